@@ -1,84 +1,224 @@
 from langgraph.graph import StateGraph, END
-from typing import Dict, List, TypedDict
+from typing import Dict, List, Optional, Sequence, TypedDict, Union
+from functools import partial
+from contextlib import asynccontextmanager
+import json
+import asyncio
+import logging
+import threading
+import httpx
+import numpy as np
 from langchain_core.messages import HumanMessage
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceBgeEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_core.documents import Document
 from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-import pandas as pd
+from langchain_core.runnables import RunnableConfig
 from config import settings
-from models import SymptomInput, DiseasePrediction, DiagnosisResponse
+from knowledge_base import asearch_with_relevance, dataset_fingerprint, read_snapshot_fingerprint, search_batch
+from live_index import LiveSymptomMatrix, build_live_retriever
+from llm_cache import LRUResponseCache, SQLiteResponseCache, bypass_llm_cache
+from llm_scheduler import LLMScheduler, ScheduledChatModel, llm_priority
+from metrics import FALLBACKS, cache_stats, instrument_node, llm_metrics_handler, timed
+from symptom_matrix import SymptomMatrixRetriever
+from symptom_lexicon import SymptomLexicon
+from models import SymptomInput, DiseasePrediction, DiagnosisResponse, StructuredDiagnosis
 #from IPython.display import Image, display 
 import os  
 
 
-# Initialize LLM
-llm = ChatGroq(
-    temperature=0.7,
-    model_name=settings.llm_model,
-    api_key=settings.groq_api_key
+logger = logging.getLogger(__name__)
+
+# 1. Shared resources, created on first use instead of at import
+llm_cache = LRUResponseCache(
+    max_entries=settings.llm_cache_size,
+    ttl=settings.llm_cache_ttl,
+    backing=SQLiteResponseCache(settings.llm_cache_path, settings.llm_cache_ttl) if settings.llm_cache_path else None
+)
+cache_stats.register("llm_response", llm_cache.stats)
+llm_scheduler = LLMScheduler(
+    max_concurrency=settings.llm_max_concurrency,
+    # The provider's limits are for the whole deployment; every worker gets an equal share
+    requests_per_minute=settings.llm_requests_per_minute / max(1, settings.workers),
+    tokens_per_minute=settings.llm_tokens_per_minute / max(1, settings.workers),
+    max_retries=settings.llm_max_retries,
+    retry_base_delay=settings.llm_retry_base_delay,
+    retry_max_delay=settings.llm_retry_max_delay,
+    call_timeout=settings.llm_call_timeout,
+    hedge_after=settings.llm_hedge_after
 )
+_init_lock = threading.Lock()
+_default_llm = None
+_default_retriever = None
+_default_symptom_matrix = None
 
-# 1. Custom Document Creation
-def create_medical_documents(csv_path: str) -> List[Document]:
-    """Convert each row into a document with symptoms + prognosis"""
-    df = pd.read_csv(csv_path)
-    documents = []
-    
-    for _, row in df.iterrows():
-        symptoms = [col for col in df.columns[:-1] if row[col] == 1]
-        prognosis = row['prognosis']
-        
-        content = f"""
-        Patient presents with: {', '.join(symptoms)}.
-        Most likely diagnosis: {prognosis}.
-        """
-        
-        metadata = {
-            "symptoms": symptoms,
-            "prognosis": prognosis,
-            "num_symptoms": len(symptoms)
-        }
-        
-        documents.append(Document(page_content=content, metadata=metadata))
-    
-    return documents
 
-# 2. Vector Store Setup
-def build_medical_retriever(csv_path: str):
-    documents = create_medical_documents(csv_path)
-    
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200
-    )
-    splits = text_splitter.split_documents(documents)
-    
-    embeddings = HuggingFaceBgeEmbeddings(
-        model_name=settings.embedding_model
-    )
-    
-    vectorstore = FAISS.from_documents(splits, embeddings)
-    return vectorstore.as_retriever(search_kwargs={"k": 4})
+def get_default_llm():
+    global _default_llm
+    with _init_lock:
+        if _default_llm is None:
+            limits = httpx.Limits(
+                max_connections=settings.llm_max_connections,
+                max_keepalive_connections=settings.llm_max_connections
+            )
+            client = ChatGroq(
+                temperature=0.7,
+                model_name=settings.llm_model,
+                api_key=settings.groq_api_key,
+                base_url=settings.llm_base_url,
+                # Retries and deadlines are the scheduler's job
+                max_retries=0,
+                http_client=httpx.Client(limits=limits),
+                http_async_client=httpx.AsyncClient(limits=limits)
+            )
+            _default_llm = ScheduledChatModel(
+                inner=client,
+                scheduler=llm_scheduler,
+                output_token_estimate=settings.llm_output_token_estimate,
+                # Identical prompts (same candidate, same symptoms) are answered from memory,
+                # before they take a slot or rate budget
+                cache=llm_cache if settings.llm_cache_size > 0 else False
+            )
+        return _default_llm
+
+
+def get_default_retriever():
+    global _default_retriever
+    with _init_lock:
+        if _default_retriever is None:
+            _default_retriever = build_live_retriever(settings.data_path)
+            embeddings = _default_retriever.vectorstore.embeddings
+            if hasattr(embeddings, "stats"):
+                cache_stats.register("query_embedding", embeddings.stats)
+        return _default_retriever
+
+
+def get_default_symptom_matrix():
+    global _default_symptom_matrix
+    with _init_lock:
+        if _default_symptom_matrix is None:
+            if settings.index_dir and settings.index_mmap and read_snapshot_fingerprint(settings.index_dir) == \
+                    dataset_fingerprint(settings.data_path, settings.embedding_model):
+                # Workers share the snapshot's mapped case arrays instead of each parsing the CSV
+                if settings.delta_dir:
+                    # Plus the cases ingested since it was compacted
+                    _default_symptom_matrix = LiveSymptomMatrix(settings.index_dir, settings.delta_dir)
+                else:
+                    _default_symptom_matrix = SymptomMatrixRetriever.from_snapshot(settings.index_dir)
+            else:
+                _default_symptom_matrix = SymptomMatrixRetriever.from_csv(settings.data_path)
+        return _default_symptom_matrix
 
-# Initialize retriever
-medical_retriever = build_medical_retriever("/app/data/new_train_set.csv")
 
-# 3. Agent Definitions
+class DiagnosisResources:
+    """LLM and retriever used by the agents; anything not injected falls back to the shared defaults on first use"""
+
+    def __init__(self, llm=None, retriever=None, symptom_matrix=None):
+        self._llm = llm.with_config(callbacks=[llm_metrics_handler]) if llm is not None else None
+        self._retriever = retriever
+        self._symptom_matrix = symptom_matrix
+        self._lexicon = None
+
+    @property
+    def llm(self):
+        if self._llm is None:
+            # Every node's LLM calls report latency and token usage
+            self._llm = get_default_llm().with_config(callbacks=[llm_metrics_handler])
+        return self._llm
+
+    @property
+    def retriever(self):
+        if self._retriever is None:
+            self._retriever = get_default_retriever()
+        return self._retriever
+
+    @property
+    def symptom_matrix(self):
+        if self._symptom_matrix is None:
+            self._symptom_matrix = get_default_symptom_matrix()
+        return self._symptom_matrix
+
+    @property
+    def lexicon(self):
+        # Built from the same columns the matrix backend scores against
+        if self._lexicon is None:
+            self._lexicon = SymptomLexicon(self.symptom_matrix.symptoms)
+        return self._lexicon
+
+    def warm_up(self):
+        """Force every lazy resource to load"""
+        self.llm
+        self.retriever
+        self.symptom_matrix
+        self.lexicon
+
+
+# 2. Agent Definitions
 class AgentState(TypedDict):
     input: str
     structured_symptoms: Dict[str, bool]
+    retrieval_backend: Optional[str]
     retrieved_diseases: List[Dict]
     predictions: List[DiseasePrediction]
     report: str
+    # Explanation per evidence_key, kept so later turns of a session only explain what changed
+    explanations: Dict[str, str]
+
+
+def make_initial_state(symptoms: SymptomInput) -> AgentState:
+    return {
+        "input": symptoms.text,
+        "structured_symptoms": symptoms.structured or {},
+        "retrieval_backend": symptoms.retrieval_backend,
+        "retrieved_diseases": [],
+        "predictions": [],
+        "report": "",
+        "explanations": {}
+    }
+
+
+def configurable(config: Optional[RunnableConfig]) -> Dict:
+    return (config or {}).get("configurable") or {}
+
+
+def request_config(symptoms: SymptomInput, config: Optional[RunnableConfig] = None) -> RunnableConfig:
+    """`config` plus the per-request options of `symptoms` that the agents read from `configurable`"""
+    config = config or {}
+    return {**config, "configurable": {**configurable(config), "no_cache": symptoms.no_cache}}
+
+
+async def emit(config: Optional[RunnableConfig], event: str, data):
+    """Send an intermediate result to the caller's `event_sink`, if it passed one"""
+    sink = configurable(config).get("event_sink")
+    if sink is not None:
+        await sink(event, data)
+
+
+@asynccontextmanager
+async def llm_slot(config: Optional[RunnableConfig]):
+    """Hold a slot of the caller's shared `llm_limit` semaphore (batch jobs) for one LLM call
+
+    Also skips the response cache for that call when the request asked for `no_cache`.
+    """
+    limit = configurable(config).get("llm_limit")
+    with bypass_llm_cache(bool(configurable(config).get("no_cache"))):
+        if limit is None:
+            yield
+        else:
+            async with limit:
+                yield
 
 # Symptom Extraction Agent
-def extract_symptoms(state: AgentState):
+async def extract_symptoms(state: AgentState, config: RunnableConfig, resources: DiagnosisResources):
     if state.get("structured_symptoms"):
         return state
+
+    # Plain descriptions usually map straight onto dataset columns; only ask the LLM when they don't
+    found: Dict[str, bool] = {}
+    if settings.use_symptom_lexicon:
+        found, coverage = resources.lexicon.match(state["input"])
+        # Only negations ("no fever") leave nothing to retrieve with; let the LLM read the text
+        if any(found.values()) and coverage >= settings.lexicon_min_coverage:
+            return {"structured_symptoms": found}
     
     prompt = ChatPromptTemplate.from_template("""
     Extract medical symptoms from the following patient description.
@@ -87,41 +227,160 @@ def extract_symptoms(state: AgentState):
     Input: {input}
     Symptoms:""")
     
-    chain = prompt | llm | StrOutputParser()
-    symptoms = chain.invoke({"input": state["input"]})
+    chain = prompt | resources.llm | StrOutputParser()
+    async with llm_slot(config):
+        symptoms = await chain.ainvoke({"input": state["input"]})
     symptoms_list = [s.strip().lower() for s in symptoms.split(",")]
     
     # Create structured format matching our dataset
-    structured = {symptom: True for symptom in symptoms_list}
+    if settings.use_symptom_lexicon:
+        structured = resources.lexicon.canonicalize(symptoms_list)
+    else:
+        structured = {symptom: True for symptom in symptoms_list}
+    # The LLM may list a symptom the text denies; the lexicon's negations win
+    structured.update({name: False for name, present in found.items() if not present})
     return {"structured_symptoms": structured}
 
 # Disease Retrieval Agent
-def retrieve_diseases(state: AgentState):
-    # Convert structured symptoms to a description for vector search
-    active_symptoms = [k for k, v in state["structured_symptoms"].items() if v]
-    symptom_text = ", ".join(active_symptoms)
-    
+def aggregate_by_prognosis(hits: List[Dict], k: int) -> List[Dict]:
+    """Collapse case-level hits into the top-k distinct diseases
+
+    Each disease keeps its best-scoring case as the representative, plus how many
+    retrieved cases supported it and their descriptions as evidence.
+    """
+    grouped: Dict[str, Dict] = {}
+    for hit in hits:
+        disease = hit["disease"].strip()
+        entry = grouped.get(disease)
+        if entry is None:
+            grouped[disease] = {**hit, "disease": disease, "support": hit.get("support", 1), "evidence": [hit["content"]]}
+            continue
+        entry["support"] += hit.get("support", 1)
+        entry["evidence"].append(hit["content"])
+        if hit["score"] > entry["score"]:
+            entry.update(score=hit["score"], symptoms=hit["symptoms"], content=hit["content"])
+
+    # Stable sort: equal scores keep retrieval order
+    return sorted(grouped.values(), key=lambda d: -d["score"])[:k]
+
+
+def doc_to_hit(doc, score: float) -> Dict:
+    return {
+        "disease": doc.metadata["prognosis"],
+        "symptoms": doc.metadata["symptoms"],
+        "score": round(score, 4),
+        "support": doc.metadata.get("support", 1),
+        "content": doc.page_content
+    }
+
+
+def present_symptoms(structured_symptoms: Dict[str, bool]) -> set:
+    """Symptoms the patient has; False marks one they were asked about and don't have"""
+    return {name for name, present in structured_symptoms.items() if present}
+
+
+def ruled_out_symptoms(structured_symptoms: Dict[str, bool]) -> set:
+    """Symptoms the patient said they don't have"""
+    return {name for name, present in structured_symptoms.items() if not present}
+
+
+def query_text(structured_symptoms: Dict[str, bool]) -> str:
+    # Convert structured symptoms to a description for vector search; sorted so the same
+    # set always produces the same query (and hits the query-embedding cache)
+    return ", ".join(sorted({k.strip().lower() for k, v in structured_symptoms.items() if v}))
+
+
+def prime_query_embeddings(resources: DiagnosisResources, queries: List[Dict[str, bool]]):
+    """Embed many symptom sets in one batch ahead of time so later retrievals hit the cache"""
+    embeddings = resources.retriever.vectorstore.embeddings
+    if hasattr(embeddings, "embed_queries"):
+        embeddings.embed_queries([query_text(q) for q in queries])
+
+
+async def retrieve_diseases(state: AgentState, config: RunnableConfig, resources: DiagnosisResources):
+    if state.get("retrieved_diseases"):
+        # Already filled in, e.g. by the batched retrieval in diagnose_batch
+        return {}
+    backend = state.get("retrieval_backend") or settings.retrieval_backend
+    # Over-fetch cases so that k distinct diseases survive the aggregation
+    fetch_k = settings.retrieval_k * max(1, settings.retrieval_overfetch)
+
+    if backend == "matrix":
+        # Exact scoring of the symptom vector against every training case
+        with timed("retrieval", "matrix"):
+            hits = resources.symptom_matrix.search(
+                state["structured_symptoms"], k=fetch_k, metric=settings.matrix_metric,
+                ruled_out_weight=settings.ruled_out_penalty
+            )
+        # Every distinct disease in the over-fetch goes on to reranking
+        return {"retrieved_diseases": aggregate_by_prognosis(hits, fetch_k)}
+    if backend != "faiss":
+        raise ValueError(f"Unknown retrieval backend {backend!r}")
+
     # Retrieve similar cases
-    docs = medical_retriever.invoke(symptom_text)
-    
-    # Process results
-    diseases = []
-    for doc in docs:
-        diseases.append({
-            "disease": doc.metadata["prognosis"],
-            "symptoms": doc.metadata["symptoms"],
-            "score": doc.metadata.get("score", 1.0),
-            "content": doc.page_content
-        })
+    with timed("retrieval", "faiss"):
+        scored = await asearch_with_relevance(
+            resources.retriever.vectorstore, query_text(state["structured_symptoms"]), fetch_k
+        )
+    hits = [doc_to_hit(doc, score) for doc, score in scored]
     
-    return {"retrieved_diseases": diseases}
+    return {"retrieved_diseases": aggregate_by_prognosis(hits, fetch_k)}
+
+
+# Rerank Agent: decides, before any LLM call, which candidates are worth explaining
+def rerank(candidates: List[Dict], structured_symptoms: Dict[str, bool]) -> List[Dict]:
+    """Order candidates by retrieval similarity blended with symptom overlap, best first
+
+    Each candidate gains `confidence` (the blend, 0-100) and `probability`
+    (softmax of the blends over all candidates).
+    """
+    if not candidates:
+        return []
+    query = present_symptoms(structured_symptoms)
+    ruled_out = ruled_out_symptoms(structured_symptoms)
+    similarity = np.clip([c["score"] for c in candidates], 0.0, 1.0)
+    sizes = np.array([len(c["symptoms"]) for c in candidates], dtype=float)
+    matched = np.array([len(query.intersection(c["symptoms"])) for c in candidates], dtype=float)
+    contradicted = np.array([len(ruled_out.intersection(c["symptoms"])) for c in candidates], dtype=float)
+    # F1 of the matched symptoms: penalises reported symptoms the case lacks and case symptoms not reported
+    overlap = 2 * matched / np.maximum(1.0, sizes + len(query))
+
+    weight = settings.rerank_similarity_weight
+    blended = weight * similarity + (1 - weight) * overlap
+    # A case symptom the patient said they don't have counts against the case
+    blended = np.maximum(0.0, blended - settings.ruled_out_penalty * contradicted / np.maximum(1.0, sizes))
+    logits = blended / max(settings.rerank_temperature, 1e-6)
+    probability = np.exp(logits - logits.max())
+    probability /= probability.sum()
+
+    order = np.argsort(-blended, kind="stable")
+    return [
+        {**candidates[i], "confidence": round(float(blended[i]) * 100, 1), "probability": round(float(probability[i]), 4)}
+        for i in order
+    ]
+
+
+def select_candidates(ranked: List[Dict], k: int) -> List[Dict]:
+    """The leading candidates that clear the confidence floor and the cumulative-probability cutoff"""
+    if not ranked:
+        return []
+    confidence = np.array([c["confidence"] for c in ranked])
+    probability = np.array([c["probability"] for c in ranked])
+    # Probability mass of the better candidates, so the one that crosses the cutoff is still kept
+    before = np.cumsum(probability) - probability
+    keep = (confidence >= settings.min_confidence) & (before < settings.cumulative_probability_cutoff)
+    # Both conditions only ever turn false further down the ranking, so keep the leading run
+    keep[0] = True
+    kept = len(ranked) if keep.all() else int(np.argmin(keep))
+    return ranked[:min(k, kept)]
+
+
+async def rerank_candidates(state: AgentState, config: RunnableConfig, resources: DiagnosisResources):
+    ranked = rerank(state["retrieved_diseases"], state["structured_symptoms"])
+    return {"retrieved_diseases": select_candidates(ranked, settings.retrieval_k)}
 
 # Explanation Agent
-def generate_explanations(state: AgentState):
-    predictions = []
-    
-    for disease in state["retrieved_diseases"]:
-        prompt = ChatPromptTemplate.from_template("""
+EXPLANATION_PROMPT = ChatPromptTemplate.from_template("""
         Explain the potential diagnosis of {disease} given these symptoms: {symptoms}.
         Provide:
         1. A clinical explanation connecting symptoms to disease
@@ -130,29 +389,88 @@ def generate_explanations(state: AgentState):
         
         Write in clear, patient-friendly language.
         """)
-        
-        chain = prompt | llm | StrOutputParser()
-        explanation = chain.invoke({
-            "disease": disease["disease"],
-            "symptoms": ", ".join(disease["symptoms"])
-        })
-        
-        # Simple confidence calculation (could be enhanced)
-        matched_symptoms = set(disease["symptoms"]) & set(state["structured_symptoms"].keys())
+
+
+EXPLANATION_UNAVAILABLE = "Explanation unavailable for"
+
+
+def evidence_key(disease: Dict) -> str:
+    """What an explanation is written from; the same key means the same prompt"""
+    return json.dumps([disease["disease"], disease["symptoms"]])
+
+
+async def explain_disease(disease: Dict, resources: DiagnosisResources, limit: asyncio.Semaphore,
+                          config: Optional[RunnableConfig] = None) -> str:
+    chain = EXPLANATION_PROMPT | resources.llm | StrOutputParser()
+    inputs = {
+        "disease": disease["disease"],
+        "symptoms": ", ".join(disease["symptoms"])
+    }
+
+    async def call():
+        try:
+            async with limit, llm_slot(config):
+                return await chain.ainvoke(inputs)
+        except Exception as e:
+            # Degrade this candidate only; the rest of the diagnosis still goes out
+            return f"{EXPLANATION_UNAVAILABLE} {disease['disease']} ({type(e).__name__})."
+
+    # Batch runs share one task per distinct prompt, so a disease is explained once per batch
+    memo = configurable(config).get("explanation_memo")
+    if memo is None:
+        return await call()
+    key = (inputs["disease"], inputs["symptoms"], bool(configurable(config).get("no_cache")))
+    if key not in memo:
+        memo[key] = asyncio.ensure_future(call())
+    return await asyncio.shield(memo[key])
+
+
+def make_prediction(disease: Dict, structured_symptoms: Dict[str, bool], explanation: str = "") -> DiseasePrediction:
+    matched_symptoms = set(disease["symptoms"]) & present_symptoms(structured_symptoms)
+    # Set by rerank; otherwise the share of the case's symptoms that were reported
+    confidence = disease.get("confidence")
+    if confidence is None:
         confidence = min(100, len(matched_symptoms) / len(disease["symptoms"]) * 100)
-        
-        predictions.append(DiseasePrediction(
-            disease=disease["disease"],
-            confidence=round(confidence, 1),
-            symptoms_matched=list(matched_symptoms),
-            explanation=explanation,
-            follow_up_questions=[]
-        ))
     
+    return DiseasePrediction(
+        disease=disease["disease"],
+        confidence=round(confidence, 1),
+        symptoms_matched=list(matched_symptoms),
+        explanation=explanation,
+        follow_up_questions=[]
+    )
+
+
+async def generate_explanations(state: AgentState, config: RunnableConfig, resources: DiagnosisResources):
+    diseases = state["retrieved_diseases"]
+    # Earlier turns of a session: candidates whose evidence is unchanged keep their explanation
+    explanations = dict(state.get("explanations") or {})
+
+    # One LLM call per candidate, run concurrently; gather() keeps the input order
+    limit = asyncio.Semaphore(max(1, settings.explanation_concurrency))
+
+    async def predict(index: int, disease: Dict) -> DiseasePrediction:
+        key = evidence_key(disease)
+        explanation = explanations.get(key)
+        if explanation is None:
+            explanation = await explain_disease(disease, resources, limit, config)
+            if not explanation.startswith(EXPLANATION_UNAVAILABLE):
+                explanations[key] = explanation
+        prediction = make_prediction(disease, state["structured_symptoms"], explanation)
+        # Streamed as soon as it is ready, not in candidate order
+        await emit(config, "explanation", {"index": index, "prediction": prediction.model_dump()})
+        return prediction
+
+    predictions = await asyncio.gather(*(predict(i, d) for i, d in enumerate(diseases)))
+    return {"predictions": list(predictions), "explanations": explanations}
+
+# Ranking-only Agent: predictions straight from retrieval, no LLM calls
+async def rank_candidates(state: AgentState, config: RunnableConfig, resources: DiagnosisResources):
+    predictions = [make_prediction(d, state["structured_symptoms"]) for d in state["retrieved_diseases"]]
     return {"predictions": predictions}
 
 # Confidence & Follow-up Agent
-def generate_followups(state: AgentState):
+async def generate_followups(state: AgentState, config: RunnableConfig, resources: DiagnosisResources):
     if not state["predictions"]:
         return state
     
@@ -164,16 +482,20 @@ def generate_followups(state: AgentState):
     suggest 3-5 follow-up questions to clarify or confirm this diagnosis.
     
     Current symptoms: {symptoms}
+    Ruled out: {absent}
     
     Return each question on a new line.
     """)
     
-    chain = prompt | llm | StrOutputParser()
-    questions = chain.invoke({
-        "disease": top_pred.disease,
-        "confidence": top_pred.confidence,
-        "symptoms": ", ".join(state["structured_symptoms"].keys())
-    }).split("\n")
+    chain = prompt | resources.llm | StrOutputParser()
+    absent = sorted(name for name, present in state["structured_symptoms"].items() if not present)
+    async with llm_slot(config):
+        questions = (await chain.ainvoke({
+            "disease": top_pred.disease,
+            "confidence": top_pred.confidence,
+            "symptoms": ", ".join(sorted(present_symptoms(state["structured_symptoms"]))),
+            "absent": ", ".join(absent) or "none"
+        })).split("\n")
     
     # Update predictions with follow-ups
     updated_preds = state["predictions"]
@@ -182,7 +504,7 @@ def generate_followups(state: AgentState):
     return {"predictions": updated_preds}
 
 # Report Generation Agent
-def generate_report(state: AgentState):
+async def generate_report(state: AgentState, config: RunnableConfig, resources: DiagnosisResources):
     if not state["predictions"]:
         return {"report": "No diagnosis could be determined from the provided symptoms."}
     
@@ -200,35 +522,282 @@ def generate_report(state: AgentState):
     Use simple language and bullet points where appropriate.
     """)
     
-    chain = prompt | llm | StrOutputParser()
-    report = chain.invoke({
+    chain = prompt | resources.llm | StrOutputParser()
+    inputs = {
         "predictions": "\n\n".join(
             f"Diagnosis: {p.disease}\nConfidence: {p.confidence}%\n{p.explanation}"
             for p in state["predictions"]
         )
-    })
+    }
+
+    # Stream tokens when someone is listening, otherwise one plain call
+    async with llm_slot(config):
+        if configurable(config).get("event_sink") is None:
+            report = await chain.ainvoke(inputs)
+        else:
+            chunks = []
+            async for chunk in chain.astream(inputs):
+                chunks.append(chunk)
+                await emit(config, "report_token", {"text": chunk})
+            report = "".join(chunks)
     
     return {"report": report}
 
-# Build the workflow
-workflow = StateGraph(AgentState)
+# Single-shot Agent: explanations, follow-ups and report from one structured LLM call
+SINGLE_SHOT_PROMPT = ChatPromptTemplate.from_template("""
+    A patient reports these symptoms: {symptoms}
+
+    Candidate diagnoses retrieved from similar cases:
+    {candidates}
+
+    Respond with ONLY a JSON object of this form:
+    {{"explanations": {{"<candidate disease>": "<explanation>"}},
+      "follow_up_questions": ["<question>"],
+      "report": "<report>"}}
+
+    - explanations: one entry per candidate, keyed by its exact name. Connect the symptoms
+      to the disease, give typical treatment approaches and a confidence level (0-100%)
+      based on symptom match, in clear, patient-friendly language.
+    - follow_up_questions: 3-5 questions to clarify or confirm {top_disease}.
+    - report: a patient-friendly medical report with a summary of likely conditions, key
+      symptoms supporting each, recommended next steps and when to seek immediate care.
+      Use simple language and bullet points where appropriate.
+    """)
+
+
+def parse_structured_diagnosis(text: str, predictions: List[DiseasePrediction]) -> DiagnosisResponse:
+    """Fill `predictions` from the single-shot answer; raises ValueError if it doesn't cover them all"""
+    # Models often wrap JSON in prose or a code fence
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        raise ValueError("No JSON object in the response")
+    answer = StructuredDiagnosis.model_validate_json(text[start:end + 1])
+
+    explanations = {name.strip().lower(): explanation for name, explanation in answer.explanations.items()}
+    missing = [p.disease for p in predictions if not explanations.get(p.disease.strip().lower())]
+    if missing:
+        raise ValueError(f"No explanation for {', '.join(missing)}")
+
+    filled = [
+        p.model_copy(update={"explanation": explanations[p.disease.strip().lower()]}) for p in predictions
+    ]
+    filled[0].follow_up_questions = [q.strip() for q in answer.follow_up_questions if q.strip()]
+    return DiagnosisResponse(predictions=filled, report=answer.report)
+
+
+async def generate_single_shot(state: AgentState, config: RunnableConfig, resources: DiagnosisResources):
+    if not state["retrieved_diseases"]:
+        return {"predictions": [], "report": "No diagnosis could be determined from the provided symptoms."}
+
+    predictions = [make_prediction(d, state["structured_symptoms"]) for d in state["retrieved_diseases"]]
+    top_pred = max(predictions, key=lambda x: x.confidence)
+    chain = SINGLE_SHOT_PROMPT | resources.llm | StrOutputParser()
+    try:
+        async with llm_slot(config):
+            answer = await chain.ainvoke({
+                "symptoms": ", ".join(sorted(present_symptoms(state["structured_symptoms"]))),
+                "candidates": "\n".join(
+                    f"- {p.disease} (match confidence: {p.confidence}%)" for p in predictions
+                ),
+                "top_disease": top_pred.disease
+            })
+        response = parse_structured_diagnosis(answer, predictions)
+    except Exception as e:
+        # Leave the report empty; the graph then falls back to one call per stage
+        logger.warning("Single-shot diagnosis failed, falling back to separate calls: %s", e)
+        return {}
+    return {"predictions": response.predictions, "report": response.report}
+
+# 3. Workflow
+# "full" runs every agent; "rank_only" stops after retrieval and returns ranked diseases
+# without explanations, follow-ups or a report (no LLM calls for structured input);
+# "single_shot" writes all three in one LLM call and only runs "full"'s agents if that fails
+PIPELINE_MODES = ("full", "rank_only", "single_shot")
+
+
+def build_diagnosis_chain(llm=None, retriever=None, symptom_matrix=None, mode: str = "full",
+                          resources: Optional[DiagnosisResources] = None, checkpointer=None):
+    """Compile the diagnosis graph; resources that are not passed in are loaded lazily on first use
+
+    With a LangGraph `checkpointer` the state of every run is saved under the
+    `thread_id` of its config, which is what diagnosis sessions build on.
+    """
+    if mode not in PIPELINE_MODES:
+        raise ValueError(f"Unknown pipeline mode {mode!r}, expected one of {PIPELINE_MODES}")
+    resources = resources or DiagnosisResources(llm=llm, retriever=retriever, symptom_matrix=symptom_matrix)
+    workflow = StateGraph(AgentState)
+
+    def add_node(node):
+        # Every node gets the shared resources and reports its latency
+        workflow.add_node(node.__name__, instrument_node(node.__name__, partial(node, resources=resources)))
+
+    # Define nodes
+    add_node(extract_symptoms)
+    add_node(retrieve_diseases)
+    add_node(rerank_candidates)
+
+    # Define edges
+    workflow.set_entry_point("extract_symptoms")
+    workflow.add_edge("extract_symptoms", "retrieve_diseases")
+    workflow.add_edge("retrieve_diseases", "rerank_candidates")
+
+    if mode == "rank_only":
+        add_node(rank_candidates)
+        workflow.add_edge("rerank_candidates", "rank_candidates")
+        workflow.add_edge("rank_candidates", END)
+    else:
+        add_node(generate_explanations)
+        add_node(generate_followups)
+        add_node(generate_report)
+        if mode == "single_shot":
+            add_node(generate_single_shot)
+            workflow.add_edge("rerank_candidates", "generate_single_shot")
+            workflow.add_conditional_edges(
+                "generate_single_shot",
+                lambda state: END if state["report"] else "generate_explanations",
+                [END, "generate_explanations"]
+            )
+        else:
+            workflow.add_edge("rerank_candidates", "generate_explanations")
+        workflow.add_edge("generate_explanations", "generate_followups")
+        workflow.add_edge("generate_followups", "generate_report")
+        workflow.add_edge("generate_report", END)
+
+    # Compile the graph
+    chain = workflow.compile(checkpointer=checkpointer)
+    chain.resources = resources
+    chain.mode = mode
+    return chain
+
+
+def chain_for_mode(chain, mode: str):
+    """Variant of a compiled chain for another pipeline mode, sharing its resources"""
+    if chain.mode == mode:
+        return chain
+    if not hasattr(chain, "variants"):
+        chain.variants = {}
+    if mode not in chain.variants:
+        chain.variants[mode] = build_diagnosis_chain(mode=mode, resources=chain.resources)
+    return chain.variants[mode]
+
+
+_default_chains: Dict[str, object] = {}
+
+
+def get_diagnosis_chain(mode: str = "full"):
+    """Shared chain for `mode`, built from the default resources"""
+    if mode not in _default_chains:
+        chain = build_diagnosis_chain(mode=mode)
+        with _init_lock:
+            _default_chains.setdefault(mode, chain)
+    return _default_chains[mode]
+
+
+def warm_up():
+    """Load the LLM client, embeddings and index so the first request doesn't pay for it"""
+    chain = get_diagnosis_chain()
+    chain.resources.warm_up()
+    return chain
+
+
+# 4. Batch diagnosis
+def batch_key(symptoms: SymptomInput) -> str:
+    """Identical inputs (up to case and whitespace) get the same key and the same diagnosis"""
+    structured = sorted((symptoms.structured or {}).items())
+    text = " ".join(symptoms.text.lower().split())
+    return json.dumps([text, structured, symptoms.retrieval_backend, symptoms.mode, symptoms.no_cache])
+
+
+async def retrieve_batch(states: List[AgentState], resources: DiagnosisResources) -> List[List[Dict]]:
+    """Retrieve candidates for many states with one scoring / embedding call per backend"""
+    fetch_k = settings.retrieval_k * max(1, settings.retrieval_overfetch)
+    results: List[List[Dict]] = [[] for _ in states]
+    by_backend: Dict[str, List[int]] = {}
+    for i, state in enumerate(states):
+        by_backend.setdefault(state.get("retrieval_backend") or settings.retrieval_backend, []).append(i)
+
+    for backend, indices in by_backend.items():
+        queries = [states[i]["structured_symptoms"] for i in indices]
+        if backend == "matrix":
+            with timed("retrieval", "matrix_batch"):
+                hits = resources.symptom_matrix.search_batch(queries, k=fetch_k, metric=settings.matrix_metric,
+                                                             ruled_out_weight=settings.ruled_out_penalty)
+        elif backend == "faiss":
+            with timed("retrieval", "faiss_batch"):
+                docs = await asyncio.to_thread(
+                    search_batch, resources.retriever.vectorstore, [query_text(q) for q in queries], fetch_k
+                )
+            hits = [[doc_to_hit(doc, score) for doc, score in row] for row in docs]
+        else:
+            raise ValueError(f"Unknown retrieval backend {backend!r}")
+        for i, row in zip(indices, hits):
+            results[i] = aggregate_by_prognosis(row, fetch_k)
+    return results
+
+
+async def diagnose_batch(inputs: Sequence[SymptomInput], chain=None,
+                         max_concurrency: Optional[int] = None) -> List[Union[AgentState, Exception]]:
+    """Diagnose many inputs at once; returns a final state or the exception for each input, in order
+
+    Identical inputs run once, retrieval is batched per backend, explanations of the
+    same disease are shared across the batch, and every LLM call goes through one
+    semaphore of `max_concurrency` slots.
+    """
+    chain = chain or get_diagnosis_chain()
+    resources = chain.resources
+    config = {"configurable": {
+        "llm_limit": asyncio.Semaphore(max(1, max_concurrency or settings.batch_max_concurrency)),
+        "explanation_memo": {}
+    }}
+
+    # Batch jobs give way to interactive requests for LLM slots
+    with llm_priority("batch"):
+        unique: Dict[str, int] = {}
+        states: List[AgentState] = []
+        modes: List[str] = []
+        configs: List[RunnableConfig] = []
+        positions = []
+        for symptoms in inputs:
+            key = batch_key(symptoms)
+            if key not in unique:
+                unique[key] = len(states)
+                states.append(make_initial_state(symptoms))
+                modes.append(symptoms.mode)
+                configs.append(request_config(symptoms, config))
+            positions.append(unique[key])
+
+        # Free-text inputs need their symptoms extracted before retrieval can be batched
+        async def extract(state, item_config):
+            if not state["structured_symptoms"]:
+                state.update(await extract_symptoms(state, item_config, resources))
+            return state
+
+        prepared = await asyncio.gather(*(extract(s, c) for s, c in zip(states, configs)), return_exceptions=True)
+        ready = [i for i, s in enumerate(prepared) if not isinstance(s, Exception)]
+        try:
+            for i, candidates in zip(ready, await retrieve_batch([states[i] for i in ready], resources)):
+                states[i]["retrieved_diseases"] = candidates
+        except Exception:
+            # Fall back to per-item retrieval inside the graph
+            logger.exception("Batched retrieval failed, retrieving each item separately")
+            FALLBACKS.labels(path="batch_retrieval").inc()
 
-# Define nodes
-workflow.add_node("extract_symptoms", extract_symptoms)
-workflow.add_node("retrieve_diseases", retrieve_diseases)
-workflow.add_node("generate_explanations", generate_explanations)
-workflow.add_node("generate_followups", generate_followups)
-workflow.add_node("generate_report", generate_report)
+        outcomes: List[Union[AgentState, Exception]] = list(prepared)
 
-# Define edges
-workflow.set_entry_point("extract_symptoms")
-workflow.add_edge("extract_symptoms", "retrieve_diseases")
-workflow.add_edge("retrieve_diseases", "generate_explanations")
-workflow.add_edge("generate_explanations", "generate_followups")
-workflow.add_edge("generate_followups", "generate_report")
-workflow.add_edge("generate_report", END)
+        async def run_mode(mode: str):
+            indices = [i for i in ready if modes[i] == mode]
+            runs = await chain_for_mode(chain, mode).abatch(
+                [states[i] for i in indices], config=[configs[i] for i in indices], return_exceptions=True
+            )
+            for i, run in zip(indices, runs):
+                outcomes[i] = run
 
-# Compile the graph
-diagnosis_chain = workflow.compile()
+        await asyncio.gather(*(run_mode(mode) for mode in set(modes[i] for i in ready)))
+        return [outcomes[i] for i in positions]
 
 
+def __getattr__(name):
+    # Keep `from agents import diagnosis_chain` working without building it at import
+    if name == "diagnosis_chain":
+        return get_diagnosis_chain()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,65 +1,458 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import APIRouter, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
-from typing import List, Optional
-from agents import diagnosis_chain
-from models import SymptomInput, DiagnosisResponse
+from typing import Callable, List, Optional
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import time
+from metrics import REQUEST_SECONDS, cache_stats, collect_timings, render_metrics
+from agents import batch_key, chain_for_mode, diagnose_batch, make_initial_state, request_config, warm_up
+from config import settings
+from models import (SymptomInput, DiagnosisResponse, BatchDiagnosisRequest, BatchDiagnosisResponse, BatchItemResult,
+                    CaseIngestRequest, CaseIngestResponse, SessionAnswer, SessionResponse)
 import uvicorn
 from evaluation import MedicalDiagnosisEvaluator
+from live_index import LiveCaseIndex, LiveSymptomMatrix, cases_from_csv
+from sessions import DiagnosisSessions, UnknownSession, open_checkpointer
+from single_flight import SingleFlight
 from fastapi.responses import FileResponse
 
+logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Medical Diagnosis Assistant API")
 
-# CORS configuration
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+router = APIRouter()
 
 
-@app.post("/diagnose", response_model=DiagnosisResponse)
-async def diagnose(symptoms: SymptomInput):
+def create_app(chain_factory: Callable = warm_up) -> FastAPI:
+    """Build the API; `chain_factory` returns the compiled diagnosis graph and runs in the background at startup"""
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # Every worker runs this; a no-op when the host application configured logging already
+        logging.basicConfig(level=settings.log_level, format="%(levelname)s:     %(name)s - %(message)s")
+        # Warm up off the event loop so the process can answer health checks meanwhile
+        app.state.chain_task = asyncio.create_task(asyncio.to_thread(chain_factory))
+        maintenance = asyncio.create_task(maintain_live_index(app))
+        async with open_checkpointer() as checkpointer:
+            app.state.checkpointer = checkpointer
+            yield
+        maintenance.cancel()
+        app.state.chain_task.cancel()
+
+    app = FastAPI(title="Medical Diagnosis Assistant API", lifespan=lifespan)
+    app.state.sessions = None
+    app.state.single_flight = SingleFlight(settings.coalesce_hold_seconds, settings.coalesce_max_held)
+    cache_stats.register("diagnose_single_flight", app.state.single_flight.stats)
+
+    # CORS configuration
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    @app.middleware("http")
+    async def record_latency(request: Request, call_next):
+        start = time.perf_counter()
+        response = await call_next(request)
+        route = request.scope.get("route")
+        REQUEST_SECONDS.labels(getattr(route, "path", "unmatched"), response.status_code).observe(
+            time.perf_counter() - start
+        )
+        return response
+
+    app.include_router(router)
+    return app
+
+
+def live_index_of(chain) -> Optional[LiveCaseIndex]:
+    vectorstore = getattr(chain.resources.retriever, "vectorstore", None)
+    return vectorstore if isinstance(vectorstore, LiveCaseIndex) else None
+
+
+def live_matrix_of(chain) -> Optional[LiveSymptomMatrix]:
+    matrix = chain.resources.symptom_matrix
+    return matrix if isinstance(matrix, LiveSymptomMatrix) else None
+
+
+async def maintain_live_index(app: FastAPI):
+    """Pick up cases ingested by other workers and compact the ingestion log now and then"""
     try:
+        chain = await asyncio.shield(app.state.chain_task)
+    except Exception:
+        # Warm-up failed; /ready reports why
+        return
+    index, matrix = live_index_of(chain), live_matrix_of(chain)
+    if index is None:
+        return
+    loop = asyncio.get_running_loop()
+    next_compaction = loop.time() + settings.compaction_interval
+    while True:
+        await asyncio.sleep(max(0.1, settings.index_sync_interval))
+        try:
+            await asyncio.to_thread(index.sync)
+            if matrix is not None:
+                await asyncio.to_thread(matrix.sync)
+            if settings.compaction_interval > 0 and loop.time() >= next_compaction:
+                next_compaction = loop.time() + settings.compaction_interval
+                compacted = await asyncio.to_thread(index.compact_if_needed)
+                if compacted:
+                    logger.info("Compacted %d ingested cases into the index snapshot", compacted)
+        except Exception as e:
+            # Searches keep using the segments already loaded; try again next round
+            logger.exception("Live index maintenance failed: %s", e)
+
+
+async def get_chain(request: Request, mode: str = "full"):
+    """Wait for warm-up to finish and return the compiled graph for `mode`"""
+    chain = await asyncio.shield(request.app.state.chain_task)
+    return chain_for_mode(chain, mode)
+
+
+@router.get("/ready")
+async def ready(request: Request):
+    task = request.app.state.chain_task
+    if not task.done():
+        return JSONResponse(status_code=503, content={"status": "warming_up"})
+    if task.cancelled() or task.exception() is not None:
+        return JSONResponse(status_code=503, content={"status": "failed", "detail": str(task.exception())})
+    return {"status": "ready"}
+
+
+async def get_symptom_catalogue(request: Request):
+    """JSON body and ETag of the symptom list, built once from the loaded dataset schema"""
+    catalogue = getattr(request.app.state, "symptom_catalogue", None)
+    if catalogue is None:
+        chain = await get_chain(request)
+        matrix = await asyncio.to_thread(lambda: chain.resources.symptom_matrix)
+        body = json.dumps({"symptoms": matrix.symptoms}).encode("utf-8")
+        catalogue = (body, '"' + hashlib.sha256(body).hexdigest()[:32] + '"')
+        request.app.state.symptom_catalogue = catalogue
+    return catalogue
+
+
+@router.get("/symptoms")
+async def list_symptoms(request: Request):
+    """Symptom names the pipeline recognises, for building selection UIs"""
+    body, etag = await get_symptom_catalogue(request)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={settings.symptoms_max_age}"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def run_for_client(request: Request, coro, timeout: float):
+    """Await `coro` but cancel it on timeout or as soon as the client goes away"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=min(settings.disconnect_poll_interval, max(0, deadline - loop.time())))
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise ClientDisconnected()
+            if loop.time() >= deadline:
+                raise asyncio.TimeoutError()
+    finally:
+        task.cancel()
+
+
+@router.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of latency, token, retry and cache metrics for this worker"""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+@router.post("/diagnose", response_model=DiagnosisResponse)
+async def diagnose(symptoms: SymptomInput, request: Request):
+    try:
+        diagnosis_chain = await get_chain(request, symptoms.mode)
+
         # Initialize state
-        initial_state = {
-            "input": symptoms.text,
-            "structured_symptoms": symptoms.structured or {},
-            "retrieved_diseases": [],
-            "predictions": [],
-            "report": ""
-        }
+        initial_state = make_initial_state(symptoms)
+        if settings.coalesce_requests:
+            # Identical requests in flight share one run (stage timings go to the first caller)
+            run = request.app.state.single_flight.run(
+                batch_key(symptoms), lambda: diagnosis_chain.ainvoke(initial_state, request_config(symptoms))
+            )
+        else:
+            run = diagnosis_chain.ainvoke(initial_state, request_config(symptoms))
         
         # Execute the workflow
-        result = diagnosis_chain.invoke(initial_state)
+        with collect_timings() as timings:
+            result = await run_for_client(request, run, settings.diagnosis_timeout)
         
         return DiagnosisResponse(
             predictions=result["predictions"],
-            report=result["report"]
+            report=result["report"],
+            timings=timings if symptoms.include_timings else None
         )
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Diagnosis timed out")
+    except ClientDisconnected:
+        # Nobody is listening any more; the pipeline has already been cancelled
+        raise HTTPException(status_code=499, detail="Client closed request")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+
+async def get_sessions(request: Request) -> DiagnosisSessions:
+    if request.app.state.checkpointer is None:
+        raise HTTPException(status_code=503, detail="Sessions need SESSION_STORE=sqlite when running several workers")
+    if request.app.state.sessions is None:
+        chain = await get_chain(request)
+        request.app.state.sessions = DiagnosisSessions(chain.resources, request.app.state.checkpointer)
+    return request.app.state.sessions
+
+
+def session_response(session_id: str, state: dict, generated: int) -> SessionResponse:
+    return SessionResponse(
+        session_id=session_id,
+        predictions=state["predictions"],
+        report=state["report"],
+        structured_symptoms=state["structured_symptoms"],
+        explanations_generated=generated
+    )
+
+
+@router.post("/sessions", response_model=SessionResponse)
+async def start_session(symptoms: SymptomInput, request: Request):
+    """Full diagnosis (whatever `mode` says) that can continue with /sessions/{id}/answer"""
+    sessions = await get_sessions(request)
+    try:
+        session_id, state = await run_for_client(request, sessions.start(symptoms), settings.diagnosis_timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Diagnosis timed out")
+    except ClientDisconnected:
+        raise HTTPException(status_code=499, detail="Client closed request")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return session_response(session_id, state, len(state.get("explanations") or {}))
+
+
+@router.get("/sessions/{session_id}", response_model=SessionResponse)
+async def get_session(session_id: str, request: Request):
+    state = await (await get_sessions(request)).get(session_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Unknown session")
+    return session_response(session_id, state, 0)
+
+
+@router.post("/sessions/{session_id}/answer", response_model=SessionResponse)
+async def answer_session(session_id: str, answer: SessionAnswer, request: Request):
+    """Add answers to follow-up questions; only explanations whose evidence changed are rewritten"""
+    if not (answer.text or "").strip() and not answer.symptoms:
+        raise HTTPException(status_code=422, detail="Send the answer as text or as symptoms")
+    sessions = await get_sessions(request)
+    try:
+        state, generated = await run_for_client(
+            request, sessions.answer(session_id, answer), settings.diagnosis_timeout
+        )
+    except UnknownSession:
+        raise HTTPException(status_code=404, detail="Unknown session")
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Diagnosis timed out")
+    except ClientDisconnected:
+        raise HTTPException(status_code=499, detail="Client closed request")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return session_response(session_id, state, generated)
+
+
+@router.post("/diagnose/batch", response_model=BatchDiagnosisResponse)
+async def diagnose_batch_endpoint(batch: BatchDiagnosisRequest, request: Request):
+    if len(batch.items) > settings.batch_max_items:
+        raise HTTPException(status_code=413, detail=f"At most {settings.batch_max_items} items per batch")
+    try:
+        diagnosis_chain = await get_chain(request)
+        outcomes = await run_for_client(
+            request,
+            diagnose_batch(batch.items, diagnosis_chain, batch.max_concurrency),
+            settings.batch_timeout
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Batch diagnosis timed out")
+    except ClientDisconnected:
+        raise HTTPException(status_code=499, detail="Client closed request")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    results = []
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            results.append(BatchItemResult(error=str(outcome) or type(outcome).__name__))
+        else:
+            results.append(BatchItemResult(predictions=outcome["predictions"], report=outcome["report"]))
+    return BatchDiagnosisResponse(results=results)
+
+
+async def ingest(request: Request, cases) -> CaseIngestResponse:
+    if len(cases) > settings.ingest_max_cases:
+        raise HTTPException(status_code=413, detail=f"At most {settings.ingest_max_cases} cases per request")
+    chain = await get_chain(request)
+    index = live_index_of(chain)
+    if index is None:
+        raise HTTPException(status_code=501, detail="Case ingestion is disabled (set DELTA_DIR)")
+    try:
+        ingested = await asyncio.to_thread(index.add_cases, cases)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    matrix = live_matrix_of(chain)
+    if matrix is not None:
+        # The matrix backend sees the new cases right away too; other workers catch up on their next sync
+        await asyncio.to_thread(matrix.sync)
+    return CaseIngestResponse(ingested=ingested, total_cases=len(index), pending_compaction=index.delta_size)
+
+
+@router.post("/cases", response_model=CaseIngestResponse)
+async def ingest_cases(body: CaseIngestRequest, request: Request):
+    """Add labelled cases to the search index without rebuilding it"""
+    return await ingest(request, [(case.symptoms, case.prognosis) for case in body.cases])
+
+
+@router.post("/cases/csv", response_model=CaseIngestResponse)
+async def ingest_cases_csv(request: Request):
+    """Bulk variant of /cases: the request body is a CSV in the training set's layout"""
+    try:
+        cases = await asyncio.to_thread(cases_from_csv, io.BytesIO(await request.body()))
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=422, detail=f"Unreadable case CSV: {e}")
+    return await ingest(request, cases)
+
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def node_events(node: str, update: dict):
+    """Map a graph node's state update to the SSE events sent for it"""
+    if node == "extract_symptoms":
+        yield "symptoms", update.get("structured_symptoms", {})
+    elif node == "rerank_candidates":
+        # The candidates that survived reranking, i.e. the ones that will be explained
+        yield "candidates", [
+            {"disease": d["disease"], "score": d["score"], "confidence": d["confidence"],
+             "probability": d["probability"], "support": d.get("support", 1), "symptoms": d["symptoms"]}
+            for d in update.get("retrieved_diseases", [])
+        ]
+    elif node in ("generate_explanations", "rank_candidates"):
+        yield "predictions", [p.model_dump() for p in update.get("predictions", [])]
+    elif node == "generate_followups":
+        preds = update.get("predictions") or []
+        yield "followups", preds[0].follow_up_questions if preds else []
+    elif node == "generate_report":
+        yield "report", update.get("report", "")
+    elif node == "generate_single_shot":
+        # Nothing to send when it failed; the per-stage agents run next and report instead
+        if update.get("report"):
+            preds = update.get("predictions") or []
+            yield "predictions", [p.model_dump() for p in preds]
+            yield "followups", preds[0].follow_up_questions if preds else []
+            yield "report", update["report"]
+    else:
+        yield node, {}
+
+
+@router.post("/diagnose/stream")
+async def diagnose_stream(symptoms: SymptomInput, request: Request):
+    """Same pipeline as /diagnose, sent as server-sent events while each stage finishes"""
+    diagnosis_chain = await get_chain(request, symptoms.mode)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def sink(event: str, data):
+        await queue.put((event, data))
+
+    async def run_graph():
+        config = request_config(symptoms, {"configurable": {"event_sink": sink}})
+        async for step in diagnosis_chain.astream(make_initial_state(symptoms), config=config):
+            for node, update in step.items():
+                for event in node_events(node, update or {}):
+                    await queue.put(event)
+
+    async def run():
+        try:
+            await asyncio.wait_for(run_graph(), settings.diagnosis_timeout)
+            await queue.put(("done", {}))
+        except asyncio.TimeoutError:
+            await queue.put(("error", {"detail": "Diagnosis timed out"}))
+        except Exception as e:
+            await queue.put(("error", {"detail": str(e)}))
+        finally:
+            await queue.put(None)
+
+    async def events():
+        task = asyncio.create_task(run())
+        try:
+            while (item := await queue.get()) is not None:
+                yield sse_event(*item)
+        finally:
+            # Starlette closes the generator when the client disconnects
+            task.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
     # Evaluation Endpoints
-@app.post("/evaluation/run")
+_evaluator = None
+
+
+def get_evaluator() -> MedicalDiagnosisEvaluator:
+    # One evaluator per process so the confusion matrix reuses the predictions of the last run
+    global _evaluator
+    if _evaluator is None:
+        _evaluator = MedicalDiagnosisEvaluator("D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\new_test_set.csv")
+    return _evaluator
+
+
+@router.post("/evaluation/run")
 async def run_evaluation():
-    evaluator = MedicalDiagnosisEvaluator("D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\new_test_set.csv")
-    metrics = evaluator.evaluate()
+    evaluator = get_evaluator()
+    # On the server's event loop: the diagnosis chain's LLM client belongs to it
+    metrics = await evaluator.aevaluate()
     return {"metrics": metrics}
 
-@app.get("/evaluation/confusion-matrix")
+@router.get("/evaluation/confusion-matrix")
 async def get_confusion_matrix():
-    evaluator = MedicalDiagnosisEvaluator("D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\new_test_set.csv")
+    evaluator = get_evaluator()
     cm_path = "D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\confusion_matrix.csv"
-    evaluator.save_confusion_matrix(cm_path)
+    await evaluator.asave_confusion_matrix(cm_path)
     return FileResponse(
         path=cm_path,
         media_type="text/csv",
         filename="confusion_matrix.csv"
     )
 
+app = create_app()
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Multi-worker mode: `WORKERS=4 python app.py` or `uvicorn app:app --workers 4`.
+    # Every worker is a separate process with its own embedding model, LLM client and caches,
+    # but the FAISS index and case metadata are memory-mapped read-only from the snapshot
+    # (INDEX_MMAP, on by default), so the OS keeps a single copy of them for all workers.
+    # Prebuild the snapshot first (`python knowledge_base.py`, as the Dockerfile does) so the
+    # workers load it instead of each embedding the corpus. /metrics reports per worker.
+    # Sessions (/sessions) need SESSION_STORE=sqlite so that every worker sees them; with the
+    # default memory store they are disabled when WORKERS > 1. Set WORKERS to the worker count
+    # with `uvicorn --workers` as well, or each worker keeps sessions of its own.
+    if settings.workers > 1:
+        # Workers re-import the app, so uvicorn needs it by name
+        uvicorn.run("app:app", host="0.0.0.0", port=8000, workers=settings.workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,280 @@
+"""Offline performance benchmark for the diagnosis pipeline
+
+Runs the graph and the FastAPI app against a fake chat model (fixed latency
+and output length) and deterministic fake embeddings, so no API key or
+network is needed. Results are written as JSON for comparison across runs:
+
+    python benchmark.py --requests 200 --concurrency 16 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import faiss
+import httpx
+import numpy as np
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from agents import DiagnosisResources, build_diagnosis_chain, make_initial_state
+from app import create_app
+from config import settings
+from knowledge_base import build_embeddings, load_case_table, load_or_build_vectorstore
+from metrics import collect_timings
+from models import SymptomInput
+from symptom_matrix import SymptomMatrixRetriever
+
+
+# 1. Fakes
+class FakeChatModel(BaseChatModel):
+    """Chat model that waits `latency` seconds and answers with `output_tokens` words"""
+
+    latency: float = 0.05
+    output_tokens: int = 64
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-benchmark"
+
+    def _content(self, prompt: str) -> str:
+        words = " ".join(["lorem"] * self.output_tokens)
+        candidates = re.findall(r"^\s*- (.+) \(match confidence", prompt, flags=re.MULTILINE)
+        if not candidates:
+            return words
+        # Single-shot prompt: answer with the JSON object it asks for
+        return json.dumps({
+            "explanations": {disease: words for disease in candidates},
+            "follow_up_questions": ["lorem?"],
+            "report": words
+        })
+
+    def _result(self, messages) -> ChatResult:
+        prompt = "\n".join(str(m.content) for m in messages)
+        # Roughly four characters per token, as for English text
+        prompt_tokens = len(prompt) // 4
+        message = AIMessage(
+            content=self._content(prompt),
+            usage_metadata={
+                "input_tokens": prompt_tokens,
+                "output_tokens": self.output_tokens,
+                "total_tokens": prompt_tokens + self.output_tokens
+            }
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return self._result(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return self._result(messages)
+
+
+def rss_mb() -> Optional[float]:
+    """Resident set size of this process, where the platform exposes it"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    values = np.asarray(samples, dtype=float)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "count": int(values.size),
+        "mean": round(float(values.mean()), 6),
+        "p50": round(float(p50), 6),
+        "p95": round(float(p95), 6),
+        "p99": round(float(p99), 6),
+        "max": round(float(values.max()), 6)
+    }
+
+
+def summarize_timings(timings: List[Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    stages = sorted({key for t in timings for key in t})
+    return {stage: summarize([t[stage] for t in timings if stage in t]) for stage in stages}
+
+
+def sample_queries(csv_path: str, n: int, seed: int) -> List[str]:
+    """Free-text descriptions drawn from the training cases"""
+    symptoms, _, _ = load_case_table(csv_path)
+    rows = symptoms.to_numpy(dtype=bool)
+    names = [s.replace("_", " ") for s in symptoms.columns]
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(n):
+        present = [names[j] for j in np.flatnonzero(rows[rng.randrange(len(rows))])]
+        queries.append("I have " + ", ".join(present))
+    return queries
+
+
+# 2. Measurements
+def benchmark_index(csv_path: str, embeddings, model_name: str) -> Dict[str, Any]:
+    """Cold build and snapshot reload of the FAISS index"""
+    with tempfile.TemporaryDirectory() as tmp:
+        # A path inside the temporary directory: the snapshot swap turns it into a symlink
+        index_dir = os.path.join(tmp, "index")
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        vectorstore = load_or_build_vectorstore(csv_path, embeddings, index_dir=index_dir, model_name=model_name)
+        build_seconds = time.perf_counter() - start
+        rss_after = rss_mb()
+
+        start = time.perf_counter()
+        load_or_build_vectorstore(csv_path, embeddings, index_dir=index_dir, model_name=model_name)
+        load_seconds = time.perf_counter() - start
+
+    return {
+        "vectors": int(vectorstore.index.ntotal),
+        "dimension": int(vectorstore.index.d),
+        "build_seconds": round(build_seconds, 6),
+        "snapshot_load_seconds": round(load_seconds, 6),
+        "index_bytes": len(faiss.serialize_index(vectorstore.index)),
+        "rss_growth_mb": round(rss_after - rss_before, 2) if rss_before is not None else None,
+        "vectorstore": vectorstore
+    }
+
+
+async def run_load(queries: List[str], concurrency: int, request) -> Dict[str, Any]:
+    """Send every query through `request` with bounded concurrency"""
+    limit = asyncio.Semaphore(max(1, concurrency))
+    latencies, timings, errors = [], [], 0
+
+    async def one(text: str):
+        nonlocal errors
+        async with limit:
+            start = time.perf_counter()
+            try:
+                timings.append(await request(text))
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(text) for text in queries))
+    wall = time.perf_counter() - start
+    return {
+        "requests": len(queries),
+        "errors": errors,
+        "wall_seconds": round(wall, 6),
+        "throughput_rps": round(len(latencies) / wall, 3) if wall else None,
+        "end_to_end": summarize(latencies) if latencies else None,
+        "stages": summarize_timings([t for t in timings if t])
+    }
+
+
+async def benchmark_chain(chain, queries: List[str], concurrency: int, mode: str,
+                          backend: Optional[str]) -> Dict[str, Any]:
+    async def request(text: str) -> Dict[str, float]:
+        state = make_initial_state(SymptomInput(text=text, mode=mode, retrieval_backend=backend))
+        with collect_timings() as timings:
+            await chain.ainvoke(state)
+        return timings
+
+    return await run_load(queries, concurrency, request)
+
+
+async def benchmark_app(chain, queries: List[str], concurrency: int, mode: str,
+                        backend: Optional[str]) -> Dict[str, Any]:
+    app = create_app(lambda: chain)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        async with app.router.lifespan_context(app):
+            # Startup is done once /ready reports the warm-up task finished
+            start = time.perf_counter()
+            while (await client.get("/ready")).status_code != 200:
+                if app.state.chain_task.done() and app.state.chain_task.exception():
+                    raise app.state.chain_task.exception()
+                await asyncio.sleep(0.01)
+            startup = time.perf_counter() - start
+
+            async def request(text: str) -> Dict[str, float]:
+                response = await client.post("/diagnose", json={
+                    "text": text, "mode": mode, "retrieval_backend": backend, "include_timings": True
+                })
+                response.raise_for_status()
+                return response.json()["timings"]
+
+            result = await run_load(queries, concurrency, request)
+    result["startup_seconds"] = round(startup, 6)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the diagnosis pipeline offline")
+    parser.add_argument("--csv", default=settings.data_path, help="Training CSV for the index and queries")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--mode", choices=["full", "rank_only", "single_shot"], default="full")
+    parser.add_argument("--backend", choices=["faiss", "matrix"], default=None, help="Retrieval backend")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Seconds per fake LLM call")
+    parser.add_argument("--llm-tokens", type=int, default=64, help="Tokens per fake LLM answer")
+    parser.add_argument("--embedding-size", type=int, default=384, help="Dimension of the fake embeddings")
+    parser.add_argument("--embedding-model", default=None,
+                        help="Use this local HuggingFace model instead of fake embeddings")
+    parser.add_argument("--skip-app", action="store_true", help="Only benchmark the graph, not the HTTP app")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    if args.embedding_model:
+        embeddings, model_name = build_embeddings(args.embedding_model), args.embedding_model
+    else:
+        embeddings = DeterministicFakeEmbedding(size=args.embedding_size)
+        model_name = f"fake-{args.embedding_size}"
+    queries = sample_queries(args.csv, args.requests, args.seed)
+
+    # Index first, so its memory growth isn't mixed up with the rest of start-up
+    index = benchmark_index(args.csv, embeddings, model_name)
+    vectorstore = index.pop("vectorstore")
+    k = settings.retrieval_k * max(1, settings.retrieval_overfetch)
+
+    start = time.perf_counter()
+    resources = DiagnosisResources(
+        llm=FakeChatModel(latency=args.llm_latency, output_tokens=args.llm_tokens),
+        retriever=vectorstore.as_retriever(search_kwargs={"k": k}),
+        symptom_matrix=SymptomMatrixRetriever.from_csv(args.csv)
+    )
+    resources.warm_up()
+    chain = build_diagnosis_chain(mode=args.mode, resources=resources)
+    startup = time.perf_counter() - start
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "startup_seconds": round(startup, 6),
+        "index": index,
+        "chain": asyncio.run(benchmark_chain(chain, queries, args.concurrency, args.mode, args.backend))
+    }
+    if not args.skip_app:
+        results["app"] = asyncio.run(benchmark_app(chain, queries, args.concurrency, args.mode, args.backend))
+    results["rss_mb"] = rss_mb()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    for target in ("chain", "app"):
+        if target in results and results[target]["end_to_end"]:
+            e2e = results[target]["end_to_end"]
+            print(f"{target}: {results[target]['throughput_rps']} req/s, "
+                  f"p50 {e2e['p50'] * 1000:.1f} ms, p95 {e2e['p95'] * 1000:.1f} ms, p99 {e2e['p99'] * 1000:.1f} ms")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,114 @@
+from typing import Optional
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
-    groq_api_key: str
+    # Only needed by the LLM agents; left optional so the index can be prebuilt without it
+    groq_api_key: str = ""
     embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2"
+    # Level of the API's own log messages (warnings about fallbacks, index maintenance)
+    log_level: str = "INFO"
     llm_model: str = "llama3-8b-8192"
+    # Alternative API endpoint for the LLM, e.g. a local fake server (python fake_llm_endpoint.py)
+    llm_base_url: Optional[str] = None
+    data_path: str = "/app/data/new_train_set.csv"
+    index_dir: str = "/app/data/index"
+    # Open the persisted index and case metadata read-only via mmap, so uvicorn workers share one copy
+    index_mmap: bool = True
+    # FAISS index layout: "flat" (exact), "ivf", "hnsw", "pq" or "ivfpq" (compressed). Build parameters
+    # (index_nlist, 0 for about 4*sqrt(cases); index_hnsw_m; index_ef_construction; index_pq_m sub-quantizers
+    # of index_pq_bits bits) rebuild the snapshot when changed; index_nprobe and index_ef_search only
+    # trade recall for latency at query time (compare settings with `python index_benchmark.py`)
+    index_type: str = "flat"
+    index_nlist: int = 0
+    index_nprobe: int = 8
+    index_hnsw_m: int = 32
+    index_ef_construction: int = 80
+    index_ef_search: int = 64
+    index_pq_m: int = 16
+    index_pq_bits: int = 8
+    # Cases ingested at runtime (POST /cases, ingest_cases.py) are logged here until compacted into
+    # the snapshot; empty disables ingestion. Both retrieval backends serve them (the matrix one when
+    # it is read from the snapshot, i.e. with index_mmap). Workers pick up each other's cases every
+    # `index_sync_interval` seconds, and the log is compacted every `compaction_interval`
+    # seconds once it holds at least `compaction_min_cases` cases
+    delta_dir: str = "/app/data/index-delta"
+    index_sync_interval: float = 10.0
+    compaction_interval: float = 300.0
+    compaction_min_cases: int = 100
+    ingest_max_cases: int = 10000
+    # Worker processes when started with `python app.py`
+    workers: int = 1
+    # "faiss" (embedding search over case documents) or "matrix" (exact symptom-vector scoring)
+    retrieval_backend: str = "faiss"
+    # Number of distinct diseases returned, and how many cases to fetch per disease before collapsing duplicates
+    retrieval_k: int = 4
+    retrieval_overfetch: int = 5
+    # Similarity used by the matrix backend: "idf", "jaccard" or "overlap"
+    matrix_metric: str = "idf"
+    # Candidates are reranked by rerank_similarity_weight * retrieval similarity plus the rest times
+    # symptom overlap; that blend is the confidence shown. Before any explanation is written, candidates
+    # below min_confidence (0-100) are dropped, as are those past the point where the blend's softmax
+    # (at rerank_temperature) adds up to cumulative_probability_cutoff. The top candidate is always kept
+    rerank_similarity_weight: float = 0.5
+    rerank_temperature: float = 0.1
+    # How much a ruled-out symptom (answered "no") counts against the cases that have it: the matrix
+    # backend scores it as -ruled_out_penalty, and reranking takes ruled_out_penalty times the share
+    # of the case's symptoms that were ruled out off the blend
+    ruled_out_penalty: float = 0.5
+    min_confidence: float = 0.0
+    cumulative_probability_cutoff: float = 1.0
+    # Match free text against the dataset's symptom lexicon first, and fall back to the LLM
+    # when fewer than this share of the descriptive words were recognised
+    use_symptom_lexicon: bool = True
+    lexicon_min_coverage: float = 0.5
+    # Upper bound on concurrent per-candidate explanation calls
+    explanation_concurrency: int = 4
+    # Per-request budget for /diagnose in seconds, and how often to check for a dropped client
+    diagnosis_timeout: float = 120.0
+    disconnect_poll_interval: float = 0.5
+    # /diagnose/batch: LLM calls in flight per batch, max items per request, time budget in seconds
+    batch_max_concurrency: int = 8
+    batch_max_items: int = 256
+    batch_timeout: float = 900.0
+    # Query-embedding cache in front of the FAISS retriever: max entries (0 disables) and memory cap
+    query_cache_size: int = 4096
+    query_cache_max_mb: float = 64.0
+    # LLM response cache: max entries (0 disables) and time-to-live in seconds
+    llm_cache_size: int = 1024
+    llm_cache_ttl: Optional[float] = 3600.0
+    # SQLite file behind the in-memory LLM cache, shared by workers and kept across restarts (None: memory only)
+    llm_cache_path: Optional[str] = None
+    # LLM scheduler shared by every agent: calls in flight, provider rate limits (0 disables),
+    # pooled HTTP connections, retries of transient failures, per-call deadline in seconds and
+    # how long to wait before sending a duplicate of a slow call (unset disables hedging).
+    # The rate limits are for the whole deployment and split evenly between `workers`, so set
+    # WORKERS to the real worker count also when starting several with `uvicorn --workers`
+    llm_max_concurrency: int = 16
+    llm_requests_per_minute: float = 30
+    llm_tokens_per_minute: float = 30000
+    llm_output_token_estimate: int = 512
+    llm_max_connections: int = 32
+    llm_max_retries: int = 4
+    llm_retry_base_delay: float = 0.5
+    llm_retry_max_delay: float = 20.0
+    llm_call_timeout: float = 30.0
+    llm_hedge_after: Optional[float] = None
+    # How long clients may reuse the /symptoms catalogue before revalidating, in seconds
+    symptoms_max_age: int = 3600
+    # Multi-turn sessions (/sessions): where their graph state is checkpointed, "memory" or "sqlite"
+    # (kept in session_db_path), and how long, in seconds,
+    # an idle session is kept. With more than one worker sessions must be in sqlite, which every
+    # worker opens; with the memory store they are disabled (503) rather than split between workers
+    session_store: str = "memory"
+    session_db_path: str = "/app/data/sessions.sqlite"
+    session_ttl: float = 3600.0
+    # Concurrent identical /diagnose requests share one pipeline run; finished results can
+    # also be reused for this many seconds (0 only coalesces requests that overlap)
+    coalesce_requests: bool = True
+    coalesce_hold_seconds: float = 0.0
+    coalesce_max_held: int = 1024
     
     class Config:
         env_file = ".env"
 
-settings = Settings()
\ No newline at end of file
+settings = Settings()
@@ -0,0 +1,118 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from metrics import timed
+
+
+def embed_queries(embeddings, texts: List[str]) -> List[List[float]]:
+    """Embed many queries in one forward pass where the model allows it"""
+    if hasattr(embeddings, "embed_queries"):
+        return embeddings.embed_queries(texts)
+    query_instruction = getattr(embeddings, "query_instruction", "")
+    if getattr(embeddings, "embed_instruction", ""):
+        # Documents get their own prefix, so embed_documents can't stand in for embed_query
+        return [embeddings.embed_query(text) for text in texts]
+    return embeddings.embed_documents([query_instruction + text for text in texts])
+
+
+def canonical_query(text: str) -> str:
+    """Sorted, de-duplicated symptom list, so the same set always maps to the same query"""
+    parts = sorted({part.strip().lower() for part in text.split(",") if part.strip()})
+    return ", ".join(parts)
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """LRU cache of query vectors in front of an embedding model
+
+    Queries are symptom lists, so they are keyed (and embedded) in canonical
+    form. Vectors are kept (and returned) as read-only float32 arrays, the
+    dtype FAISS searches with, and the cache is bounded both by entry count
+    and by their bytes. Document embedding is passed straight through.
+    """
+
+    def __init__(self, inner: Embeddings, max_entries: int = 4096, max_bytes: int = 64 * 1024 * 1024):
+        self.inner = inner
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._vectors: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, name: str) -> Any:
+        # Expose the wrapped model's attributes (query_instruction, model_name, ...)
+        if name == "inner":
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[np.ndarray]:
+        """Cached vectors for `texts`; all misses are embedded together in a single batch"""
+        keys = [canonical_query(text) for text in texts]
+        found = {key: vector for key in set(keys) if (vector := self._get(key)) is not None}
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing:
+            with timed("embedding", "query_batch" if len(missing) > 1 else "query"):
+                vectors = embed_queries(self.inner, missing)
+            for key, vector in zip(missing, vectors):
+                found[key] = self._put(key, vector)
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> np.ndarray:
+        key = canonical_query(text)
+        vector = self._get(key)
+        if vector is None:
+            with timed("embedding", "query"):
+                vector = self._put(key, await self.inner.aembed_query(key))
+        return vector
+
+    def _get(self, key: str):
+        with self._lock:
+            vector = self._vectors.get(key)
+            if vector is None:
+                self.misses += 1
+            else:
+                self._vectors.move_to_end(key)
+                self.hits += 1
+            return vector
+
+    def _put(self, key: str, vector: Sequence[float]) -> np.ndarray:
+        vector = np.array(vector, dtype=np.float32)
+        # Shared by every caller that hits the entry, so nobody may change it
+        vector.flags.writeable = False
+        if self.max_entries <= 0:
+            return vector
+        with self._lock:
+            if key in self._vectors:
+                return self._vectors[key]
+            self._vectors[key] = vector
+            self._bytes += vector.nbytes
+            while self._vectors and (len(self._vectors) > self.max_entries or self._bytes > self.max_bytes):
+                _, old = self._vectors.popitem(last=False)
+                self._bytes -= old.nbytes
+                self.evictions += 1
+        return vector
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, size = len(self._vectors), self._bytes
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
@@ -1,76 +1,234 @@
 import pandas as pd
 from typing import List, Dict
 from sklearn.metrics import accuracy_score, recall_score, precision_score, f1_score
-from sklearn.metrics import confusion_matrix
+from sklearn.metrics import confusion_matrix, classification_report
 from tqdm import tqdm
 #import seaborn as sns
 #import matplotlib.pyplot as plt
 import os
-from agents import diagnosis_chain
+import json
+import asyncio
+from typing import Optional
+from agents import get_diagnosis_chain, make_initial_state, prime_query_embeddings
+from llm_scheduler import llm_priority
+from config import settings
+from knowledge_base import dataset_fingerprint, load_symptom_table, read_snapshot_meta
+from live_index import DeltaLog
+from models import SymptomInput
 
 class MedicalDiagnosisEvaluator:
-    def __init__(self, test_data_path: str= str("D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\new_test_set.csv")):
-        self.test_df = pd.read_csv(test_data_path)
-        self.symptom_columns = [col for col in self.test_df.columns if col != 'prognosis']
-        
+    def __init__(self, test_data_path: str= str("D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\new_test_set.csv"),
+                 retrieval_backend: Optional[str] = None, workers: int = 4,
+                 checkpoint_path: Optional[str] = None, mode: str = "rank_only"):
+        # Read like the training data: canonical symptom names (the raw headers have stray spaces
+        # and `.1` duplicates) and stripped labels ('Diabetes ' -> 'Diabetes'), or cases always miss
+        self.test_symptoms, self.test_prognosis = load_symptom_table(test_data_path)
+        # "matrix" scores the test vectors exactly instead of embedding them
+        self.retrieval_backend = retrieval_backend
+        # Only the top-ranked disease is scored, so by default skip the explanation/report LLM calls
+        self.mode = mode
+        # Number of test cases diagnosed concurrently
+        self.workers = workers
+        # JSONL file of finished predictions; a rerun only diagnoses the cases missing from it
+        self.checkpoint_path = checkpoint_path
+        self.symptom_columns = list(self.test_symptoms.columns)
+        # Predictions per sample size, valid as long as the checkpoint header they were made under
+        self._predictions: Dict[Optional[int], pd.DataFrame] = {}
+        self._predictions_header: Optional[Dict] = None
+
     def prepare_test_cases(self) -> List[Dict]:
         test_cases = []
-        for _, row in self.test_df.iterrows():
-            symptoms = {col: bool(row[col]) for col in self.symptom_columns}
+        for case_id, (row, prognosis) in enumerate(zip(self.test_symptoms.to_numpy(), self.test_prognosis)):
+            symptoms = {col: bool(value) for col, value in zip(self.symptom_columns, row)}
             test_cases.append({
+                'case_id': case_id,
                 'symptoms': symptoms,
-                'true_diagnosis': row['prognosis']
+                'true_diagnosis': prognosis
             })
         return test_cases
-    
-    def run_diagnosis(self, symptoms: Dict[str, bool]) -> Dict:
+
+    def make_state(self, symptoms: Dict[str, bool]) -> Dict:
         symptom_text = "I have " + ", ".join([s for s, present in symptoms.items() if present])
-        initial_state = {
-            "input": symptom_text,
-            "structured_symptoms": symptoms,
-            "retrieved_diseases": [],
-            "predictions": [],
-            "report": ""
+        return make_initial_state(SymptomInput(
+            text=symptom_text,
+            structured=symptoms,
+            retrieval_backend=self.retrieval_backend,
+            mode=self.mode
+        ))
+
+    async def run_diagnosis(self, symptoms: Dict[str, bool]) -> Dict:
+        return await get_diagnosis_chain(self.mode).ainvoke(self.make_state(symptoms))
+
+    def checkpoint_header(self) -> Dict:
+        """Everything that decides the top-ranked disease; a checkpoint is only reused when it matches"""
+        return {
+            'mode': self.mode,
+            'retrieval_backend': self.retrieval_backend or settings.retrieval_backend,
+            'embedding_model': settings.embedding_model,
+            # The fingerprint a current snapshot of the training data has, plus ingested cases folded into it
+            'index_fingerprint': dataset_fingerprint(settings.data_path, settings.embedding_model),
+            'compacted_through': read_snapshot_meta(settings.index_dir).get('compacted_through', 0),
+            # Cases ingested since, which the live index already serves
+            'ingested_through': DeltaLog(settings.delta_dir).end() if settings.delta_dir else 0,
+            'matrix_metric': settings.matrix_metric,
+            'retrieval_overfetch': settings.retrieval_overfetch,
+            'rerank_similarity_weight': settings.rerank_similarity_weight
         }
-        return diagnosis_chain.invoke(initial_state)
-    
-    def evaluate(self, sample_size: int = None) -> Dict[str, float]:
+
+    def load_checkpoint(self, test_cases: List[Dict], header: Dict) -> Optional[Dict[int, str]]:
+        """Predictions already on disk, ignoring rows that no longer match the test set
+
+        Returns None when there is no checkpoint for this configuration, i.e. the
+        file is missing or was written by a run with a different header.
+        """
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return None
+        expected = {case['case_id']: case['true_diagnosis'] for case in test_cases}
+        done = {}
+        with open(self.checkpoint_path) as f:
+            try:
+                saved = json.loads(f.readline()).get('header')
+            except (ValueError, AttributeError):
+                saved = None
+            if saved != header:
+                print(f"Checkpoint {self.checkpoint_path} was written with a different configuration; starting over")
+                return None
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Half-written last line from an interrupted run
+                    continue
+                if expected.get(record.get('case_id')) == record.get('true_diagnosis'):
+                    done[record['case_id']] = record['predicted_diagnosis']
+        return done
+
+    async def _predict_cases(self, test_cases: List[Dict], checkpoint) -> Dict[int, str]:
+        chain = get_diagnosis_chain(self.mode)
+        if (self.retrieval_backend or settings.retrieval_backend) == "faiss":
+            # One batched forward pass for every test query instead of one per case
+            await asyncio.to_thread(prime_query_embeddings, chain.resources, [c['symptoms'] for c in test_cases])
+        limit = asyncio.Semaphore(max(1, self.workers))
+        predictions = {}
+        failures = 0
+
+        async def predict(case):
+            nonlocal failures
+            async with limit:
+                try:
+                    result = await self.run_diagnosis(case['symptoms'])
+                except Exception as e:
+                    # Left out of the checkpoint so the next run retries it
+                    failures += 1
+                    tqdm.write(f"Case {case['case_id']} failed: {e}")
+                    return
+            pred_diagnosis = result['predictions'][0].disease if result['predictions'] else "Unknown"
+            predictions[case['case_id']] = pred_diagnosis
+            if checkpoint is not None:
+                checkpoint.write(json.dumps({
+                    'case_id': case['case_id'],
+                    'true_diagnosis': case['true_diagnosis'],
+                    'predicted_diagnosis': pred_diagnosis
+                }) + "\n")
+                checkpoint.flush()
+            progress.update(1)
+
+        # Evaluation LLM calls (full mode) queue behind interactive and batch traffic
+        with tqdm(total=len(test_cases), desc="Evaluating cases") as progress, llm_priority("evaluation"):
+            await asyncio.gather(*(predict(case) for case in test_cases))
+        if failures:
+            print(f"{failures} case(s) failed; run again to resume from the checkpoint")
+        return predictions
+
+    def predict(self, sample_size: int = None) -> pd.DataFrame:
+        """Diagnose every test case once (resuming from the checkpoint) and return true vs predicted labels"""
+        return asyncio.run(self.apredict(sample_size))
+
+    async def apredict(self, sample_size: int = None) -> pd.DataFrame:
+        """predict() on the running event loop, whose LLM client the diagnosis chain shares"""
+        # Hashes the training data
+        header = await asyncio.to_thread(self.checkpoint_header)
+        if header != self._predictions_header:
+            # Cases were ingested, the index was rebuilt or the settings changed since the last run
+            self._predictions, self._predictions_header = {}, header
+        if sample_size in self._predictions:
+            return self._predictions[sample_size]
+
         test_cases = self.prepare_test_cases()
         if sample_size:
             test_cases = test_cases[:sample_size]
-            
-        y_true = []
-        y_pred = []
-        
-        for case in tqdm(test_cases, desc="Evaluating cases"):
-            result = self.run_diagnosis(case['symptoms'])
-            pred_diagnosis = result['predictions'][0].disease if result['predictions'] else "Unknown"
-            y_true.append(case['true_diagnosis'])
-            y_pred.append(pred_diagnosis)
-        
+
+        done = self.load_checkpoint(test_cases, header)
+        fresh = done is None
+        done = done or {}
+        pending = [case for case in test_cases if case['case_id'] not in done]
+        if pending:
+            checkpoint = None
+            if self.checkpoint_path:
+                checkpoint = open(self.checkpoint_path, "w" if fresh else "a")
+                if fresh:
+                    checkpoint.write(json.dumps({'header': header}) + "\n")
+            try:
+                done.update(await self._predict_cases(pending, checkpoint))
+            finally:
+                if checkpoint is not None:
+                    checkpoint.close()
+
+        predictions = pd.DataFrame([
+            {
+                'case_id': case['case_id'],
+                'true_diagnosis': case['true_diagnosis'],
+                'predicted_diagnosis': done[case['case_id']]
+            }
+            for case in test_cases if case['case_id'] in done
+        ], columns=['case_id', 'true_diagnosis', 'predicted_diagnosis'])
+        self._predictions[sample_size] = predictions
+        return predictions
+
+    def evaluate(self, sample_size: int = None) -> Dict[str, float]:
+        return self.metrics(self.predict(sample_size))
+
+    async def aevaluate(self, sample_size: int = None) -> Dict[str, float]:
+        return self.metrics(await self.apredict(sample_size))
+
+    @staticmethod
+    def metrics(predictions: pd.DataFrame) -> Dict[str, float]:
+        y_true = predictions['true_diagnosis']
+        y_pred = predictions['predicted_diagnosis']
+
         return {
             'accuracy': accuracy_score(y_true, y_pred),
             'recall': recall_score(y_true, y_pred, average='weighted', zero_division=0),
             'precision': precision_score(y_true, y_pred, average='weighted', zero_division=0),
             'f1': f1_score(y_true, y_pred, average='weighted', zero_division=0)
         }
-    
-    def save_confusion_matrix(self, output_path: str = "D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\confusion_matrix.csv"):
-        test_cases = self.prepare_test_cases()
-        y_true = []
-        y_pred = []
-        
-        for case in tqdm(test_cases, desc="Generating confusion matrix"):
-            result = self.run_diagnosis(case['symptoms'])
-            pred_diagnosis = result['predictions'][0].disease if result['predictions'] else "Unknown"
-            y_true.append(case['true_diagnosis'])
-            y_pred.append(pred_diagnosis)
-        
+
+    def classification_report(self, sample_size: int = None) -> pd.DataFrame:
+        """Per-class precision, recall, F1 and support"""
+        predictions = self.predict(sample_size)
+        report = classification_report(
+            predictions['true_diagnosis'], predictions['predicted_diagnosis'],
+            output_dict=True, zero_division=0
+        )
+        return pd.DataFrame(report).T
+
+    def save_confusion_matrix(self, output_path: str = "D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\confusion_matrix.csv",
+                              sample_size: int = None):
+        return self.write_confusion_matrix(self.predict(sample_size), output_path)
+
+    async def asave_confusion_matrix(self, output_path: str, sample_size: int = None):
+        return self.write_confusion_matrix(await self.apredict(sample_size), output_path)
+
+    @staticmethod
+    def write_confusion_matrix(predictions: pd.DataFrame, output_path: str) -> pd.DataFrame:
+        y_true = list(predictions['true_diagnosis'])
+        y_pred = list(predictions['predicted_diagnosis'])
+
         classes = sorted(set(y_true + y_pred))
         cm = confusion_matrix(y_true, y_pred, labels=classes)
         cm_df = pd.DataFrame(cm, index=classes, columns=classes)
         cm_df.to_csv(output_path)
-        
+
         # plt.figure(figsize=(12, 10))
         # #sns.heatmap(cm_df, annot=True, fmt='d', cmap='Blues')
         # plt.title('Confusion Matrix')
@@ -79,5 +237,5 @@ class MedicalDiagnosisEvaluator:
         # plt.tight_layout()
         # plt.savefig("D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\confusion_matrix.png")
         # plt.close()
-        
-        return cm_df
\ No newline at end of file
+
+        return cm_df
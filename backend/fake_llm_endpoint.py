@@ -0,0 +1,82 @@
+"""Local stand-in for the Groq chat completions API
+
+Answers with filler text after a fixed latency and fails a share of requests
+with 429s, so rate limiting, retries and hedging can be exercised offline:
+
+    python fake_llm_endpoint.py --port 8100 --latency 0.2 --error-rate 0.1
+    LLM_BASE_URL=http://127.0.0.1:8100 GROQ_API_KEY=fake uvicorn app:app
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def create_fake_llm_app(latency: float = 0.2, tokens: int = 64, error_rate: float = 0.0,
+                        seed: int = 0) -> FastAPI:
+    app = FastAPI(title="Fake LLM endpoint")
+    rng = random.Random(seed)
+    app.state.requests = 0
+
+    @app.post("/openai/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        if rng.random() < error_rate:
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached", "type": "tokens", "code": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after": "0.1"}
+            )
+
+        await asyncio.sleep(latency)
+        model = body.get("model", "fake")
+        words = ["lorem"] * tokens
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": tokens,
+                 "total_tokens": prompt_tokens + tokens}
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "created": int(time.time()), "model": model}
+
+        if not body.get("stream"):
+            return {**base, "object": "chat.completion", "usage": usage, "choices": [{
+                "index": 0, "finish_reason": "stop", "logprobs": None,
+                "message": {"role": "assistant", "content": " ".join(words)}
+            }]}
+
+        async def chunks():
+            for i, word in enumerate(words):
+                delta = {"role": "assistant", "content": word if i == 0 else " " + word}
+                yield "data: " + json.dumps({**base, "object": "chat.completion.chunk", "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": None, "logprobs": None}
+                ]}) + "\n\n"
+            yield "data: " + json.dumps({**base, "object": "chat.completion.chunk", "x_groq": {"usage": usage},
+                                         "choices": [{"index": 0, "delta": {}, "finish_reason": "stop",
+                                                      "logprobs": None}]}) + "\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Groq-compatible chat completions API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before each answer")
+    parser.add_argument("--tokens", type=int, default=64, help="Words per answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    uvicorn.run(create_fake_llm_app(args.latency, args.tokens, args.error_rate, args.seed),
+                host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
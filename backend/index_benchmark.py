@@ -0,0 +1,175 @@
+"""Recall/latency trade-offs of the FAISS index types
+
+Builds every requested index type over the same vectors and compares its
+answers with the exact flat index, for each search setting:
+
+    python index_benchmark.py --types flat,ivf,hnsw,pq,ivfpq --k 10
+    python index_benchmark.py --synthetic 1000000 --dimension 384 --nprobe 1,8,32 --ef-search 16,64,256
+
+The case corpus is embedded with deterministic fake embeddings unless
+--embedding-model is given; --synthetic replaces it with clustered random
+vectors, to see how an index type behaves at a corpus size we don't have yet.
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+import faiss
+import numpy as np
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from benchmark import rss_mb, sample_queries, summarize
+from config import settings
+from embedding_cache import embed_queries
+from knowledge_base import (INDEX_TYPES, build_embeddings, build_faiss_index, create_medical_documents,
+                            index_build_params, index_factory_string, set_search_params)
+
+
+# 1. Vectors
+def corpus_vectors(csv_path: str, embeddings, n_queries: int, seed: int):
+    """Case document vectors and query vectors for descriptions drawn from the same cases"""
+    documents = create_medical_documents(csv_path)
+    corpus = embeddings.embed_documents([doc.page_content for doc in documents])
+    queries = embed_queries(embeddings, sample_queries(csv_path, n_queries, seed))
+    return np.asarray(corpus, dtype=np.float32), np.asarray(queries, dtype=np.float32)
+
+
+def synthetic_vectors(n: int, d: int, n_queries: int, seed: int):
+    """Gaussian clusters, with queries near random corpus points"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, int(np.sqrt(n))), d)).astype(np.float32)
+    corpus = centers[rng.integers(len(centers), size=n)] + 0.3 * rng.normal(size=(n, d)).astype(np.float32)
+    queries = corpus[rng.integers(n, size=n_queries)] + 0.1 * rng.normal(size=(n_queries, d)).astype(np.float32)
+    return corpus.astype(np.float32), queries.astype(np.float32)
+
+
+# 2. Measurements
+def recall_at_k(found: np.ndarray, exact: np.ndarray) -> float:
+    """Share of the exact top-k neighbours the index returned, averaged over queries"""
+    hits = [len(set(row[row != -1]) & set(truth[truth != -1])) / max(1, (truth != -1).sum())
+            for row, truth in zip(found, exact)]
+    return float(np.mean(hits))
+
+
+def search_settings(index_type: str, nprobe: List[int], ef_search: List[int]) -> List[Dict[str, int]]:
+    if index_type in ("ivf", "ivfpq"):
+        return [{"nprobe": value} for value in nprobe]
+    if index_type == "hnsw":
+        return [{"ef_search": value} for value in ef_search]
+    return [{}]
+
+
+def measure_search(index: faiss.Index, queries: np.ndarray, k: int, exact: np.ndarray) -> Dict[str, Any]:
+    # One query at a time, as the API issues them
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    batch_seconds = time.perf_counter() - start
+    return {
+        f"recall@{k}": round(recall_at_k(found, exact), 4),
+        "latency": summarize(latencies),
+        "batch_qps": round(len(queries) / batch_seconds, 1) if batch_seconds else None
+    }
+
+
+def benchmark_type(index_type: str, corpus: np.ndarray, queries: np.ndarray, k: int, exact: np.ndarray,
+                   nprobe: List[int], ef_search: List[int], overrides: Dict) -> Dict[str, Any]:
+    params = index_build_params(index_type, **overrides)
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    index = build_faiss_index(corpus, params)
+    build_seconds = time.perf_counter() - start
+    rss_after = rss_mb()
+
+    runs = []
+    for search in search_settings(index_type, nprobe, ef_search):
+        set_search_params(index, **search)
+        runs.append({**search, **measure_search(index, queries, k, exact)})
+    return {
+        "index_type": index_type,
+        "factory": index_factory_string(*corpus.shape, params),
+        "build_params": params,
+        "build_seconds": round(build_seconds, 6),
+        "index_bytes": len(faiss.serialize_index(index)),
+        "rss_growth_mb": round(rss_after - rss_before, 2) if rss_before is not None else None,
+        "search": runs
+    }
+
+
+def int_list(text: str) -> List[int]:
+    return [int(value) for value in text.split(",") if value.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare recall, latency, build time and size of FAISS index types")
+    parser.add_argument("--csv", default=settings.data_path, help="Training CSV for the corpus and queries")
+    parser.add_argument("--types", default=",".join(INDEX_TYPES), help=f"Comma-separated, from {INDEX_TYPES}")
+    parser.add_argument("--k", type=int, default=10, help="Neighbours per query for recall@k")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--nprobe", type=int_list, default=[settings.index_nprobe], help="IVF lists to visit")
+    parser.add_argument("--ef-search", type=int_list, default=[settings.index_ef_search], help="HNSW search depth")
+    parser.add_argument("--nlist", type=int, default=None, help="IVF lists (0 for about 4*sqrt(n))")
+    parser.add_argument("--hnsw-m", type=int, default=None)
+    parser.add_argument("--pq-m", type=int, default=None, help="PQ sub-quantizers")
+    parser.add_argument("--pq-bits", type=int, default=None, help="Bits per PQ code")
+    parser.add_argument("--synthetic", type=int, default=0, help="Use this many random vectors instead of the CSV")
+    parser.add_argument("--dimension", type=int, default=384, help="Dimension of fake or synthetic vectors")
+    parser.add_argument("--embedding-model", default=None, help="Embed the corpus with this local model")
+    parser.add_argument("--threads", type=int, default=None, help="FAISS OpenMP threads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="index_benchmark.json")
+    args = parser.parse_args()
+
+    types = [t.strip() for t in args.types.split(",") if t.strip()]
+    unknown = sorted(set(types) - set(INDEX_TYPES))
+    if unknown:
+        parser.error(f"Unknown index types {unknown}, expected some of {INDEX_TYPES}")
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+
+    if args.synthetic:
+        corpus, queries = synthetic_vectors(args.synthetic, args.dimension, args.queries, args.seed)
+    else:
+        embeddings = (build_embeddings(args.embedding_model) if args.embedding_model
+                      else DeterministicFakeEmbedding(size=args.dimension))
+        corpus, queries = corpus_vectors(args.csv, embeddings, args.queries, args.seed)
+    k = min(args.k, len(corpus))
+
+    # Ground truth from an exact search
+    exact_index = faiss.IndexFlatL2(corpus.shape[1])
+    exact_index.add(corpus)
+    _, exact = exact_index.search(queries, k)
+    del exact_index
+
+    overrides = {"nlist": args.nlist, "hnsw_m": args.hnsw_m, "pq_m": args.pq_m, "pq_bits": args.pq_bits}
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "vectors": int(corpus.shape[0]),
+        "dimension": int(corpus.shape[1]),
+        "raw_vector_bytes": int(corpus.nbytes),
+        "indexes": [benchmark_type(index_type, corpus, queries, k, exact, args.nprobe, args.ef_search, overrides)
+                    for index_type in types]
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{results['vectors']} vectors of dimension {results['dimension']}, recall@{k} against exact search")
+    for entry in results["indexes"]:
+        for run in entry["search"]:
+            setting = ", ".join(f"{key}={value}" for key, value in run.items() if key in ("nprobe", "ef_search"))
+            print(f"{entry['factory']:<16} {setting:<14} recall {run[f'recall@{k}']:.3f}  "
+                  f"p50 {run['latency']['p50'] * 1000:.3f} ms  p99 {run['latency']['p99'] * 1000:.3f} ms  "
+                  f"build {entry['build_seconds']:.2f} s  size {entry['index_bytes'] / 2 ** 20:.1f} MiB")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
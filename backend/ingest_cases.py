@@ -0,0 +1,44 @@
+"""Add labelled cases to the live index without rebuilding it
+
+    python ingest_cases.py --csv new_cases.csv
+    python ingest_cases.py --symptoms "itching, skin rash" --prognosis "Fungal infection"
+    python ingest_cases.py --compact
+
+Cases are appended to the ingestion log in DELTA_DIR, where running API
+workers pick them up within INDEX_SYNC_INTERVAL seconds; --compact folds the
+log into the index snapshot straight away.
+"""
+import argparse
+
+from config import settings
+from live_index import cases_from_csv, open_live_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest new cases into the live FAISS index")
+    parser.add_argument("--csv", help="Cases in the training set's layout (0/1 symptom columns plus prognosis)")
+    parser.add_argument("--symptoms", help="Comma-separated symptoms of a single case")
+    parser.add_argument("--prognosis", help="Diagnosis of the single case")
+    parser.add_argument("--compact", action="store_true", help="Compact the ingestion log into the snapshot")
+    parser.add_argument("--data-path", default=settings.data_path, help="Training CSV the snapshot is built from")
+    args = parser.parse_args()
+
+    if not settings.delta_dir:
+        parser.error("Ingestion is disabled; set DELTA_DIR")
+    if bool(args.symptoms) != bool(args.prognosis):
+        parser.error("--symptoms and --prognosis go together")
+    if not (args.csv or args.symptoms or args.compact):
+        parser.error("Nothing to do: pass --csv, --symptoms/--prognosis or --compact")
+
+    index = open_live_index(args.data_path)
+    cases = cases_from_csv(args.csv) if args.csv else []
+    if args.symptoms:
+        cases.append((args.symptoms.split(","), args.prognosis))
+    if cases:
+        print(f"Ingested {index.add_cases(cases)} cases ({index.delta_size} awaiting compaction)")
+    if args.compact:
+        print(f"Compacted {index.compact()} cases into {index.index_dir} ({len(index)} cases in total)")
+
+
+if __name__ == "__main__":
+    main()
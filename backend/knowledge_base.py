@@ -0,0 +1,491 @@
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import tempfile
+import uuid
+from collections.abc import Mapping
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+import pandas as pd
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+from langchain_core.documents import Document
+from config import settings
+from embedding_cache import CachedQueryEmbeddings, embed_queries
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the document layout changes so stale snapshots are rebuilt
+INDEX_FORMAT_VERSION = 3
+INDEX_TYPES = ("flat", "ivf", "hnsw", "pq", "ivfpq")
+FINGERPRINT_FILE = "fingerprint.json"
+INDEX_FILE = "index.faiss"
+# Case metadata as flat arrays that worker processes can memory-map instead of unpickling
+CASE_SYMPTOMS_FILE = "case_symptoms.npy"
+CASE_PROGNOSIS_FILE = "case_prognosis.npy"
+CASE_SUPPORT_FILE = "case_support.npy"
+CASE_LABELS_FILE = "case_labels.json"
+
+
+# 1. Dataset schema
+def normalize_symptom_name(name: str) -> str:
+    """Canonical column form: lower case, single underscores (`spotting_ urination` -> `spotting_urination`)"""
+    return re.sub(r"[\s_]+", "_", name.strip().lower()).strip("_")
+
+
+def load_symptom_table(csv_path):
+    """Return (0/1 symptom frame with canonical column names, prognosis series)
+
+    Drops the trailing `Unnamed: N` column and folds pandas' `.1` duplicates
+    (e.g. `fluid_overload.1`) back into their original column. `csv_path` may
+    also be a seekable file object, e.g. an uploaded CSV.
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns
+    columns = [col for col in header if not col.startswith("Unnamed")]
+    rewind = getattr(csv_path, "seek", lambda offset: None)
+    rewind(0)
+    try:
+        # One byte per cell instead of int64
+        df = pd.read_csv(csv_path, usecols=columns,
+                         dtype={col: "uint8" for col in columns if col != "prognosis"})
+    except ValueError:
+        # Blank cells can't be read as uint8; treat them as "symptom absent"
+        rewind(0)
+        df = pd.read_csv(csv_path, usecols=columns)
+        df[[c for c in columns if c != "prognosis"]] = df.drop(columns="prognosis").fillna(0).astype("uint8")
+    prognosis = df.pop("prognosis").astype(str).str.strip()
+
+    # Rebuild as a single uint8 block; read_csv leaves one block per column
+    names = [normalize_symptom_name(re.sub(r"\.\d+$", "", col)) for col in df.columns]
+    symptoms = pd.DataFrame(df.to_numpy(dtype="uint8"), columns=names)
+    if symptoms.columns.duplicated().any():
+        symptoms = symptoms.T.groupby(level=0, sort=False).max().T.astype("uint8")
+    return symptoms, prognosis
+
+
+def load_case_table(csv_path: str):
+    """Like load_symptom_table, with identical (symptom set, prognosis) rows collapsed
+
+    Returns (symptom frame, prognosis series, support series) where support counts
+    how many training rows each unique case stands for.
+    """
+    symptoms, prognosis = load_symptom_table(csv_path)
+    # Identify rows by a 64-bit hash of all their cells; codes follow first appearance
+    row_hash = pd.util.hash_pandas_object(symptoms.assign(prognosis=prognosis.to_numpy()), index=False)
+    codes, _ = pd.factorize(row_hash)
+    first = np.flatnonzero(~pd.Series(codes).duplicated().to_numpy())
+    support = pd.Series(np.bincount(codes), name="support")
+    return (symptoms.iloc[first].reset_index(drop=True),
+            prognosis.iloc[first].reset_index(drop=True),
+            support)
+
+
+# 2. Custom Document Creation
+def create_medical_documents(csv_path: str) -> List[Document]:
+    """Convert each unique (symptom set, prognosis) case into a document"""
+    symptoms, prognosis, support = load_case_table(csv_path)
+
+    # "a, b, c" per row in one matrix-vector product over the column names
+    joined = symptoms.astype(bool).dot(symptoms.columns + ", ").str[:-2]
+    symptom_lists = [text.split(", ") if text else [] for text in joined]
+
+    return [
+        case_document(text, names, disease, count)
+        for text, names, disease, count in zip(joined, symptom_lists, prognosis, support)
+    ]
+
+
+def case_document(text: str, names: List[str], disease: str, support: int) -> Document:
+    return Document(
+        page_content=f"Patient presents with: {text}.\nMost likely diagnosis: {disease}.",
+        metadata={
+            "symptoms": names,
+            "prognosis": disease,
+            "num_symptoms": len(names),
+            "support": int(support)
+        }
+    )
+
+
+def case_row_document(symptom_names: Sequence[str], row: np.ndarray, disease: str, support: int) -> Document:
+    """Document for one 0/1 row of a case matrix"""
+    names = [symptom_names[j] for j in np.flatnonzero(row)]
+    return case_document(", ".join(names), names, disease, support)
+
+
+class MappedCaseDocstore(Docstore):
+    """Read-only docstore over the snapshot's case arrays, opened with mmap
+
+    Row i of the arrays is the case behind FAISS vector i; documents are
+    rebuilt on lookup, so every worker shares the same file pages instead of
+    holding its own unpickled copy of the corpus.
+    """
+
+    def __init__(self, directory: str):
+        self.symptoms = np.load(os.path.join(directory, CASE_SYMPTOMS_FILE), mmap_mode="r")
+        self.prognosis = np.load(os.path.join(directory, CASE_PROGNOSIS_FILE), mmap_mode="r")
+        self.support = np.load(os.path.join(directory, CASE_SUPPORT_FILE), mmap_mode="r")
+        with open(os.path.join(directory, CASE_LABELS_FILE)) as f:
+            labels = json.load(f)
+        self.symptom_names = labels["symptoms"]
+        self.diseases = labels["diseases"]
+
+    def __len__(self) -> int:
+        return len(self.symptoms)
+
+    def search(self, search: str):
+        try:
+            row = int(search)
+        except ValueError:
+            row = -1
+        if not 0 <= row < len(self):
+            return f"ID {search} not found."
+        return case_row_document(
+            self.symptom_names, self.symptoms[row], self.diseases[self.prognosis[row]], self.support[row]
+        )
+
+
+class RowIds(Mapping):
+    """FAISS row -> docstore id for stores whose ids are the row numbers, without a dict per row"""
+
+    def __init__(self, n: int):
+        self.n = n
+
+    def __getitem__(self, row: int) -> str:
+        if not isinstance(row, (int, np.integer)) or not 0 <= row < self.n:
+            raise KeyError(row)
+        return str(row)
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __iter__(self):
+        return iter(range(self.n))
+
+
+def build_embeddings(model_name: Optional[str] = None):
+    return HuggingFaceBgeEmbeddings(
+        model_name=model_name or settings.embedding_model
+    )
+
+
+# 3. Index snapshot
+def dataset_fingerprint(csv_path: str, model_name: str) -> str:
+    """Hash of the dataset bytes, embedding model, document format and index build parameters"""
+    digest = hashlib.sha256()
+    with open(csv_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    digest.update(model_name.encode("utf-8"))
+    digest.update(str(INDEX_FORMAT_VERSION).encode("utf-8"))
+    if settings.index_type != "flat":
+        # Flat snapshots keep the fingerprint they had before index types existed
+        digest.update(json.dumps(index_build_params(), sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def read_snapshot_meta(index_dir: str) -> dict:
+    """Contents of the snapshot's fingerprint file, or {} if there is no readable snapshot"""
+    try:
+        with open(os.path.join(index_dir, FINGERPRINT_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def read_snapshot_fingerprint(index_dir: str) -> Optional[str]:
+    return read_snapshot_meta(index_dir).get("fingerprint")
+
+
+def index_build_params(index_type: Optional[str] = None, **overrides) -> Dict:
+    """Build parameters for `index_type` (default settings.index_type), with overrides"""
+    index_type = index_type or settings.index_type
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+    params = {"index_type": index_type}
+    if index_type in ("ivf", "ivfpq"):
+        params["nlist"] = settings.index_nlist
+    if index_type == "hnsw":
+        params["hnsw_m"] = settings.index_hnsw_m
+        params["ef_construction"] = settings.index_ef_construction
+    if index_type in ("pq", "ivfpq"):
+        params["pq_m"] = settings.index_pq_m
+        params["pq_bits"] = settings.index_pq_bits
+    params.update({key: value for key, value in overrides.items() if key in params and value is not None})
+    return params
+
+
+def index_factory_string(n: int, d: int, params: Dict) -> str:
+    """faiss.index_factory description for `params`, scaled down so n training vectors suffice"""
+    index_type = params["index_type"]
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "hnsw":
+        return f"HNSW{params['hnsw_m']}"
+    # k-means wants about 39 points per centroid
+    nlist = max(1, min(params.get("nlist") or int(4 * math.sqrt(n)), n // 39))
+    ivf = f"IVF{nlist},"
+    if index_type == "ivf":
+        return ivf + "Flat"
+    # Sub-quantizers must divide the dimension, and each codebook's k-means wants about 39 points
+    # per centroid, i.e. 39 * 2^bits. Below 4 bits the codes are too coarse to be worth it
+    pq_m = max(m for m in range(1, min(params["pq_m"], d) + 1) if d % m == 0)
+    pq_bits = min(params["pq_bits"], int(math.log2(max(1, n // 39))) if n >= 39 else 0)
+    if pq_bits < 4:
+        return ivf + "Flat" if index_type == "ivfpq" else "Flat"
+    return (ivf if index_type == "ivfpq" else "") + f"PQ{pq_m}x{pq_bits}"
+
+
+def build_faiss_index(vectors: np.ndarray, params: Optional[Dict] = None,
+                      metric: int = faiss.METRIC_L2) -> faiss.Index:
+    """Train (where needed) and fill an index of the configured type"""
+    params = params or index_build_params()
+    n, d = vectors.shape
+    index = faiss.index_factory(d, index_factory_string(n, d, params), metric)
+    if params["index_type"] == "hnsw":
+        faiss.downcast_index(index).hnsw.efConstruction = params["ef_construction"]
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def set_search_params(index: faiss.Index, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Apply the query-time knobs of IVF and HNSW indexes (others have none)"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(ivf.nlist, nprobe or settings.index_nprobe)
+    index = faiss.downcast_index(index)
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search or settings.index_ef_search
+
+
+def build_vectorstore(csv_path: str, embeddings) -> FAISS:
+    # A case document is one short line, far below any chunk size, so it is indexed as-is
+    documents = create_medical_documents(csv_path)
+    vectors = np.asarray(embeddings.embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+    index = build_faiss_index(vectors)
+    set_search_params(index)
+    docstore = InMemoryDocstore({str(i): doc for i, doc in enumerate(documents)})
+    return FAISS(embeddings, index, docstore, {i: str(i) for i in range(len(documents))})
+
+
+# (symptom names, 0/1 case matrix, disease names, prognosis code per case, support per case)
+CaseArrays = Tuple[List[str], np.ndarray, List[str], np.ndarray, np.ndarray]
+
+
+def case_arrays_from_csv(csv_path: str) -> CaseArrays:
+    """The cases in index order (the order create_medical_documents uses)"""
+    symptoms, prognosis, support = load_case_table(csv_path)
+    codes, diseases = pd.factorize(prognosis)
+    return list(symptoms.columns), symptoms.to_numpy(dtype=np.uint8), list(diseases), codes, support.to_numpy()
+
+
+def save_case_arrays(directory: str, cases: CaseArrays):
+    symptom_names, matrix, diseases, codes, support = cases
+    np.save(os.path.join(directory, CASE_SYMPTOMS_FILE), np.asarray(matrix, dtype=np.uint8))
+    np.save(os.path.join(directory, CASE_PROGNOSIS_FILE), np.asarray(codes, dtype=np.int32))
+    np.save(os.path.join(directory, CASE_SUPPORT_FILE), np.asarray(support, dtype=np.int32))
+    with open(os.path.join(directory, CASE_LABELS_FILE), "w") as f:
+        json.dump({"symptoms": list(symptom_names), "diseases": list(diseases)}, f)
+
+
+def resolve_snapshot(index_dir: str) -> str:
+    """The versioned directory `index_dir` points at right now
+
+    Resolve it once and read every file from the result, so a swap in the
+    middle can't mix files of two snapshots.
+    """
+    return os.path.realpath(index_dir)
+
+
+def save_snapshot(vectorstore: FAISS, index_dir: str, fingerprint: str, model_name: str, cases: CaseArrays,
+                  compacted_through: int = 0):
+    """Write the index into a new versioned directory and point `index_dir` at it atomically
+
+    `index_dir` is a symlink to a sibling `<name>.<generation>` directory and
+    is replaced in one rename, so it always names a complete snapshot.
+    `compacted_through` is the byte offset of the ingestion log up to which
+    ingested cases are already part of this snapshot.
+    """
+    index_dir = os.path.abspath(index_dir)
+    parent, name = os.path.split(index_dir)
+    legacy = os.path.isdir(index_dir) and not os.path.islink(index_dir)
+    if legacy and not os.path.isfile(os.path.join(index_dir, FINGERPRINT_FILE)):
+        # Someone else's directory; it can't be moved aside for the symlink
+        raise FileExistsError(f"{index_dir} exists and is not an index snapshot; pass a path that doesn't exist yet")
+    os.makedirs(parent, exist_ok=True)
+    # Changes on every write, so other processes can tell the snapshot was swapped
+    generation = uuid.uuid4().hex
+    version = f"{name}.{generation}"
+    tmp_dir = tempfile.mkdtemp(prefix=f".{name}-", dir=parent)
+    try:
+        vectorstore.save_local(tmp_dir)
+        save_case_arrays(tmp_dir, cases)
+        with open(os.path.join(tmp_dir, FINGERPRINT_FILE), "w") as f:
+            json.dump({
+                "fingerprint": fingerprint,
+                "embedding_model": model_name,
+                "format_version": INDEX_FORMAT_VERSION,
+                "compacted_through": compacted_through,
+                "generation": generation
+            }, f)
+        os.rename(tmp_dir, os.path.join(parent, version))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    previous = os.readlink(index_dir) if os.path.islink(index_dir) else None
+    if legacy:
+        # A snapshot written before versioned directories; moved aside once, not atomically
+        previous = f"{name}.{read_snapshot_meta(index_dir).get('generation') or uuid.uuid4().hex}"
+        os.rename(index_dir, os.path.join(parent, previous))
+    link = os.path.join(parent, f".{version}.link")
+    os.symlink(version, link)
+    os.replace(link, index_dir)
+    # Processes that resolved the previous version may still be loading it; older ones go
+    prune_snapshots(parent, name, keep={version, os.path.basename(previous or "")})
+
+
+def prune_snapshots(parent: str, name: str, keep: set):
+    pattern = re.compile(rf"{re.escape(name)}\.[0-9a-f]{{32}}")
+    for entry in os.listdir(parent):
+        if entry not in keep and pattern.fullmatch(entry):
+            shutil.rmtree(os.path.join(parent, entry), ignore_errors=True)
+
+
+def load_or_build_vectorstore(csv_path: str, embeddings=None, index_dir: Optional[str] = None,
+                              model_name: Optional[str] = None) -> FAISS:
+    """Load the persisted index if it matches the dataset, otherwise rebuild and persist it"""
+    model_name = model_name or settings.embedding_model
+    index_dir = index_dir if index_dir is not None else settings.index_dir
+    embeddings = embeddings or build_embeddings(model_name)
+    if settings.query_cache_size > 0 and not isinstance(embeddings, CachedQueryEmbeddings):
+        # Symptom sets repeat a lot; remember their query vectors
+        embeddings = CachedQueryEmbeddings(
+            embeddings,
+            max_entries=settings.query_cache_size,
+            max_bytes=int(settings.query_cache_max_mb * 1024 * 1024)
+        )
+    fingerprint = dataset_fingerprint(csv_path, model_name)
+
+    if index_dir and read_snapshot_fingerprint(index_dir) == fingerprint:
+        return load_snapshot(index_dir, embeddings)
+
+    vectorstore = build_vectorstore(csv_path, embeddings)
+    if index_dir:
+        try:
+            save_snapshot(vectorstore, index_dir, fingerprint, model_name, case_arrays_from_csv(csv_path))
+        except OSError as e:
+            logger.warning("Could not persist index snapshot to %s: %s", index_dir, e)
+    return vectorstore
+
+
+def load_snapshot(index_dir: str, embeddings) -> FAISS:
+    index_dir = resolve_snapshot(index_dir)
+    if settings.index_mmap:
+        vectorstore = load_mapped_vectorstore(index_dir, embeddings)
+    else:
+        # The docstore is a pickle we wrote ourselves; the fingerprint guards against stale files
+        vectorstore = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+    set_search_params(vectorstore.index)
+    return vectorstore
+
+
+def load_mapped_vectorstore(index_dir: str, embeddings) -> FAISS:
+    """Open a snapshot read-only through mmap, so processes on one host share its pages"""
+    flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    path = os.path.join(index_dir, INDEX_FILE)
+    try:
+        index = faiss.read_index(path, flags)
+    except RuntimeError:
+        # Index types this FAISS build can't map are read into memory as before
+        index = faiss.read_index(path)
+    docstore = MappedCaseDocstore(index_dir)
+    if len(docstore) != index.ntotal:
+        raise ValueError(f"Snapshot at {index_dir} has {index.ntotal} vectors but {len(docstore)} cases")
+    return FAISS(embeddings, index, docstore, RowIds(index.ntotal))
+
+
+# 4. Vector Store Setup
+def build_medical_retriever(csv_path: str, embeddings=None):
+    vectorstore = load_or_build_vectorstore(csv_path, embeddings)
+    # Over-fetch so duplicate prognoses can be collapsed into k distinct diseases
+    k = settings.retrieval_k * max(1, settings.retrieval_overfetch)
+    return vectorstore.as_retriever(search_kwargs={"k": k})
+
+
+def search_vectors(vectorstore: FAISS, vectors: np.ndarray, k: int) -> List[List[Tuple[Document, float]]]:
+    """Top-k (document, distance) pairs for each query vector from one index search"""
+    distances, indices = vectorstore.index.search(vectors, k)
+    return [
+        [(vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]), float(d))
+         for i, d in zip(row, row_distances) if i != -1]
+        for row, row_distances in zip(indices, distances)
+    ]
+
+
+def relevance_score(vectorstore: FAISS, distance: float) -> float:
+    """Cosine similarity clipped to [0, 1] from a FAISS score
+
+    Assumes unit-length embeddings (BGE normalises them), for which the
+    squared L2 distance FAISS reports is 2 - 2 * cosine.
+    """
+    if vectorstore.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+        cosine = distance
+    else:
+        cosine = 1.0 - distance / 2.0
+    return min(1.0, max(0.0, float(cosine)))
+
+
+async def asearch_with_relevance(vectorstore: FAISS, text: str, k: int) -> List[Tuple[Document, float]]:
+    """Top-k documents for one query text with their relevance scores"""
+    hits = await vectorstore.asimilarity_search_with_score(text, k=k)
+    return [(doc, relevance_score(vectorstore, distance)) for doc, distance in hits]
+
+
+def search_batch(vectorstore: FAISS, texts: List[str], k: int) -> List[List[Tuple[Document, float]]]:
+    """Top-k (document, relevance) pairs for each query text, using one embedding call and one index search"""
+    if not texts:
+        return []
+    vectors = np.asarray(embed_queries(vectorstore.embeddings, texts), dtype=np.float32)
+    if getattr(vectorstore, "_normalize_L2", False):
+        faiss.normalize_L2(vectors)
+    if hasattr(vectorstore, "search_vectors"):
+        # A live index searches each of its segments
+        rows = vectorstore.search_vectors(vectors, k)
+    else:
+        rows = search_vectors(vectorstore, vectors, k)
+    return [[(doc, relevance_score(vectorstore, distance)) for doc, distance in row] for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prebuild the persisted FAISS case index")
+    parser.add_argument("--csv", default=settings.data_path, help="Training CSV")
+    parser.add_argument("--index-dir", default=settings.index_dir, help="Snapshot directory")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if the snapshot is current")
+    args = parser.parse_args()
+
+    model_name = settings.embedding_model
+    fingerprint = dataset_fingerprint(args.csv, model_name)
+    if not args.force and read_snapshot_fingerprint(args.index_dir) == fingerprint:
+        print(f"Index at {args.index_dir} is up to date ({fingerprint[:12]})")
+        return
+
+    vectorstore = build_vectorstore(args.csv, build_embeddings(model_name))
+    save_snapshot(vectorstore, args.index_dir, fingerprint, model_name, case_arrays_from_csv(args.csv))
+    print(f"Index written to {args.index_dir} ({fingerprint[:12]})")
+
+
+if __name__ == "__main__":
+    main()
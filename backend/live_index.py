@@ -0,0 +1,467 @@
+import json
+import logging
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from config import settings
+from knowledge_base import (INDEX_FILE, MappedCaseDocstore, build_medical_retriever, case_document, case_row_document,
+                            load_or_build_vectorstore, load_snapshot, load_symptom_table, normalize_symptom_name,
+                            read_snapshot_meta, resolve_snapshot, save_snapshot, search_vectors)
+from symptom_matrix import SymptomMatrixRetriever
+
+logger = logging.getLogger(__name__)
+
+DELTA_LOG_FILE = "cases.jsonl"
+# (canonical symptom names, prognosis)
+Case = Tuple[List[str], str]
+
+try:
+    import fcntl
+except ImportError:  # Windows: compaction is only guarded within the process, and the log never truncated
+    fcntl = None
+
+
+def normalize_case(symptoms: Iterable[str], prognosis: str) -> Case:
+    """Canonical symptom names (de-duplicated, in input order) and a stripped prognosis"""
+    names = list(dict.fromkeys(normalize_symptom_name(s) for s in symptoms if s and s.strip()))
+    prognosis = (prognosis or "").strip()
+    if not names:
+        raise ValueError("A case needs at least one symptom")
+    if not prognosis:
+        raise ValueError("A case needs a prognosis")
+    return names, prognosis
+
+
+def cases_from_csv(source) -> List[Case]:
+    """Cases from a CSV in the training set's layout (0/1 symptom columns plus `prognosis`)"""
+    symptoms, prognosis = load_symptom_table(source)
+    names = list(symptoms.columns)
+    return [([names[j] for j in np.flatnonzero(row)], disease)
+            for row, disease in zip(symptoms.to_numpy(), prognosis)]
+
+
+class DeltaLog:
+    """Append-only JSONL of ingested cases and their vectors, shared by every process
+
+    Byte offsets identify positions in the log: a snapshot records the offset
+    it has compacted through, and each process remembers how far it has read.
+    Once a snapshot holds them, the records before its offset are cut off;
+    the file then starts with a header line giving the offset its first
+    record had, so offsets never move.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, DELTA_LOG_FILE)
+
+    def append(self, records: List[Dict]):
+        os.makedirs(self.directory, exist_ok=True)
+        # One write in append mode, so concurrent writers never interleave inside a line;
+        # the lock keeps the write out of the file truncate() is about to replace
+        with _file_lock(os.path.join(self.directory, ".append.lock"), blocking=True), \
+                open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _header(f) -> Tuple[int, int]:
+        """(offset of the first record, bytes before it) of a log file open at its start"""
+        line = f.readline()
+        try:
+            header = json.loads(line) if line.endswith(b"\n") else {}
+        except ValueError:
+            header = {}
+        if "log_start" in header:
+            return header["log_start"], len(line)
+        return 0, 0
+
+    def end(self) -> int:
+        """Offset just past everything written so far"""
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return 0
+        with f:
+            base, header_size = self._header(f)
+            return base + os.fstat(f.fileno()).st_size - header_size
+
+    def read(self, start: int, end: Optional[int] = None) -> Tuple[List[Dict], int]:
+        """Records between byte offsets `start` and `end`, and the offset after the last whole line"""
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return [], start
+        records = []
+        with f:
+            base, header_size = self._header(f)
+            if start < base:
+                # Cut off after compaction; the caller picks them up from the new snapshot
+                return [], start
+            f.seek(header_size + start - base)
+            offset = start
+            for line in f:
+                if not line.endswith(b"\n") or (end is not None and offset >= end):
+                    # A line still being written, or past the requested range
+                    break
+                records.append(json.loads(line))
+                offset += len(line)
+        return records, offset
+
+    def truncate(self, through: int):
+        """Drop the records before offset `through`, which a snapshot now holds"""
+        if fcntl is None:
+            # Another process could append to the file being replaced
+            return
+        with _file_lock(os.path.join(self.directory, ".append.lock"), blocking=True):
+            try:
+                f = open(self.path, "rb")
+            except FileNotFoundError:
+                return
+            with f:
+                base, header_size = self._header(f)
+                if through <= base:
+                    return
+                f.seek(header_size + through - base)
+                rest = f.read()
+            # Written beside the log and renamed over it: readers see the old file or the new one
+            staging = self.path + ".tmp"
+            with open(staging, "wb") as out:
+                out.write((json.dumps({"log_start": through}) + "\n").encode("utf-8"))
+                out.write(rest)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(staging, self.path)
+
+
+class LiveCaseIndex(VectorStore):
+    """Case index that accepts new cases while serving
+
+    The snapshot on disk is the read-only base segment; ingested cases are
+    appended to a DeltaLog and indexed in a small in-memory delta segment.
+    Searches query both and merge by distance, so ingest cost is proportional
+    to the new rows. Compaction folds the log into a new snapshot, swaps it in
+    atomically and keeps serving from the old segments until the swap.
+    """
+
+    def __init__(self, base: FAISS, index_dir: str, delta_dir: str, model_name: str):
+        self.index_dir = index_dir
+        self.model_name = model_name
+        self.log = DeltaLog(delta_dir)
+        # Swapped as a unit; searches take a reference and never wait for writers
+        self._segments = (base, None)
+        meta = read_snapshot_meta(index_dir)
+        self._generation = meta.get("generation")
+        self._log_offset = meta.get("compacted_through", 0)
+        self._write_lock = threading.RLock()
+        # FAISS must not search an index while vectors are being added to it
+        self._delta_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self.sync()
+
+    # Vector store interface (what the retriever and search_batch use)
+    @property
+    def base(self) -> FAISS:
+        return self._segments[0]
+
+    @property
+    def embeddings(self):
+        return self.base.embeddings
+
+    @property
+    def _normalize_L2(self) -> bool:
+        return self.base._normalize_L2
+
+    @property
+    def distance_strategy(self):
+        return self.base.distance_strategy
+
+    def _select_relevance_score_fn(self):
+        return self.base._select_relevance_score_fn()
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("Build the base index with knowledge_base, then wrap it in LiveCaseIndex")
+
+    def _merge(self, base_hits: List, delta_hits: List, k: int) -> List[Tuple[Document, float]]:
+        if not delta_hits:
+            return base_hits
+        # Inner-product scores rank high-to-high; distances low-to-high
+        descending = self.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT
+        return sorted(base_hits + delta_hits, key=lambda hit: hit[1], reverse=descending)[:k]
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               **kwargs) -> List[Tuple[Document, float]]:
+        base, delta = self._segments
+        hits = base.similarity_search_with_score_by_vector(embedding, k, **kwargs)
+        if delta is None:
+            return hits
+        with self._delta_lock:
+            delta_hits = delta.similarity_search_with_score_by_vector(embedding, k, **kwargs)
+        return self._merge(hits, delta_hits, k)
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def search_vectors(self, vectors: np.ndarray, k: int) -> List[List[Tuple[Document, float]]]:
+        base, delta = self._segments
+        rows = search_vectors(base, vectors, k)
+        if delta is None:
+            return rows
+        with self._delta_lock:
+            delta_rows = search_vectors(delta, vectors, k)
+        return [self._merge(row, delta_row, k) for row, delta_row in zip(rows, delta_rows)]
+
+    # Ingestion
+    def __len__(self) -> int:
+        base, delta = self._segments
+        return base.index.ntotal + (delta.index.ntotal if delta is not None else 0)
+
+    @property
+    def delta_size(self) -> int:
+        delta = self._segments[1]
+        return delta.index.ntotal if delta is not None else 0
+
+    def add_cases(self, cases: Sequence[Case]) -> int:
+        """Embed, log and index new cases; returns how many were added"""
+        cases = [normalize_case(names, prognosis) for names, prognosis in cases]
+        if not cases:
+            return 0
+        documents = [case_document(", ".join(names), names, prognosis, 1) for names, prognosis in cases]
+        vectors = self.embeddings.embed_documents([doc.page_content for doc in documents])
+        with self._write_lock:
+            self.log.append([
+                {"symptoms": names, "prognosis": prognosis, "model": self.model_name, "vector": list(map(float, vector))}
+                for (names, prognosis), vector in zip(cases, vectors)
+            ])
+            # Picks up these records (and any appended by other processes) from the log
+            self.sync()
+        return len(cases)
+
+    def _vectors(self, records: List[Dict]) -> np.ndarray:
+        """Stored vectors, re-embedding records written under a different embedding model"""
+        stale = [i for i, record in enumerate(records) if record.get("model") != self.model_name]
+        if stale:
+            texts = [case_document(", ".join(records[i]["symptoms"]), records[i]["symptoms"],
+                                   records[i]["prognosis"], 1).page_content for i in stale]
+            for i, vector in zip(stale, self.embeddings.embed_documents(texts)):
+                records[i] = {**records[i], "vector": vector, "model": self.model_name}
+        return np.asarray([record["vector"] for record in records], dtype=np.float32)
+
+    def _new_delta(self) -> FAISS:
+        base = self.base
+        return FAISS(
+            self.embeddings, faiss.IndexFlat(base.index.d, base.index.metric_type), InMemoryDocstore(), {},
+            normalize_L2=base._normalize_L2, distance_strategy=base.distance_strategy
+        )
+
+    def _index_records(self, delta: Optional[FAISS], records: List[Dict]) -> Optional[FAISS]:
+        if not records:
+            return delta
+        delta = delta if delta is not None else self._new_delta()
+        documents = [case_document(", ".join(r["symptoms"]), r["symptoms"], r["prognosis"], 1) for r in records]
+        vectors = self._vectors(records)
+        with self._delta_lock:
+            delta.add_embeddings(
+                zip([doc.page_content for doc in documents], vectors.tolist()),
+                metadatas=[doc.metadata for doc in documents]
+            )
+        return delta
+
+    def sync(self):
+        """Catch up with the log and with snapshots compacted by any process"""
+        with self._write_lock:
+            snapshot = resolve_snapshot(self.index_dir)
+            meta = read_snapshot_meta(snapshot)
+            if meta.get("generation") != self._generation:
+                self._reload(snapshot, meta)
+                return
+            records, self._log_offset = self.log.read(self._log_offset)
+            if records:
+                base, delta = self._segments
+                self._segments = (base, self._index_records(delta, records))
+
+    def _reload(self, snapshot: str, meta: Dict):
+        base = load_snapshot(snapshot, self.embeddings)
+        records, offset = self.log.read(meta.get("compacted_through", 0))
+        delta = self._index_records(None, records)
+        self._segments = (base, delta)
+        self._generation, self._log_offset = meta.get("generation"), offset
+
+    # Compaction
+    def compact(self) -> int:
+        """Fold logged cases into a new snapshot and swap it in; returns how many were folded in"""
+        with self._compact_lock, _file_lock(os.path.join(self.log.directory, ".compact.lock")) as acquired:
+            if not acquired:
+                # Another process is compacting; sync() will pick up its snapshot
+                return 0
+            self.sync()
+            snapshot = resolve_snapshot(self.index_dir)
+            meta = read_snapshot_meta(snapshot)
+            if "fingerprint" not in meta:
+                # No index_dir, or the snapshot couldn't be saved: the cases stay in the log and the delta
+                logger.warning("Not compacting ingested cases: there is no index snapshot at %r", self.index_dir)
+                return 0
+            start = meta.get("compacted_through", 0)
+            records, end = self.log.read(start, self._log_offset)
+            if not records:
+                return 0
+
+            # Built off to the side from the files on disk; searches keep using the live segments
+            index = faiss.read_index(os.path.join(snapshot, INDEX_FILE))
+            vectors = self._vectors(records)
+            if self._normalize_L2:
+                faiss.normalize_L2(vectors)
+            index.add(vectors)
+            cases = merge_case_arrays(MappedCaseDocstore(snapshot), records)
+            symptom_names, matrix, diseases, codes, support = cases
+            docstore = InMemoryDocstore({
+                str(i): case_row_document(symptom_names, matrix[i], diseases[codes[i]], support[i])
+                for i in range(len(matrix))
+            })
+            compacted = FAISS(self.embeddings, index, docstore, {i: str(i) for i in range(len(matrix))},
+                              normalize_L2=self._normalize_L2, distance_strategy=self.distance_strategy)
+            save_snapshot(compacted, self.index_dir, meta["fingerprint"], self.model_name, cases,
+                          compacted_through=end)
+            self.sync()
+            # Processes still on the old snapshot see the new generation before they read the log again
+            self.log.truncate(end)
+            return len(records)
+
+    def compact_if_needed(self) -> int:
+        if self.delta_size < max(1, settings.compaction_min_cases):
+            return 0
+        return self.compact()
+
+
+class LiveSymptomMatrix:
+    """Matrix backend over the snapshot's cases plus those ingested since
+
+    Follows the snapshot and the DeltaLog like LiveCaseIndex, without the
+    embeddings: sync() swaps in a new SymptomMatrixRetriever when either has
+    moved on. Everything else is the current retriever's.
+    """
+
+    def __init__(self, index_dir: str, delta_dir: str):
+        self.index_dir = index_dir
+        self.log = DeltaLog(delta_dir)
+        self._matrix: Optional[SymptomMatrixRetriever] = None
+        self._cases: Optional[MappedCaseDocstore] = None
+        self._records: List[Dict] = []
+        self._generation = None
+        self._log_offset = 0
+        self._lock = threading.Lock()
+        self.sync()
+
+    def __getattr__(self, name):
+        # search, search_batch, symptoms, ... of the matrix in use right now
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._matrix, name)
+
+    def sync(self):
+        """Catch up with the log and with snapshots compacted by any process"""
+        with self._lock:
+            snapshot = resolve_snapshot(self.index_dir)
+            meta = read_snapshot_meta(snapshot)
+            reload = self._matrix is None or meta.get("generation") != self._generation
+            if reload:
+                self._cases = MappedCaseDocstore(snapshot)
+                self._records = []
+                self._generation, self._log_offset = meta.get("generation"), meta.get("compacted_through", 0)
+            records, self._log_offset = self.log.read(self._log_offset)
+            if not (reload or records):
+                return
+            # The logged vectors aren't needed here
+            self._records += [{"symptoms": r["symptoms"], "prognosis": r["prognosis"]} for r in records]
+            cases = self._cases
+            if self._records:
+                symptom_names, matrix, diseases, codes, support = merge_case_arrays(cases, self._records)
+            else:
+                # The snapshot's mapped arrays as they are, shared by every worker
+                symptom_names, matrix, diseases, codes, support = \
+                    cases.symptom_names, cases.symptoms, cases.diseases, cases.prognosis, cases.support
+            self._matrix = SymptomMatrixRetriever(symptom_names, matrix, codes, support, diseases=diseases)
+
+
+def merge_case_arrays(base: MappedCaseDocstore, records: List[Dict]):
+    """The base snapshot's case arrays with the logged cases appended (new symptoms become new columns)"""
+    symptom_names = list(base.symptom_names)
+    diseases = list(base.diseases)
+    columns = {name: j for j, name in enumerate(symptom_names)}
+    disease_codes = {name: j for j, name in enumerate(diseases)}
+    for record in records:
+        for name in record["symptoms"]:
+            columns.setdefault(name, len(columns))
+        disease_codes.setdefault(record["prognosis"], len(disease_codes))
+    symptom_names = list(columns)
+    diseases = list(disease_codes)
+
+    matrix = np.zeros((len(base) + len(records), len(symptom_names)), dtype=np.uint8)
+    matrix[:len(base), :base.symptoms.shape[1]] = base.symptoms
+    for i, record in enumerate(records, start=len(base)):
+        matrix[i, [columns[name] for name in record["symptoms"]]] = 1
+    codes = np.concatenate([base.prognosis, [disease_codes[r["prognosis"]] for r in records]]).astype(np.int32)
+    support = np.concatenate([base.support, np.ones(len(records), dtype=np.int32)])
+    return symptom_names, matrix, diseases, codes, support
+
+
+class _file_lock:
+    """Exclusive lock on `path` across processes (always granted without fcntl)
+
+    Non-blocking unless asked: entering returns False when another process holds it.
+    """
+
+    def __init__(self, path: str, blocking: bool = False):
+        self.path = path
+        self.blocking = blocking
+        self.file = None
+
+    def __enter__(self) -> bool:
+        if fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "w")
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.file.close()
+            self.file = None
+            return False
+        return True
+
+    def __exit__(self, *exc):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+
+
+def open_live_index(csv_path: str, embeddings=None, index_dir: Optional[str] = None,
+                    delta_dir: Optional[str] = None, model_name: Optional[str] = None) -> LiveCaseIndex:
+    """Load (or build) the snapshot and replay the cases ingested since it was compacted"""
+    index_dir = index_dir if index_dir is not None else settings.index_dir
+    model_name = model_name or settings.embedding_model
+    base = load_or_build_vectorstore(csv_path, embeddings, index_dir=index_dir, model_name=model_name)
+    return LiveCaseIndex(base, index_dir, delta_dir or settings.delta_dir, model_name)
+
+
+def build_live_retriever(csv_path: str, embeddings=None):
+    """Retriever over the live index, or over the plain snapshot when ingestion is disabled"""
+    if not settings.delta_dir:
+        return build_medical_retriever(csv_path, embeddings)
+    vectorstore = open_live_index(csv_path, embeddings)
+    # Over-fetch so duplicate prognoses can be collapsed into k distinct diseases
+    k = settings.retrieval_k * max(1, settings.retrieval_overfetch)
+    return vectorstore.as_retriever(search_kwargs={"k": k})
@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+
+_bypass: ContextVar[bool] = ContextVar("llm_cache_bypass", default=False)
+
+
+@contextmanager
+def bypass_llm_cache(enabled: bool = True):
+    """Send the LLM calls made inside the block (and the tasks it starts) to the model
+
+    Lookups miss, but the fresh answers are still stored for later requests.
+    """
+    token = _bypass.set(enabled)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def make_key(prompt: str, llm_string: str) -> str:
+    # llm_string carries the model name, temperature, etc. so different settings never collide
+    return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+
+class SQLiteResponseCache(BaseCache):
+    """LLM responses in an SQLite file, shared by worker processes and kept across restarts"""
+
+    def __init__(self, path: str, ttl: Optional[float] = None):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            # WAL lets workers read while one of them writes
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_responses (key TEXT PRIMARY KEY, created REAL, value BLOB)"
+            )
+            if ttl is not None:
+                self._conn.execute("DELETE FROM llm_responses WHERE created < ?", (time.time() - ttl,))
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created, value FROM llm_responses WHERE key = ?", (make_key(prompt, llm_string),)
+            ).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[0] > self.ttl):
+            return None
+        # Only this service writes the file, so its pickles are trusted
+        return pickle.loads(row[1])
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        value = pickle.dumps(list(return_val))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_responses (key, created, value) VALUES (?, ?, ?)",
+                (make_key(prompt, llm_string), time.time(), value)
+            )
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_responses")
+
+
+class LRUResponseCache(BaseCache):
+    """In-memory LLM response cache keyed by a hash of the prompt and model parameters
+
+    Entries are evicted least-recently-used once `max_entries` is reached and
+    expire after `ttl` seconds (None keeps them until evicted). With a `backing`
+    cache (e.g. SQLiteResponseCache), misses are looked up there and every
+    update is written through to it.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None, backing: Optional[BaseCache] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backing = backing
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.backing_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    make_key = staticmethod(make_key)
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        value = self._lookup_memory(prompt, llm_string)
+        if value is None and self.backing is not None and not _bypass.get():
+            value = self._lookup_backing(prompt, llm_string)
+        return value
+
+    def _lookup_memory(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        if _bypass.get():
+            with self._lock:
+                self.bypassed += 1
+            return None
+        key = self.make_key(prompt, llm_string)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                if self.backing is None:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _lookup_backing(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        value = self.backing.lookup(prompt, llm_string)
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.backing_hits += 1
+        self._store(prompt, llm_string, value)
+        return value
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        self._store(prompt, llm_string, return_val)
+        if self.backing is not None:
+            self.backing.update(prompt, llm_string, return_val)
+
+    def _store(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        if self.max_entries <= 0:
+            return
+        key = self.make_key(prompt, llm_string)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), return_val)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._entries.clear()
+        if self.backing is not None:
+            self.backing.clear(**kwargs)
+
+    # Memory lookups are a dict access; only the backing cache is worth the executor hop
+    async def alookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        value = self._lookup_memory(prompt, llm_string)
+        if value is None and self.backing is not None and not _bypass.get():
+            value = await asyncio.to_thread(self._lookup_backing, prompt, llm_string)
+        return value
+
+    async def aupdate(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        self._store(prompt, llm_string, return_val)
+        if self.backing is not None:
+            await asyncio.to_thread(self.backing.update, prompt, llm_string, return_val)
+
+    async def aclear(self, **kwargs: Any) -> None:
+        self.clear(**kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            size = len(self._entries)
+        hits = self.hits + self.backing_hits
+        lookups = hits + self.misses
+        return {
+            "entries": size,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "backing_hits": self.backing_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evictions": self.evictions,
+            "hit_rate": hits / lookups if lookups else 0.0
+        }
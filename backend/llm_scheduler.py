@@ -0,0 +1,361 @@
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional
+
+import groq
+import httpx
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from metrics import LLM_HEDGES, LLM_QUEUE_SECONDS, LLM_RETRIES
+
+# Lower runs first: interactive requests overtake batch jobs, which overtake evaluation runs
+PRIORITIES = {"interactive": 0, "batch": 1, "evaluation": 2}
+RETRYABLE_STATUS = frozenset([408, 409, 429, 500, 502, 503, 504])
+
+_priority: ContextVar[str] = ContextVar("llm_priority", default="interactive")
+
+
+@contextmanager
+def llm_priority(name: str):
+    """Run the LLM calls made inside the block (and the tasks it starts) at priority `name`"""
+    if name not in PRIORITIES:
+        raise ValueError(f"Unknown LLM priority {name!r}, expected one of {tuple(PRIORITIES)}")
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """Allows `per_minute` units per minute with bursts up to `capacity`; 0 disables the limit"""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` is available (0 when it already is)"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def try_acquire(self, amount: float) -> bool:
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            self._refill()
+            if self.level >= min(amount, self.capacity):
+                self.level -= min(amount, self.capacity)
+                return True
+            return False
+
+    async def acquire(self, amount: float):
+        if self.rate <= 0:
+            return
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                wait = (amount - self.level) / self.rate
+            await asyncio.sleep(wait)
+
+    def adjust(self, delta: float):
+        """Charge (or refund) `delta` units, e.g. the difference between an estimate and what was used"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self.level = min(self.capacity, self.level - delta)
+
+
+class PriorityLimiter:
+    """Concurrency limit whose free slots go to the most urgent waiter first
+
+    With `requests` and `tokens` buckets, a slot is only handed out together
+    with the rate budget for the call, so the most urgent waiter also gets the
+    budget first; the ones behind it wait their turn instead of draining it.
+    Safe to share between event loops in different threads (the API and an
+    evaluation run in a worker thread).
+    """
+
+    def __init__(self, max_concurrency: int, requests: Optional[TokenBucket] = None,
+                 tokens: Optional[TokenBucket] = None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.requests = requests
+        self.tokens = tokens
+        self.active = 0
+        self._waiters: List = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._timer_pending = False
+
+    def _budget_delay(self, estimate: int) -> float:
+        return max(self.requests.delay(1) if self.requests else 0.0,
+                   self.tokens.delay(estimate) if self.tokens else 0.0)
+
+    def _charge(self, estimate: int):
+        if self.requests:
+            self.requests.adjust(1)
+        if self.tokens:
+            self.tokens.adjust(min(estimate, self.tokens.capacity))
+
+    async def acquire(self, priority: int, estimate: int = 0):
+        """Wait for a slot and, with buckets, budget for one request of about `estimate` tokens"""
+        with self._lock:
+            if self.active < self.max_concurrency and not self._waiters and self._budget_delay(estimate) == 0:
+                self.active += 1
+                self._charge(estimate)
+                return
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._seq), estimate, future))
+            self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot arrived just as we gave up; pass it on
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+            self._dispatch()
+
+    def _dispatch(self):
+        """Hand free slots to waiters in priority order while the budget lasts; call with the lock held"""
+        while self._waiters and self.active < self.max_concurrency:
+            _, _, estimate, future = self._waiters[0]
+            if future.cancelled():
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._budget_delay(estimate)
+            if delay > 0:
+                # Nobody overtakes the head of the queue; look again once its budget has refilled
+                if not self._timer_pending:
+                    self._timer_pending = True
+                    loop = future.get_loop()
+                    loop.call_soon_threadsafe(loop.call_later, delay, self._wake)
+                return
+            heapq.heappop(self._waiters)
+            self.active += 1
+            self._charge(estimate)
+            future.get_loop().call_soon_threadsafe(self._grant, future)
+
+    def _wake(self):
+        with self._lock:
+            self._timer_pending = False
+            self._dispatch()
+
+    def _grant(self, future: asyncio.Future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, httpx.TransportError, groq.APIConnectionError)):
+        return True
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status in RETRYABLE_STATUS
+
+
+def retry_after(error: BaseException) -> float:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class LLMScheduler:
+    """Shared execution layer for LLM calls
+
+    Every call waits, by priority, for a concurrency slot together with
+    request and token budget from the per-minute buckets. The buckets only
+    see this process, so with several workers each should get its share of
+    the provider's limits. A call that doesn't finish within
+    `call_timeout` is retried, and transient failures (429, 5xx, connection
+    errors) are retried with jittered exponential backoff. With `hedge_after`
+    set, a call still running after that many seconds gets a duplicate and
+    the first answer wins.
+    """
+
+    def __init__(self, max_concurrency: int = 16, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 max_retries: int = 4, retry_base_delay: float = 0.5, retry_max_delay: float = 20.0,
+                 call_timeout: Optional[float] = 30.0, hedge_after: Optional[float] = None):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.limiter = PriorityLimiter(max_concurrency, self.requests, self.tokens)
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.call_timeout = call_timeout
+        self.hedge_after = hedge_after
+
+    @asynccontextmanager
+    async def slot(self, estimate: int):
+        """Hold one slot, with rate budget for a call of about `estimate` tokens"""
+        priority = _priority.get()
+        start = time.perf_counter()
+        await self.limiter.acquire(PRIORITIES[priority], estimate)
+        try:
+            LLM_QUEUE_SECONDS.labels(priority).observe(time.perf_counter() - start)
+            yield
+        finally:
+            self.limiter.release()
+
+    def settle(self, estimate: int, usage: Optional[dict]):
+        if usage and usage.get("total_tokens"):
+            self.tokens.adjust(usage["total_tokens"] - estimate)
+
+    def backoff(self, attempt: int, error: BaseException) -> float:
+        # Full jitter, but never sooner than the server asked for
+        delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+        return max(delay, retry_after(error))
+
+    async def run(self, call: Callable[[], Awaitable], estimate: int, model: str = "unknown"):
+        """Run `call` (a fresh coroutine per attempt) under the limits, retrying transient failures"""
+        attempt = 0
+        while True:
+            try:
+                async with self.slot(estimate):
+                    result = await self._attempt(call, estimate, model)
+                self.settle(estimate, getattr(result, "usage_metadata", None))
+                return result
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = self.backoff(attempt, e)
+            attempt += 1
+            LLM_RETRIES.labels(model).inc()
+            await asyncio.sleep(delay)
+
+    async def _attempt(self, call: Callable[[], Awaitable], estimate: int, model: str):
+        first = asyncio.ensure_future(call())
+        if not self.hedge_after:
+            return await asyncio.wait_for(first, self.call_timeout)
+
+        pending = {first}
+        deadline = time.monotonic() + self.call_timeout if self.call_timeout else None
+        error: Optional[BaseException] = None
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.hedge_after)
+            if not done and self.requests.try_acquire(1) and self.tokens.try_acquire(estimate):
+                # Only hedge when there is budget to spare
+                LLM_HEDGES.labels(model).inc()
+                pending.add(asyncio.ensure_future(call()))
+            while pending:
+                timeout = max(0.0, deadline - time.monotonic()) if deadline else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+class ScheduledChatModel(BaseChatModel):
+    """Chat model that sends every call of `inner` through an LLMScheduler"""
+
+    inner: BaseChatModel
+    scheduler: Any
+    # Rough output length used for token budgeting before the real usage is known
+    output_token_estimate: int = 512
+
+    @property
+    def _llm_type(self) -> str:
+        return self.inner._llm_type
+
+    @property
+    def _identifying_params(self):
+        return self.inner._identifying_params
+
+    def _get_llm_string(self, stop=None, **kwargs) -> str:
+        # Cache entries are keyed by the wrapped model and its settings
+        return self.inner._get_llm_string(stop=stop, **kwargs)
+
+    def _get_invocation_params(self, stop=None, **kwargs):
+        params = self.inner._get_invocation_params(stop=stop, **kwargs)
+        return {**params, "model_name": self.model_label}
+
+    @property
+    def model_label(self) -> str:
+        return str(getattr(self.inner, "model_name", None) or getattr(self.inner, "model", None) or self._llm_type)
+
+    def estimate_tokens(self, messages: List[BaseMessage]) -> int:
+        # About four characters per token for English prompts
+        return sum(len(str(m.content)) for m in messages) // 4 + self.output_token_estimate
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        # Synchronous callers bypass the scheduler; every agent runs async
+        message = self.inner.invoke(messages, stop=stop, **kwargs)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        message = await self.scheduler.run(
+            lambda: self.inner.ainvoke(messages, stop=stop, **kwargs),
+            self.estimate_tokens(messages),
+            self.model_label
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        # Streams are retried only until the first chunk arrives; after that the caller has seen output
+        estimate = self.estimate_tokens(messages)
+        scheduler = self.scheduler
+        attempt = 0
+        while True:
+            async with scheduler.slot(estimate):
+                stream = self.inner.astream(messages, stop=stop, **kwargs)
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), scheduler.call_timeout)
+                except StopAsyncIteration:
+                    return
+                except Exception as e:
+                    await stream.aclose()
+                    if attempt >= scheduler.max_retries or not is_retryable(e):
+                        raise
+                    delay = scheduler.backoff(attempt, e)
+                else:
+                    usage = None
+                    while True:
+                        usage = chunk.usage_metadata or usage
+                        yield ChatGenerationChunk(message=chunk)
+                        try:
+                            chunk = await stream.__anext__()
+                        except StopAsyncIteration:
+                            break
+                    scheduler.settle(estimate, usage)
+                    return
+            attempt += 1
+            LLM_RETRIES.labels(self.model_label).inc()
+            await asyncio.sleep(delay)
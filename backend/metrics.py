@@ -0,0 +1,169 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+registry = CollectorRegistry()
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUEST_SECONDS = Histogram(
+    "diagnosis_http_request_seconds", "HTTP request latency", ["route", "status"],
+    buckets=LATENCY_BUCKETS, registry=registry
+)
+STAGE_SECONDS = Histogram(
+    "diagnosis_stage_seconds", "Latency of pipeline stages (graph nodes, retrieval, embedding)",
+    ["kind", "name"], buckets=LATENCY_BUCKETS, registry=registry
+)
+LLM_SECONDS = Histogram(
+    "diagnosis_llm_call_seconds", "Latency of individual LLM calls", ["model", "status"],
+    buckets=LATENCY_BUCKETS, registry=registry
+)
+LLM_TOKENS = Counter(
+    "diagnosis_llm_tokens", "Tokens sent to and received from the LLM", ["model", "kind"], registry=registry
+)
+LLM_RETRIES = Counter("diagnosis_llm_retries", "LLM call retries", ["model"], registry=registry)
+LLM_HEDGES = Counter("diagnosis_llm_hedges", "Duplicate requests sent for slow LLM calls", ["model"], registry=registry)
+FALLBACKS = Counter(
+    "diagnosis_fallbacks", "Times a failing fast path was replaced by the slower one", ["path"], registry=registry
+)
+LLM_QUEUE_SECONDS = Histogram(
+    "diagnosis_llm_queue_seconds", "Time LLM calls wait for a slot and rate budget", ["priority"],
+    buckets=LATENCY_BUCKETS, registry=registry
+)
+
+# Per-request breakdown, filled in when a caller opens collect_timings()
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("diagnosis_timings", default=None)
+
+
+def _record(key: str, seconds: float):
+    timings = _timings.get()
+    if timings is not None:
+        timings[key] = round(timings.get(key, 0.0) + seconds, 6)
+
+
+@contextmanager
+def collect_timings():
+    """Collect stage durations (seconds, summed per stage) for everything run inside the block"""
+    timings: Dict[str, float] = {}
+    token = _timings.set(timings)
+    start = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        timings["total"] = round(time.perf_counter() - start, 6)
+        _timings.reset(token)
+
+
+@contextmanager
+def timed(kind: str, name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(kind, name).observe(elapsed)
+        _record(f"{kind}.{name}", elapsed)
+
+
+def instrument_node(name: str, node: Callable):
+    """Wrap an async graph node so its duration is recorded"""
+    async def run(state, config):
+        with timed("node", name):
+            return await node(state, config)
+    return run
+
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """Records latency, token usage and retries of every LLM call it is attached to"""
+
+    # Run in the caller's context so per-request timings see it
+    run_inline = True
+
+    def __init__(self):
+        self._started: Dict[UUID, tuple] = {}
+
+    def _start(self, serialized: Dict[str, Any], run_id: UUID, kwargs: Dict[str, Any]):
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model_name") or params.get("model") or (serialized or {}).get("name") or "unknown"
+        self._started[run_id] = (time.perf_counter(), str(model))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs: Any):
+        self._start(serialized, run_id, kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs: Any):
+        self._start(serialized, run_id, kwargs)
+
+    def _finish(self, run_id: UUID, status: str) -> str:
+        start, model = self._started.pop(run_id, (None, "unknown"))
+        if start is not None:
+            elapsed = time.perf_counter() - start
+            LLM_SECONDS.labels(model, status).observe(elapsed)
+            _record("llm", elapsed)
+        return model
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        model = self._finish(run_id, "ok")
+        prompt, completion = 0, 0
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage:
+            prompt, completion = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        else:
+            for generations in response.generations:
+                for generation in generations:
+                    meta = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                    prompt += meta.get("input_tokens", 0)
+                    completion += meta.get("output_tokens", 0)
+        LLM_TOKENS.labels(model, "prompt").inc(prompt)
+        LLM_TOKENS.labels(model, "completion").inc(completion)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._finish(run_id, "error")
+
+    def on_retry(self, retry_state: Any, *, run_id: UUID, **kwargs: Any):
+        model = self._started.get(run_id, (None, "unknown"))[1]
+        LLM_RETRIES.labels(model).inc()
+
+
+llm_metrics_handler = LLMMetricsHandler()
+
+
+class CacheStatsCollector:
+    """Exposes the `stats()` of in-process caches (LLM responses, query embeddings)"""
+
+    def __init__(self):
+        self.caches: Dict[str, Callable[[], Optional[Dict[str, Any]]]] = {}
+
+    def register(self, name: str, stats: Callable[[], Optional[Dict[str, Any]]]):
+        self.caches[name] = stats
+
+    def collect(self):
+        lookups = CounterMetricFamily("diagnosis_cache_lookups", "Cache lookups", labels=["cache", "result"])
+        entries = GaugeMetricFamily("diagnosis_cache_entries", "Entries held by a cache", labels=["cache"])
+        for name, stats_fn in self.caches.items():
+            stats = stats_fn()
+            if not stats:
+                continue
+            lookups.add_metric([name, "hit"], stats.get("hits", 0))
+            lookups.add_metric([name, "miss"], stats.get("misses", 0))
+            # Only some caches have a second tier or can be bypassed
+            for result, key in (("backing_hit", "backing_hits"), ("bypass", "bypassed")):
+                if key in stats:
+                    lookups.add_metric([name, result], stats[key])
+            entries.add_metric([name], stats.get("entries", 0))
+        yield lookups
+        yield entries
+
+
+cache_stats = CacheStatsCollector()
+registry.register(cache_stats)
+
+
+def render_metrics():
+    return generate_latest(registry), CONTENT_TYPE_LATEST
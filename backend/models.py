@@ -1,9 +1,14 @@
-from pydantic import BaseModel
-from typing import List, Optional, Dict
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional, Dict
 
 class SymptomInput(BaseModel):
     text: str  # Natural language description
     structured: Optional[Dict[str, bool]] = None  # Optional structured input
+    retrieval_backend: Optional[Literal["faiss", "matrix"]] = None  # Defaults to settings.retrieval_backend
+    # "rank_only" skips explanations, follow-ups and the report; "single_shot" asks for all three in one LLM call
+    mode: Literal["full", "rank_only", "single_shot"] = "full"
+    include_timings: bool = False  # Return a per-stage latency breakdown with the response
+    no_cache: bool = False  # Ask the LLM again instead of answering from the response cache
 
 class DiseasePrediction(BaseModel):
     disease: str
@@ -15,6 +20,46 @@ class DiseasePrediction(BaseModel):
 class DiagnosisResponse(BaseModel):
     predictions: List[DiseasePrediction]
     report: str
+    timings: Optional[Dict[str, float]] = None  # Seconds per stage; concurrent LLM calls are summed
+
+class SessionAnswer(BaseModel):
+    text: Optional[str] = None  # Free-text answer; new symptoms are extracted from it
+    symptoms: Optional[Dict[str, bool]] = None  # Symptom -> whether the patient has it
+
+class SessionResponse(DiagnosisResponse):
+    session_id: str
+    structured_symptoms: Dict[str, bool]
+    explanations_generated: int = 0  # Explanations written this turn; the others were reused
+
+class StructuredDiagnosis(BaseModel):
+    """JSON answer expected from the LLM in single-shot mode"""
+    explanations: Dict[str, str]  # Candidate disease -> explanation
+    follow_up_questions: List[str]
+    report: str = Field(min_length=1)
+
+class BatchDiagnosisRequest(BaseModel):
+    items: List[SymptomInput]
+    max_concurrency: Optional[int] = None  # LLM calls in flight for the whole batch
+
+class BatchItemResult(BaseModel):
+    predictions: Optional[List[DiseasePrediction]] = None
+    report: Optional[str] = None
+    error: Optional[str] = None
+
+class BatchDiagnosisResponse(BaseModel):
+    results: List[BatchItemResult]
+
+class CaseInput(BaseModel):
+    symptoms: List[str]  # Symptom names as in the dataset, e.g. "skin_rash" or "skin rash"
+    prognosis: str
+
+class CaseIngestRequest(BaseModel):
+    cases: List[CaseInput]
+
+class CaseIngestResponse(BaseModel):
+    ingested: int
+    total_cases: int
+    pending_compaction: int  # Ingested cases not yet folded into the snapshot
 
 class EvaluationResult(BaseModel):
     accuracy: float
@@ -1,28 +1,47 @@
 from evaluation import MedicalDiagnosisEvaluator
+import argparse
+import os
 import pandas as pd
 
 def main():
+    parser = argparse.ArgumentParser(description="Evaluate the diagnosis pipeline on a labelled test set")
+    parser.add_argument("--test-csv", default="D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\new_test_set.csv")
+    parser.add_argument("--output-dir", default="D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET")
+    parser.add_argument("--workers", type=int, default=4, help="Test cases diagnosed concurrently")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Predictions JSONL to resume from (default: <output-dir>/predictions.jsonl); "
+                             "it is started over when mode, backend or index differ")
+    parser.add_argument("--backend", choices=["faiss", "matrix"], default=None, help="Retrieval backend")
+    parser.add_argument("--mode", choices=["rank_only", "full", "single_shot"], default="rank_only",
+                        help="rank_only scores retrieval without any LLM calls; full runs every agent")
+    parser.add_argument("--sample-size", type=int, default=None)
+    args = parser.parse_args()
+
     # Initialize evaluator
-    evaluator = MedicalDiagnosisEvaluator("D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\new_test_set.csv")
-    
-    # Run evaluation on a sample 
-    metrics = evaluator.evaluate()
-    
+    evaluator = MedicalDiagnosisEvaluator(
+        args.test_csv,
+        retrieval_backend=args.backend,
+        mode=args.mode,
+        workers=args.workers,
+        checkpoint_path=args.checkpoint or os.path.join(args.output_dir, "predictions.jsonl")
+    )
+
+    # Every case is diagnosed once; all reports below reuse those predictions
+    metrics = evaluator.evaluate(args.sample_size)
+
     print("\nEvaluation Metrics:")
     print(f"Accuracy: {metrics['accuracy']:.2%}")
     print(f"Precision: {metrics['precision']:.2%}")
     print(f"Recall (True Positive Rate): {metrics['recall']:.2%}")
     print(f"F1 Score: {metrics['f1']:.2%}")
-    
-    # Get confusion matrix
-    confusion_matrix = evaluator.save_confusion_matrix()
-    
+
     # Save results
-    pd.DataFrame([metrics]).to_csv("D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\evaluation_metrics.csv")
-    confusion_matrix.to_csv("D:\\MAYNOOTH\\SEM 2\\SUMMER PROJECT\\DATASET\\confusion_matrix.csv")
-    
-    print("\nConfusion matrix saved for analysis")
+    pd.DataFrame([metrics]).to_csv(os.path.join(args.output_dir, "evaluation_metrics.csv"))
+    evaluator.save_confusion_matrix(os.path.join(args.output_dir, "confusion_matrix.csv"), args.sample_size)
+    evaluator.classification_report(args.sample_size).to_csv(os.path.join(args.output_dir, "classification_report.csv"))
+
+    print("\nConfusion matrix and per-class report saved for analysis")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
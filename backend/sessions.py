@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+import uuid
+import weakref
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+from agents import (AgentState, DiagnosisResources, build_diagnosis_chain, configurable, extract_symptoms,
+                    make_initial_state, request_config)
+from config import settings
+from knowledge_base import normalize_symptom_name
+from models import SessionAnswer, SymptomInput
+
+logger = logging.getLogger(__name__)
+
+
+def session_serializer() -> Optional[JsonPlusSerializer]:
+    """Checkpoint serializer that may restore the predictions kept in session state"""
+    try:
+        return JsonPlusSerializer(allowed_msgpack_modules=[("models", "DiseasePrediction")])
+    except TypeError:
+        # Older langgraph restores any type without being told
+        return None
+
+
+@asynccontextmanager
+async def open_checkpointer(store: Optional[str] = None):
+    """The LangGraph checkpointer sessions are saved in, open for the duration of the block
+
+    Yields None when sessions can't work: with several workers, a session kept
+    in one worker's memory would be unknown to the others.
+    """
+    store = store or settings.session_store
+    serde = session_serializer()
+    if settings.workers > 1 and store != "sqlite":
+        logger.warning("Sessions are disabled: %d workers need SESSION_STORE=sqlite, not %r", settings.workers, store)
+        yield None
+        return
+    if store == "sqlite":
+        async with AsyncSqliteSaver.from_conn_string(settings.session_db_path) as saver:
+            if serde is not None:
+                saver.serde = serde
+            yield saver
+        return
+    if store != "memory":
+        raise ValueError(f"Unknown session store {store!r}, expected 'memory' or 'sqlite'")
+    yield MemorySaver(serde=serde)
+
+
+class UnknownSession(Exception):
+    """No saved state for this session id: it never existed or has expired"""
+
+
+# Checkpoint metadata key with the wall-clock time of the run that wrote the checkpoint
+LAST_USED = "session_last_used"
+
+
+class DiagnosisSessions:
+    """Multi-turn consultations on top of a checkpointed diagnosis graph
+
+    A session is a LangGraph thread. Answering a follow-up question merges the
+    new symptoms into the saved state and resumes the graph after symptom
+    extraction: retrieval and reranking run again (they are cheap), while
+    candidates whose evidence is unchanged keep their explanation.
+
+    Every run stamps its checkpoints with the time it was made, so idle
+    sessions expire across restarts and whichever worker wrote them.
+    """
+
+    def __init__(self, resources: DiagnosisResources, checkpointer, ttl: Optional[float] = None):
+        self.chain = build_diagnosis_chain(resources=resources, checkpointer=checkpointer)
+        self.checkpointer = checkpointer
+        self.ttl = settings.session_ttl if ttl is None else ttl
+        self._next_expiry = 0.0
+        # One answer at a time per session; locks go away with their last user
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def config(session_id: str, config: Optional[RunnableConfig] = None) -> RunnableConfig:
+        config = config or {}
+        return {
+            **config,
+            "configurable": {**configurable(config), "thread_id": session_id},
+            "metadata": {**(config.get("metadata") or {}), LAST_USED: time.time()}
+        }
+
+    async def start(self, symptoms: SymptomInput, config: Optional[RunnableConfig] = None) -> Tuple[str, AgentState]:
+        await self.expire()
+        session_id = uuid.uuid4().hex
+        run_config = self.config(session_id, request_config(symptoms, config))
+        state = await self.chain.ainvoke(make_initial_state(symptoms), run_config)
+        return session_id, state
+
+    async def get(self, session_id: str) -> Optional[AgentState]:
+        snapshot = await self.chain.aget_state(self.config(session_id))
+        # Unknown threads come back with empty values
+        return snapshot.values or None
+
+    async def answer(self, session_id: str, answer: SessionAnswer,
+                     config: Optional[RunnableConfig] = None) -> Tuple[AgentState, int]:
+        """Apply a follow-up answer; returns the new state and how many explanations were written
+
+        Raises UnknownSession for an unknown session.
+        """
+        lock = self._locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            state = await self.get(session_id)
+            if state is None:
+                raise UnknownSession(session_id)
+
+            new = {normalize_symptom_name(name): bool(present) for name, present in (answer.symptoms or {}).items()}
+            text = (answer.text or "").strip()
+            if text:
+                extracted = await extract_symptoms(
+                    {"input": text, "structured_symptoms": {}}, config, resources=self.chain.resources
+                )
+                # Explicit yes/no answers win over what was read from the text
+                new = {**extracted.get("structured_symptoms", {}), **new}
+            merged = {**state["structured_symptoms"], **new}
+            if merged == state["structured_symptoms"] and state.get("report"):
+                return state, 0
+
+            # Resume as if extraction had produced the merged symptoms; everything after it re-runs
+            run_config = self.config(session_id, config)
+            await self.chain.aupdate_state(run_config, {
+                "input": f"{state['input']}\n{text}" if text else state["input"],
+                "structured_symptoms": merged,
+                "retrieved_diseases": []
+            }, as_node="extract_symptoms")
+            result = await self.chain.ainvoke(None, run_config)
+            generated = set(result.get("explanations") or {}) - set(state.get("explanations") or {})
+            return result, len(generated)
+
+    async def expire(self):
+        """Delete sessions nobody has used for longer than the TTL
+
+        Goes through every saved checkpoint, so it runs at most once per
+        tenth of the TTL.
+        """
+        if not self.ttl or self.ttl <= 0:
+            return
+        now = time.time()
+        if now < self._next_expiry:
+            return
+        self._next_expiry = now + self.ttl / 10
+
+        last_used: Dict[str, float] = {}
+        async for checkpoint in self.checkpointer.alist(None):
+            session_id = checkpoint.config["configurable"]["thread_id"]
+            used = (checkpoint.metadata or {}).get(LAST_USED, 0.0)
+            last_used[session_id] = max(used, last_used.get(session_id, 0.0))
+        for session_id, used in last_used.items():
+            # Leave sessions alone while an answer is being applied to them
+            if used < now - self.ttl and session_id not in self._locks:
+                await self.checkpointer.adelete_thread(session_id)
@@ -0,0 +1,73 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key onto one execution
+
+    The first caller for a key starts the work; callers arriving while it runs
+    await the same task and get the same result (or exception). A caller that
+    gives up only detaches itself; the work is cancelled once nobody is waiting.
+    Successful results can be held for `hold_seconds` so a burst just after
+    completion is answered too.
+    """
+
+    def __init__(self, hold_seconds: float = 0.0, max_held: int = 1024):
+        self.hold_seconds = hold_seconds
+        self.max_held = max_held
+        self._inflight: Dict[Hashable, Tuple[asyncio.Task, list]] = {}
+        self._held: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.executions = 0
+        self.coalesced = 0
+        self.held_hits = 0
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable]) -> Any:
+        held = self._held.get(key)
+        if held is not None:
+            if held[0] > time.monotonic():
+                self.held_hits += 1
+                return held[1]
+            del self._held[key]
+
+        if key in self._inflight:
+            task, waiters = self._inflight[key]
+            self.coalesced += 1
+        else:
+            task, waiters = asyncio.ensure_future(factory()), [0]
+            self._inflight[key] = (task, waiters)
+            task.add_done_callback(lambda t: self._finish(key, t))
+            self.executions += 1
+
+        waiters[0] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if waiters[0] == 1 and not task.done():
+                # Last one out: nobody wants this result any more
+                task.cancel()
+            raise
+        finally:
+            waiters[0] -= 1
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key, (None,))[0] is task:
+            del self._inflight[key]
+        if self.hold_seconds <= 0 or self.max_held <= 0 or task.cancelled() or task.exception() is not None:
+            return
+        self._held[key] = (time.monotonic() + self.hold_seconds, task.result())
+        self._held.move_to_end(key)
+        while len(self._held) > self.max_held:
+            self._held.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._held),
+            "inflight": len(self._inflight),
+            "executions": self.executions,
+            "hits": self.coalesced + self.held_hits,
+            "misses": self.executions,
+            "coalesced": self.coalesced,
+            "held_hits": self.held_hits
+        }
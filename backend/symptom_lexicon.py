@@ -0,0 +1,214 @@
+import re
+from difflib import get_close_matches
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from knowledge_base import normalize_symptom_name
+
+# Everyday phrasings for dataset columns; column names themselves are always matched
+SYNONYMS: Dict[str, List[str]] = {
+    "itching": ["itch", "itchy", "itchiness", "pruritus"],
+    "skin_rash": ["rash", "skin eruption", "skin rash"],
+    "continuous_sneezing": ["sneezing", "sneeze", "keep sneezing"],
+    "shivering": ["shivers", "trembling"],
+    "chills": ["chill", "feeling cold", "cold sweats"],
+    "joint_pain": ["joint ache", "aching joints", "sore joints", "arthralgia"],
+    "stomach_pain": ["stomach ache", "stomachache", "stomach cramps", "tummy ache"],
+    "acidity": ["heartburn", "acid reflux"],
+    "ulcers_on_tongue": ["tongue ulcers", "mouth ulcers"],
+    "vomiting": ["vomit", "throwing up", "threw up", "puking", "emesis"],
+    "burning_micturition": ["burning urination", "burning when urinating", "painful urination", "dysuria"],
+    "fatigue": ["tired", "tiredness", "exhausted", "exhaustion", "fatigued", "worn out"],
+    "weight_gain": ["gaining weight", "put on weight"],
+    "anxiety": ["anxious", "nervousness"],
+    "mood_swings": ["mood changes"],
+    "weight_loss": ["losing weight", "lost weight"],
+    "restlessness": ["restless"],
+    "lethargy": ["lethargic", "sluggish"],
+    "irregular_sugar_level": ["irregular blood sugar", "unstable blood sugar"],
+    "cough": ["coughing", "coughs"],
+    "high_fever": ["fever", "high temperature", "febrile", "pyrexia", "temperature"],
+    "sunken_eyes": ["hollow eyes"],
+    "breathlessness": ["shortness of breath", "short of breath", "breathless", "difficulty breathing",
+                       "trouble breathing", "dyspnea", "dyspnoea"],
+    "sweating": ["sweats", "sweaty", "night sweats", "perspiration"],
+    "dehydration": ["dehydrated"],
+    "indigestion": ["dyspepsia", "upset stomach"],
+    "headache": ["head ache", "head pain", "headaches", "migraine pain"],
+    "yellowish_skin": ["yellow skin", "skin turning yellow"],
+    "dark_urine": ["dark pee", "brown urine"],
+    "nausea": ["nauseous", "nauseated", "queasy", "feel sick", "feeling sick"],
+    "loss_of_appetite": ["no appetite", "poor appetite", "not hungry", "lost my appetite"],
+    "pain_behind_the_eyes": ["eye pain", "pain behind eyes"],
+    "back_pain": ["backache", "back ache", "sore back"],
+    "constipation": ["constipated"],
+    "abdominal_pain": ["abdominal cramps", "belly ache", "tummy pain"],
+    "diarrhoea": ["diarrhea", "loose stools", "loose motions", "runny stools"],
+    "mild_fever": ["slight fever", "low grade fever", "low fever"],
+    "yellowing_of_eyes": ["yellow eyes"],
+    "swelled_lymph_nodes": ["swollen lymph nodes", "swollen glands"],
+    "malaise": ["unwell", "feeling unwell"],
+    "blurred_and_distorted_vision": ["blurred vision", "blurry vision", "distorted vision"],
+    "phlegm": ["mucus"],
+    "throat_irritation": ["sore throat", "scratchy throat", "throat pain"],
+    "redness_of_eyes": ["red eyes", "bloodshot eyes"],
+    "sinus_pressure": ["sinus pain"],
+    "runny_nose": ["running nose", "runny nostrils"],
+    "congestion": ["stuffy nose", "blocked nose", "nasal congestion"],
+    "chest_pain": ["chest ache", "chest tightness", "pain in chest", "pain in my chest"],
+    "fast_heart_rate": ["racing heart", "rapid heartbeat", "tachycardia"],
+    "bloody_stool": ["blood in stool", "blood in my stool"],
+    "neck_pain": ["sore neck"],
+    "dizziness": ["dizzy", "lightheaded", "light headed", "vertigo"],
+    "cramps": ["cramping"],
+    "bruising": ["bruises", "bruise easily"],
+    "obesity": ["obese", "overweight"],
+    "swollen_legs": ["leg swelling", "swelling in legs"],
+    "puffy_face_and_eyes": ["puffy face", "puffy eyes"],
+    "excessive_hunger": ["always hungry", "constant hunger"],
+    "slurred_speech": ["slurring words"],
+    "knee_pain": ["sore knee", "knee ache"],
+    "stiff_neck": ["neck stiffness"],
+    "swelling_joints": ["swollen joints", "joint swelling"],
+    "spinning_movements": ["room spinning"],
+    "loss_of_balance": ["off balance", "losing balance"],
+    "unsteadiness": ["unsteady"],
+    "loss_of_smell": ["can't smell", "cannot smell", "anosmia"],
+    "foul_smell_of_urine": ["smelly urine", "foul smelling urine"],
+    "continuous_feel_of_urine": ["frequent urge to urinate", "constant urge to urinate"],
+    "passage_of_gases": ["flatulence", "passing gas", "gassy"],
+    "depression": ["depressed", "low mood"],
+    "irritability": ["irritable"],
+    "muscle_pain": ["muscle ache", "muscle aches", "sore muscles", "body ache", "body aches", "myalgia"],
+    "muscle_weakness": ["weak muscles"],
+    "red_spots_over_body": ["red spots"],
+    "belly_pain": ["belly pain"],
+    "watering_from_eyes": ["watery eyes", "teary eyes"],
+    "increased_appetite": ["eating more"],
+    "polyuria": ["frequent urination", "urinating a lot", "peeing a lot"],
+    "lack_of_concentration": ["can't concentrate", "poor concentration", "trouble concentrating"],
+    "visual_disturbances": ["vision problems"],
+    "coma": ["unconscious"],
+    "palpitations": ["heart pounding", "fluttering heart"],
+    "pus_filled_pimples": ["pimples", "acne"],
+    "skin_peeling": ["peeling skin"],
+    "blister": ["blisters"],
+}
+
+STOPWORDS = frozenset("""
+a about after all also am an and any are as at be been being but by can could day days did do does
+feel feeling feels few for from get getting got had has have having he her i im i'm ive i've in is it
+its just last like lot lots me mild my of on or past quite really severe she since slight so some
+sometimes started still that the their them there they this today too very was we week weeks were
+what when which while with yesterday you your
+""".split())
+
+NEGATIONS = frozenset(["no", "not", "without", "denies", "deny", "never", "nor", "dont", "don't"])
+PUNCTUATION = frozenset(".,;:!?")
+# Negation reaches back over a few words but never past one of these
+CLAUSE_BREAKS = frozenset(["but", "though", "although", "however"]) | PUNCTUATION
+_END = "$"
+
+
+def tokenize(text: str) -> List[str]:
+    """Words, plus the punctuation that ends a clause as tokens of its own"""
+    return re.findall(r"[a-z]+(?:'[a-z]+)?|[.,;:!?]", text.lower())
+
+
+def stem(token: str) -> str:
+    # Enough to fold plurals ("rashes", "aches") onto the singular
+    if len(token) > 4 and token.endswith("es") and not token.endswith("ses"):
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+class SymptomLexicon:
+    """Maps free text to dataset symptom columns without calling the LLM
+
+    Phrases are compiled into a token trie and matched leftmost-longest in one
+    pass; tokens that aren't in the vocabulary are snapped to a close spelling.
+    """
+
+    def __init__(self, symptoms: Iterable[str], synonyms: Optional[Dict[str, List[str]]] = None):
+        self.symptoms = [normalize_symptom_name(s) for s in symptoms]
+        known = set(self.symptoms)
+        self.trie: Dict = {}
+        self.vocabulary = set()
+
+        for name in self.symptoms:
+            self._add(name.replace("_", " "), name)
+        for name, phrases in (SYNONYMS if synonyms is None else synonyms).items():
+            if name in known:
+                for phrase in phrases:
+                    self._add(phrase, name)
+
+        self._vocab_list = sorted(self.vocabulary)
+        self._correct = lru_cache(maxsize=4096)(self._correct_uncached)
+
+    def _add(self, phrase: str, name: str):
+        node = self.trie
+        for token in map(stem, (t for t in tokenize(phrase) if t not in PUNCTUATION)):
+            self.vocabulary.add(token)
+            node = node.setdefault(token, {})
+        node[_END] = name
+
+    def _correct_uncached(self, token: str) -> str:
+        token = stem(token)
+        if token in self.vocabulary or len(token) < 5:
+            return token
+        match = get_close_matches(token, self._vocab_list, n=1, cutoff=0.85)
+        return match[0] if match else token
+
+    def match(self, text: str) -> Tuple[Dict[str, bool], float]:
+        """Return (canonical symptoms found, share of content words they cover)
+
+        A negated mention ("no fever") maps to False, unless the same symptom
+        is also mentioned without negation.
+        """
+        raw = tokenize(text)
+        tokens = [self._correct(t) for t in raw]
+        found: Dict[str, bool] = {}
+        covered = set()
+
+        i = 0
+        while i < len(tokens):
+            node, end, name = self.trie, None, None
+            j = i
+            while j < len(tokens) and tokens[j] in node:
+                node = node[tokens[j]]
+                j += 1
+                if _END in node:
+                    end, name = j, node[_END]
+            if name is None:
+                i += 1
+                continue
+
+            covered.update(range(i, end))
+            found[name] = found.get(name, False) or not self._negated(raw, i)
+            i = end
+
+        content = [k for k, t in enumerate(raw) if t not in STOPWORDS and t not in NEGATIONS and t not in PUNCTUATION]
+        coverage = sum(1 for k in content if k in covered) / len(content) if content else 0.0
+        return found, coverage
+
+    @staticmethod
+    def _negated(raw: List[str], start: int) -> bool:
+        for token in reversed(raw[max(0, start - 4):start]):
+            if token in CLAUSE_BREAKS:
+                return False
+            if token in NEGATIONS:
+                return True
+        return False
+
+    def canonicalize(self, terms: Iterable[str]) -> Dict[str, bool]:
+        """Map free-form symptom terms (e.g. LLM output) to columns, keeping unmatched terms as-is"""
+        structured: Dict[str, bool] = {}
+        for term in terms:
+            found, _ = self.match(term)
+            if found:
+                structured.update(found)
+            elif term.strip():
+                structured[term.strip().lower()] = True
+        return structured
@@ -0,0 +1,118 @@
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from knowledge_base import MappedCaseDocstore, load_case_table, normalize_symptom_name, resolve_snapshot
+
+METRICS = ("jaccard", "overlap", "idf")
+
+
+class SymptomMatrixRetriever:
+    """Exact retrieval over the 0/1 symptom matrix of the training set
+
+    Every case is a row of a dense uint8 matrix, so scoring a batch of query
+    vectors against the whole corpus is a single matrix product. Built from
+    the index snapshot, the matrix and the per-case arrays are the snapshot's
+    memory-mapped files, which all workers on a host share.
+    """
+
+    def __init__(self, symptoms: Sequence[str], matrix: np.ndarray, prognoses: Sequence,
+                 support: Optional[Sequence[int]] = None, diseases: Optional[Sequence[str]] = None):
+        """`prognoses` are disease names per case, or codes into `diseases` when that is given"""
+        self.symptoms = list(symptoms)
+        self.column_index = {name: i for i, name in enumerate(self.symptoms)}
+        # No copy for the snapshot's mapped uint8 array
+        self.matrix = np.asarray(matrix, dtype=np.uint8)
+        if diseases is None:
+            diseases, prognoses = np.unique(np.asarray(prognoses, dtype=object), return_inverse=True)
+        self.diseases = list(diseases)
+        self.prognosis_codes = np.asarray(prognoses, dtype=np.int32)
+        # Number of identical training rows behind each case
+        self.support = np.ones(len(self.matrix), dtype=np.int32) if support is None else np.asarray(support, dtype=np.int32)
+
+        self.row_sizes = self.matrix.sum(axis=1, dtype=np.float32)
+        # Smoothed inverse document frequency: rare symptoms carry more evidence
+        doc_freq = self.matrix.sum(axis=0, dtype=np.float32)
+        self.idf = np.log((1 + len(self.matrix)) / (1 + doc_freq)).astype(np.float32) + 1.0
+        self.row_idf_mass = self.matrix @ self.idf
+
+    @classmethod
+    def from_csv(cls, csv_path: str) -> "SymptomMatrixRetriever":
+        symptoms, prognosis, support = load_case_table(csv_path)
+        return cls(symptoms.columns, symptoms.to_numpy(), prognosis.to_numpy(), support.to_numpy())
+
+    @classmethod
+    def from_snapshot(cls, index_dir: str) -> "SymptomMatrixRetriever":
+        """The cases of an index snapshot (compacted ingested cases included), read through mmap"""
+        cases = MappedCaseDocstore(resolve_snapshot(index_dir))
+        return cls(cases.symptom_names, cases.symptoms, cases.prognosis, cases.support, diseases=cases.diseases)
+
+    def encode(self, structured: Dict[str, bool], ruled_out_weight: float = 0.0) -> np.ndarray:
+        """Query vector: 1 for present symptoms, -ruled_out_weight for ruled-out ones
+
+        Symptoms that aren't dataset columns are ignored.
+        """
+        vector = np.zeros(len(self.symptoms), dtype=np.float32)
+        for name, present in structured.items():
+            idx = self.column_index.get(normalize_symptom_name(name))
+            if idx is not None:
+                vector[idx] = 1.0 if present else -ruled_out_weight
+        return vector
+
+    def score(self, queries: np.ndarray, metric: str = "idf") -> np.ndarray:
+        """Similarity of each query row against every case, shape (n_queries, n_cases)
+
+        Negative query entries (ruled-out symptoms) take their weight off the
+        intersection of every case that has them, without changing the union.
+        """
+        queries = np.atleast_2d(queries).astype(np.float32, copy=False)
+        present = np.maximum(queries, 0.0)
+        # Weights go on the query side, so the shared case matrix is only ever read
+        if metric == "idf":
+            intersection, matched = np.vsplit(np.vstack([queries * self.idf, present * self.idf]) @ self.matrix.T, 2)
+            query_mass = (present @ self.idf)[:, None]
+            union = query_mass + self.row_idf_mass[None, :] - matched
+        elif metric == "jaccard":
+            intersection, matched = np.vsplit(np.vstack([queries, present]) @ self.matrix.T, 2)
+            union = present.sum(axis=1)[:, None] + self.row_sizes[None, :] - matched
+        elif metric == "overlap":
+            intersection = queries @ self.matrix.T
+            union = np.minimum(present.sum(axis=1)[:, None], self.row_sizes[None, :])
+        else:
+            raise ValueError(f"Unknown matrix metric {metric!r}, expected one of {METRICS}")
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = np.where(union > 0, intersection / union, 0.0)
+        return scores.astype(np.float32, copy=False)
+
+    def search(self, structured: Dict[str, bool], k: int = 4, metric: str = "idf",
+               ruled_out_weight: float = 0.0) -> List[Dict]:
+        return self.search_batch([structured], k=k, metric=metric, ruled_out_weight=ruled_out_weight)[0]
+
+    def search_batch(self, queries: Iterable[Dict[str, bool]], k: int = 4, metric: str = "idf",
+                     ruled_out_weight: float = 0.0) -> List[List[Dict]]:
+        """Top-k cases for each query, in the same shape `retrieve_diseases` produces"""
+        queries = list(queries)
+        if not queries:
+            return []
+        scores = self.score(np.stack([self.encode(q, ruled_out_weight) for q in queries]), metric)
+        k = min(k, scores.shape[1])
+
+        # argpartition keeps this linear in the corpus size; only the k winners get sorted
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row_scores, candidates in zip(scores, top):
+            ranked = candidates[np.argsort(-row_scores[candidates], kind="stable")]
+            results.append([self._hit(i, float(row_scores[i])) for i in ranked if row_scores[i] > 0])
+        return results
+
+    def _hit(self, row: int, score: float) -> Dict:
+        symptoms = [self.symptoms[j] for j in np.flatnonzero(self.matrix[row])]
+        prognosis = self.diseases[self.prognosis_codes[row]]
+        return {
+            "disease": prognosis,
+            "symptoms": symptoms,
+            "score": round(score, 4),
+            "support": int(self.support[row]),
+            "content": f"Patient presents with: {', '.join(symptoms)}.\nMost likely diagnosis: {prognosis}."
+        }
@@ -0,0 +1,19 @@
+import asyncio
+
+import numpy as np
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from embedding_cache import CachedQueryEmbeddings
+
+
+def test_vectors_are_float32_and_counted_by_their_bytes():
+    cache = CachedQueryEmbeddings(DeterministicFakeEmbedding(size=64), max_bytes=3 * 64 * 4)
+    vectors = cache.embed_queries(["cough, fever", "headache", "fever, cough"])
+    assert all(v.dtype == np.float32 and not v.flags.writeable for v in vectors)
+    assert np.array_equal(vectors[0], vectors[2])
+    assert cache.stats()["bytes"] == 2 * 64 * 4
+
+    asyncio.run(cache.aembed_query("nausea"))
+    cache.embed_query("rash")
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["evictions"]) == (3, 3 * 64 * 4, 1)
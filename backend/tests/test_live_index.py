@@ -0,0 +1,79 @@
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from knowledge_base import load_snapshot, read_snapshot_meta, save_snapshot
+from live_index import DeltaLog, LiveCaseIndex, LiveSymptomMatrix
+
+CASES = (["cough", "high_fever"], np.array([[1, 0], [1, 1]]), ["Common Cold"], np.array([0, 0]), np.array([1, 1]))
+
+
+def record(prognosis):
+    return {"symptoms": ["cough"], "prognosis": prognosis, "model": "other", "vector": [0.0]}
+
+
+def live_index(tmp_path):
+    embeddings = DeterministicFakeEmbedding(size=8)
+    index_dir = str(tmp_path / "index")
+    vectorstore = FAISS.from_texts(["cough", "cough, high fever"], embeddings)
+    save_snapshot(vectorstore, index_dir, "fingerprint", "model", CASES)
+    return LiveCaseIndex(load_snapshot(index_dir, embeddings), index_dir, str(tmp_path / "delta"), "model")
+
+
+def test_truncated_logs_keep_their_offsets(tmp_path):
+    log = DeltaLog(str(tmp_path))
+    log.append([record("A"), record("B")])
+    _, middle = log.read(0, 1)
+    log.append([record("C")])
+    end = log.end()
+
+    log.truncate(middle)
+    records, offset = log.read(middle)
+    assert [r["prognosis"] for r in records] == ["B", "C"]
+    assert (offset, log.end()) == (end, end)
+    # Offsets from before the cut come back empty until the reader reloads the snapshot
+    assert log.read(0) == ([], 0)
+    assert open(log.path).read().count("\n") == 3
+
+
+def test_compaction_truncates_the_log(tmp_path):
+    index = live_index(tmp_path)
+    index.add_cases([(["cough", "chills"], "Flu"), (["headache"], "Migraine")])
+    end = index.log.end()
+
+    assert index.compact() == 2
+    assert read_snapshot_meta(index.index_dir)["compacted_through"] == end
+    assert index.log.read(end) == ([], end)
+    assert open(index.log.path).read().count("\n") == 1
+    assert (len(index), index.delta_size) == (4, 0)
+
+    index.add_cases([(["cough"], "Flu")])
+    # A process starting now replays only what came after the compaction
+    restarted = LiveCaseIndex(load_snapshot(index.index_dir, index.embeddings), index.index_dir,
+                              index.log.directory, "model")
+    assert (len(restarted), restarted.delta_size) == (5, 1)
+
+
+def test_compaction_without_a_snapshot_keeps_the_cases(tmp_path):
+    base = FAISS.from_texts(["cough"], DeterministicFakeEmbedding(size=8))
+    index = LiveCaseIndex(base, str(tmp_path / "missing"), str(tmp_path / "delta"), "model")
+    index.add_cases([(["cough", "chills"], "Flu")])
+
+    assert index.compact() == 0
+    assert (len(index), index.delta_size) == (2, 1)
+    assert len(index.log.read(0)[0]) == 1
+
+
+def test_matrix_backend_sees_ingested_cases(tmp_path):
+    index = live_index(tmp_path)
+    matrix = LiveSymptomMatrix(index.index_dir, index.log.directory)
+    index.add_cases([(["chills"], "Malaria")])
+    assert matrix.search({"chills": True}, k=1) == []
+
+    matrix.sync()
+    assert matrix.search({"chills": True}, k=1)[0]["disease"] == "Malaria"
+    # Still there once compaction has moved it into the snapshot and cut the log
+    index.compact()
+    matrix.sync()
+    assert matrix.search({"chills": True}, k=1)[0]["disease"] == "Malaria"
+    assert len(matrix.matrix) == 3
@@ -0,0 +1,41 @@
+import asyncio
+
+from langchain_core.language_models import FakeListChatModel
+
+from agents import llm_slot
+from llm_cache import LRUResponseCache, SQLiteResponseCache
+
+
+def test_sqlite_tier_survives_a_new_memory_cache(tmp_path):
+    path = str(tmp_path / "llm.sqlite")
+    first = FakeListChatModel(responses=["first", "second"], cache=LRUResponseCache(backing=SQLiteResponseCache(path)))
+    assert first.invoke("prompt").content == "first"
+
+    # Another worker, or the same one after a restart
+    cache = LRUResponseCache(backing=SQLiteResponseCache(path))
+    second = FakeListChatModel(responses=["first", "second"], cache=cache)
+    second.i = 1
+    assert second.invoke("prompt").content == "first"
+    assert second.invoke("prompt").content == "first"
+    assert (cache.stats()["backing_hits"], cache.stats()["hits"]) == (1, 1)
+
+
+def test_sqlite_entries_expire(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / "llm.sqlite"), ttl=-1)
+    cache.update("prompt", "llm", [])
+    assert cache.lookup("prompt", "llm") is None
+
+
+def test_no_cache_requests_skip_lookups_but_refresh_the_cache():
+    cache = LRUResponseCache()
+    model = FakeListChatModel(responses=["first", "second"], cache=cache)
+
+    async def ask(config):
+        async with llm_slot(config):
+            return (await model.ainvoke("prompt")).content
+
+    async def run():
+        return [await ask({}), await ask({"configurable": {"no_cache": True}}), await ask({})]
+
+    assert asyncio.run(run()) == ["first", "second", "second"]
+    assert cache.stats()["bypassed"] == 1
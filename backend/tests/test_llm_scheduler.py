@@ -0,0 +1,84 @@
+import asyncio
+
+import httpx
+from langchain_groq import ChatGroq
+
+from fake_llm_endpoint import create_fake_llm_app
+from llm_scheduler import LLMScheduler, PriorityLimiter, ScheduledChatModel, TokenBucket, llm_priority
+
+
+async def take_in_order(limiter, waiters):
+    """Queue (name, priority) waiters behind a held slot and return the order they were let through"""
+    order = []
+
+    async def wait(name, priority):
+        await limiter.acquire(priority)
+        order.append(name)
+        limiter.release()
+
+    tasks = []
+    for name, priority in waiters:
+        tasks.append(asyncio.create_task(wait(name, priority)))
+        await asyncio.sleep(0)
+    return tasks, order
+
+
+def test_free_slots_go_to_the_most_urgent_waiter():
+    async def run():
+        limiter = PriorityLimiter(1)
+        await limiter.acquire(0)
+        tasks, order = await take_in_order(limiter, [("evaluation", 2), ("batch", 1), ("interactive", 0)])
+        limiter.release()
+        await asyncio.gather(*tasks)
+        return order, limiter.active
+
+    assert asyncio.run(run()) == (["interactive", "batch", "evaluation"], 0)
+
+
+def test_rate_budget_goes_to_the_most_urgent_waiter():
+    async def run():
+        # Ten requests a second, one at a time: slots are free but the budget is not
+        limiter = PriorityLimiter(4, requests=TokenBucket(600, capacity=1))
+        await limiter.acquire(0)
+        limiter.release()
+        tasks, order = await take_in_order(limiter, [("batch", 1), ("interactive", 0)])
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["interactive", "batch"]
+
+
+def test_cancelled_waiters_give_up_their_place():
+    async def run():
+        limiter = PriorityLimiter(1)
+        await limiter.acquire(0)
+        tasks, order = await take_in_order(limiter, [("cancelled", 0), ("batch", 1)])
+        tasks[0].cancel()
+        limiter.release()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return order, limiter.active
+
+    assert asyncio.run(run()) == (["batch"], 0)
+
+
+def fake_groq(error_rate: float) -> ChatGroq:
+    app = create_fake_llm_app(latency=0.01, tokens=8, error_rate=error_rate, seed=1)
+    transport = httpx.ASGITransport(app=app)
+    return ChatGroq(model_name="fake", api_key="fake", base_url="http://fake", max_retries=0,
+                    http_async_client=httpx.AsyncClient(transport=transport)), app
+
+
+def test_scheduler_retries_rate_limited_calls_against_the_fake_endpoint():
+    inner, app = fake_groq(error_rate=0.5)
+    scheduler = LLMScheduler(max_concurrency=2, max_retries=10, retry_base_delay=0.01, retry_max_delay=0.02)
+    model = ScheduledChatModel(inner=inner, scheduler=scheduler, output_token_estimate=8)
+
+    async def run():
+        with llm_priority("batch"):
+            return await asyncio.gather(*(model.ainvoke(f"prompt {i}") for i in range(6)))
+
+    answers = asyncio.run(run())
+    assert [a.content.split()[0] for a in answers] == ["lorem"] * 6
+    # Some of the calls were answered with 429 and retried
+    assert app.state.requests > 6
+    assert scheduler.limiter.active == 0
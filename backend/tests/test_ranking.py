@@ -0,0 +1,33 @@
+import numpy as np
+
+from agents import rerank
+from symptom_matrix import SymptomMatrixRetriever
+
+SYMPTOMS = ["high_fever", "chills", "sweating", "cough", "headache"]
+MATRIX = np.array([
+    [1, 1, 1, 0, 1],  # Malaria
+    [1, 0, 0, 1, 1],  # Flu
+], dtype=np.float32)
+
+
+def test_ruled_out_symptoms_lower_matrix_scores():
+    matrix = SymptomMatrixRetriever(SYMPTOMS, MATRIX, ["Malaria", "Flu"])
+    query = {"high_fever": True, "headache": True}
+    for metric in ("idf", "jaccard", "overlap"):
+        before = matrix.score(matrix.encode(query), metric)[0]
+        after = matrix.score(matrix.encode({**query, "chills": False}, ruled_out_weight=0.5), metric)[0]
+        assert after[0] < before[0]
+        assert after[1] == before[1]
+
+
+def test_ruled_out_symptoms_penalise_candidates_in_rerank():
+    candidates = [
+        {"disease": "Malaria", "symptoms": ["high_fever", "chills", "sweating", "headache"], "score": 0.6},
+        {"disease": "Flu", "symptoms": ["high_fever", "cough", "headache"], "score": 0.6},
+    ]
+    present = {"high_fever": True, "headache": True}
+    assert rerank(candidates, present)[0]["disease"] == "Flu"
+
+    ranked = rerank(candidates, {**present, "cough": False})
+    assert [c["disease"] for c in ranked] == ["Malaria", "Flu"]
+    assert ranked[1]["confidence"] < rerank(candidates, present)[1]["confidence"]
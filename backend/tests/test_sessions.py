@@ -0,0 +1,93 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from langchain_core.language_models import FakeListChatModel
+
+from agents import DiagnosisResources
+from config import settings
+from models import SessionAnswer, SymptomInput
+import sessions as sessions_module
+from sessions import DiagnosisSessions, UnknownSession, open_checkpointer
+from symptom_matrix import SymptomMatrixRetriever
+
+SYMPTOMS = ["high_fever", "chills", "sweating", "cough", "headache"]
+MATRIX = np.array([[1, 1, 1, 0, 1], [1, 0, 0, 1, 1]])
+
+
+def resources():
+    matrix = SymptomMatrixRetriever(SYMPTOMS, MATRIX, ["Malaria", "Flu"])
+    return DiagnosisResources(llm=FakeListChatModel(responses=["Explanation"]), symptom_matrix=matrix)
+
+
+def symptoms(text):
+    return SymptomInput(text=text, mode="rank_only", retrieval_backend="matrix")
+
+
+def test_no_answer_rules_symptom_out():
+    async def run():
+        async with open_checkpointer("memory") as checkpointer:
+            sessions = DiagnosisSessions(resources(), checkpointer)
+            session_id, _ = await sessions.start(symptoms("fever and headache"))
+            state, _ = await sessions.answer(session_id, SessionAnswer(text="No, I don't have a cough"))
+            return state
+
+    state = asyncio.run(run())
+    assert state["structured_symptoms"]["cough"] is False
+    assert state["predictions"][0].disease == "Malaria"
+
+
+def test_idle_sessions_expire_from_checkpoint_metadata(monkeypatch):
+    async def run():
+        async with open_checkpointer("memory") as checkpointer:
+            # A session written two minutes ago, before a restart
+            monkeypatch.setattr(sessions_module, "time", SimpleNamespace(time=lambda: time.time() - 120))
+            stale_id, _ = await DiagnosisSessions(resources(), checkpointer, ttl=60).start(symptoms("fever"))
+            monkeypatch.setattr(sessions_module, "time", time)
+
+            # The new process has no memory of it, only its checkpoints
+            sessions = DiagnosisSessions(resources(), checkpointer, ttl=60)
+            live_id, _ = await sessions.start(symptoms("cough"))
+            return await sessions.get(stale_id), await sessions.get(live_id)
+
+    stale, live = asyncio.run(run())
+    assert stale is None
+    assert live is not None
+
+
+def test_memory_sessions_are_disabled_with_several_workers(monkeypatch):
+    monkeypatch.setattr(settings, "workers", 2)
+
+    async def run():
+        async with open_checkpointer("memory") as checkpointer:
+            return checkpointer
+
+    assert asyncio.run(run()) is None
+
+
+def test_answer_to_an_unknown_session_is_refused():
+    async def run():
+        async with open_checkpointer("memory") as checkpointer:
+            await DiagnosisSessions(resources(), checkpointer).answer("missing", SessionAnswer(symptoms={"cough": True}))
+
+    with pytest.raises(UnknownSession):
+        asyncio.run(run())
+
+
+def test_sqlite_sessions_survive_a_restart(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "session_db_path", str(tmp_path / "sessions.sqlite"))
+
+    async def run():
+        async with open_checkpointer("sqlite") as checkpointer:
+            session_id, _ = await DiagnosisSessions(resources(), checkpointer).start(symptoms("fever and headache"))
+        # A new process opens the same file
+        async with open_checkpointer("sqlite") as checkpointer:
+            sessions = DiagnosisSessions(resources(), checkpointer)
+            state, _ = await sessions.answer(session_id, SessionAnswer(symptoms={"cough": False}))
+            return state
+
+    state = asyncio.run(run())
+    assert state["structured_symptoms"] == {"high_fever": True, "headache": True, "cough": False}
+    assert state["predictions"][0].disease == "Malaria"
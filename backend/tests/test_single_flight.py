@@ -0,0 +1,31 @@
+import asyncio
+
+from single_flight import SingleFlight
+
+
+def test_single_flight_coalesces_and_cancels_only_when_nobody_waits():
+    async def run():
+        flight = SingleFlight()
+        started = []
+
+        async def work():
+            started.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        callers = [asyncio.create_task(flight.run("key", work)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        callers[0].cancel()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+
+        lonely = asyncio.create_task(flight.run("other", work))
+        await asyncio.sleep(0.01)
+        lonely.cancel()
+        await asyncio.gather(lonely, return_exceptions=True)
+        await asyncio.sleep(0)
+        return results[1:], len(started), flight.stats()
+
+    results, executions, stats = asyncio.run(run())
+    assert results == ["result", "result"]
+    assert executions == 2
+    assert (stats["coalesced"], stats["inflight"]) == (2, 0)
@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from knowledge_base import (RowIds, index_factory_string, load_mapped_vectorstore, read_snapshot_meta, resolve_snapshot,
+                            save_snapshot)
+from symptom_matrix import SymptomMatrixRetriever
+
+CASES = (["cough", "high_fever"], np.array([[1, 0], [1, 1]]), ["Common Cold"], np.array([0, 0]), np.array([1, 1]))
+
+
+def save(index_dir, compacted_through=0):
+    vectorstore = FAISS.from_texts(["cough", "cough, high fever"], DeterministicFakeEmbedding(size=8))
+    save_snapshot(vectorstore, index_dir, "fingerprint", "model", CASES, compacted_through=compacted_through)
+
+
+def test_snapshots_are_swapped_by_flipping_a_symlink(tmp_path):
+    index_dir = str(tmp_path / "index")
+    save(index_dir)
+    first = resolve_snapshot(index_dir)
+    for offset in (10, 20):
+        save(index_dir, compacted_through=offset)
+
+    assert os.path.islink(index_dir)
+    assert read_snapshot_meta(index_dir)["compacted_through"] == 20
+    # The current snapshot and the one before it, for readers that resolved it before the swap
+    versions = sorted(p for p in os.listdir(tmp_path) if p.startswith("index."))
+    assert len(versions) == 2
+    assert os.path.basename(resolve_snapshot(index_dir)) in versions
+    assert not os.path.exists(first)
+
+
+def test_plain_snapshot_directories_are_moved_aside(tmp_path):
+    index_dir = str(tmp_path / "index")
+    save(index_dir)
+    # Turn it back into a snapshot from before versioned directories
+    version = resolve_snapshot(index_dir)
+    os.unlink(index_dir)
+    os.rename(version, index_dir)
+
+    save(index_dir, compacted_through=5)
+    assert os.path.islink(index_dir)
+    assert read_snapshot_meta(index_dir)["compacted_through"] == 5
+    assert len([p for p in os.listdir(tmp_path) if p.startswith("index.")]) == 2
+
+
+def test_directories_that_are_not_snapshots_are_left_alone(tmp_path):
+    index_dir = tmp_path / "index"
+    index_dir.mkdir()
+    (index_dir / "notes.txt").write_text("not an index")
+    with pytest.raises(FileExistsError):
+        save(str(index_dir))
+    assert index_dir.is_dir() and not index_dir.is_symlink()
+    assert sorted(os.listdir(tmp_path)) == ["index"]
+
+
+def test_mapped_snapshots_hold_no_per_case_python_objects(tmp_path):
+    index_dir = str(tmp_path / "index")
+    save(index_dir)
+    vectorstore = load_mapped_vectorstore(resolve_snapshot(index_dir), DeterministicFakeEmbedding(size=8))
+    assert isinstance(vectorstore.index_to_docstore_id, RowIds)
+    assert len(vectorstore.similarity_search("cough", k=2)) == 2
+
+    matrix = SymptomMatrixRetriever.from_snapshot(index_dir)
+    assert not matrix.matrix.flags.owndata
+    assert [hit["disease"] for hit in matrix.search({"high_fever": True})] == ["Common Cold"]
+
+
+@pytest.mark.parametrize("n, pq, ivfpq", [
+    (263, "Flat", "IVF6,Flat"),
+    (1000, "PQ16x4", "IVF25,PQ16x4"),
+    (100000, "PQ16x8", "IVF1264,PQ16x8"),
+])
+def test_pq_codebooks_get_enough_training_points(n, pq, ivfpq):
+    params = {"index_type": "pq", "pq_m": 16, "pq_bits": 8, "nlist": 0}
+    assert index_factory_string(n, 384, params) == pq
+    assert index_factory_string(n, 384, {**params, "index_type": "ivfpq"}) == ivfpq
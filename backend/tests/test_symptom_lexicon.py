@@ -0,0 +1,62 @@
+import asyncio
+
+import numpy as np
+import pytest
+from langchain_core.language_models import FakeListChatModel
+
+from agents import DiagnosisResources, extract_symptoms
+from symptom_lexicon import SymptomLexicon
+from symptom_matrix import SymptomMatrixRetriever
+
+SYMPTOMS = ["itching", "skin_rash", "high_fever", "headache", "cough", "fatigue", "nausea"]
+
+
+@pytest.fixture(scope="module")
+def lexicon():
+    return SymptomLexicon(SYMPTOMS)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("I have a rash and a headache", {"skin_rash", "headache"}),
+    ("no fever or headache", set()),
+    ("I have a rash. No fever. Headache and cough.", {"skin_rash", "headache", "cough"}),
+    ("no fever, headache", {"headache"}),
+    ("rash; no cough", {"skin_rash"}),
+    ("no fever! tired", {"fatigue"}),
+    ("no fever but a cough", {"cough"}),
+])
+def test_negation_stops_at_clause_breaks(lexicon, text, expected):
+    found, _ = lexicon.match(text)
+    assert {name for name, present in found.items() if present} == expected
+
+
+def test_punctuation_does_not_count_towards_coverage(lexicon):
+    _, coverage = lexicon.match("Headache, cough.")
+    assert coverage == 1.0
+
+
+def test_misspellings_are_corrected(lexicon):
+    found, _ = lexicon.match("really bad hedache")
+    assert found == {"headache": True}
+
+
+def test_negated_mentions_are_ruled_out(lexicon):
+    assert lexicon.match("No, I don't have a fever") == ({"high_fever": False}, 1.0)
+    found, _ = lexicon.match("no fever. fever at night")
+    assert found == {"high_fever": True}
+
+
+def test_llm_fallback_does_not_override_negations():
+    matrix = SymptomMatrixRetriever(SYMPTOMS, np.eye(len(SYMPTOMS)), SYMPTOMS)
+    resources = DiagnosisResources(llm=FakeListChatModel(responses=["fever, tingling"]), symptom_matrix=matrix)
+    state = {"input": "No fever. Aching all over with strange tingling sensations", "structured_symptoms": {}}
+    result = asyncio.run(extract_symptoms(state, {}, resources=resources))
+    assert result["structured_symptoms"] == {"high_fever": False, "tingling": True}
+
+
+def test_only_negations_fall_back_to_the_llm():
+    matrix = SymptomMatrixRetriever(SYMPTOMS, np.eye(len(SYMPTOMS)), SYMPTOMS)
+    resources = DiagnosisResources(llm=FakeListChatModel(responses=["cough"]), symptom_matrix=matrix)
+    state = {"input": "No fever", "structured_symptoms": {}}
+    result = asyncio.run(extract_symptoms(state, {}, resources=resources))
+    assert result["structured_symptoms"] == {"high_fever": False, "cough": True}
@@ -1,5 +1,8 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import json
 import time
 from typing import List, Dict
 import pandas as pd
@@ -13,6 +16,10 @@ BACKEND_URL = (
     "http://backend:8000" if os.path.exists("/.dockerenv") 
     else os.getenv("BACKEND_URL", "http://localhost:8000")
 )
+# (connect, read) timeouts in seconds; the backend gives up on a diagnosis after 120 s
+REQUEST_TIMEOUT = (3.05, float(os.getenv("DIAGNOSIS_TIMEOUT", "130")))
+# Used when the backend can't be reached for its symptom list
+FALLBACK_SYMPTOMS = ["itching", "skin_rash", "headache", "high_fever", "cough", "joint_pain"]
 
 # Set page config
 st.set_page_config(
@@ -58,20 +65,57 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """One keep-alive connection pool shared by every rerun and browser session"""
+    session = requests.Session()
+    # Only idempotent GETs are retried; a diagnosis is never sent twice behind the user's back
+    retries = Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@st.cache_resource
+def symptom_catalogue_store() -> Dict:
+    # Last catalogue and its ETag, so a refresh can be a cheap 304
+    return {}
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_symptom_options() -> List[str]:
+    """Symptom names from the backend, fetched once per hour rather than on every rerun"""
+    store = symptom_catalogue_store()
+    headers = {"If-None-Match": store["etag"]} if "etag" in store else {}
+    response = get_http_session().get(f"{BACKEND_URL}/symptoms", headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code != 304:
+        response.raise_for_status()
+        store["symptoms"] = response.json()["symptoms"]
+        store["etag"] = response.headers.get("ETag")
+    return store["symptoms"]
+
+
 def diagnose_symptoms(symptom_text: str, structured_symptoms: Dict[str, bool] = None):
-    """Send symptoms to backend API"""
+    """Send symptoms to backend API; an identical earlier submission in this session is answered locally"""
     payload = {
         "text": symptom_text,
         "structured": structured_symptoms
     }
+    key = json.dumps([symptom_text.strip(), sorted((structured_symptoms or {}).items())])
+    cache = st.session_state.setdefault("diagnosis_cache", {})
+    if key in cache:
+        return cache[key]
     
     try:
-        response = requests.post(
+        response = get_http_session().post(
             f"{BACKEND_URL}/diagnose",
-            json=payload
+            json=payload,
+            timeout=REQUEST_TIMEOUT
         )
         response.raise_for_status()
-        return response.json()
+        cache[key] = response.json()
+        return cache[key]
     except requests.exceptions.RequestException as e:
         st.error(f"Error connecting to the diagnosis service: {e}")
         return None
@@ -146,16 +190,19 @@ def main():
         # Option 2: Structured symptom selection
         st.markdown("**Or select symptoms from list:**")
         
-        # Load symptom options (in a real app, load from your dataset)
-        symptom_options = [
-            "itching", "skin_rash", "headache", 
-            "fever", "cough", "joint_pain"
-        ]  # Add all your symptoms here
+        # Symptom options come from the backend's dataset schema
+        try:
+            symptom_options = load_symptom_options()
+        except (requests.exceptions.RequestException, KeyError, ValueError):
+            st.caption("Could not load the full symptom list; showing common symptoms.")
+            symptom_options = FALLBACK_SYMPTOMS
         
-        structured_symptoms = {
-            symptom: st.checkbox(symptom.replace("_", " ").title())
-            for symptom in symptom_options
-        }
+        selected = st.multiselect(
+            "Symptoms",
+            symptom_options,
+            format_func=lambda symptom: symptom.replace("_", " ").title()
+        )
+        structured_symptoms = {symptom: True for symptom in selected}
         
         # Diagnosis button
         if st.button("Get Diagnosis", type="primary"):